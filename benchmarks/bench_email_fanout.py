@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Sends invitation and membership notifications through an email backend
+taking --latency seconds per message, like a remote SMTP server, and
+reports the wall clock time per notification one after another and with
+OVP_ORGANIZATIONS['EMAIL_FANOUT_WORKERS'] set.
+
+  python benchmarks/bench_email_fanout.py [--latency 0.05] [--workers 4]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from django.conf import settings
+from django.core.mail.backends.locmem import EmailBackend
+
+from benchmarks import environment
+
+
+class SlowEmailBackend(EmailBackend):
+  """ locmem backend waiting settings.BENCH_EMAIL_LATENCY seconds per message """
+  def send_messages(self, messages):
+    time.sleep(settings.BENCH_EMAIL_LATENCY * len(messages))
+    return super(SlowEmailBackend, self).send_messages(messages)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--latency', type=float, default=0.05, help='seconds each message takes to send')
+  parser.add_argument('--workers', type=int, default=4, help='fan-out thread pool size')
+  args = parser.parse_args()
+
+  environment.setup(emails=True, EMAIL_BACKEND='benchmarks.bench_email_fanout.SlowEmailBackend', BENCH_EMAIL_LATENCY=args.latency)
+
+  from django.test.utils import override_settings
+  from ovp_users.models import User
+  from ovp_organizations.emails import OrganizationMail
+  from ovp_organizations.models import Organization, OrganizationInvite
+
+  owner = User.objects.create_user(email='bench@organizations.com', password='bench')
+  invitator = User.objects.create_user(email='invitator@organizations.com', password='bench')
+  users = [User.objects.create_user(email='user{}@organizations.com'.format(i), password='bench') for i in range(8)]
+  organization = Organization(name='organization', owner=owner)
+  organization.save()
+
+  notifications = (
+    ('sendUserInvited', {'invite': OrganizationInvite(organization=organization, invitator=invitator, invited=users[0])}),
+    ('sendUserJoined', {'user': users[0], 'organization': organization}),
+    ('sendMembersAdded', {'users': users, 'organization': organization}),
+  )
+
+  for label, workers in (('sequential', 0), ('fan-out', args.workers)):
+    with override_settings(OVP_ORGANIZATIONS={'EMAIL_FANOUT_WORKERS': workers}):
+      for method, context in notifications:
+        with environment.Timer() as timer:
+          results = getattr(OrganizationMail(organization, async_mail=False), method)(context=context)
+        print('{:<11} {:<17} {:>2} emails  {:.3f}s'.format(label, method, len(results), timer.elapsed))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Renders organization emails for receivers in a few locales and reports the
+time spent per email, comparing the compiled email cache used by
+OrganizationMail against resolving the subject and loading both templates
+for every email, as ovp_core BaseMail does.
+
+  python benchmarks/bench_email_render.py [--count 2000]
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmarks import environment
+
+EMAILS = (
+  ('userInvited-toUser', 'You are invited to an organization'),
+  ('userInvited-toOwner', 'A member has been invited to your organization'),
+  ('userJoined-toUser', 'You have joined an organization'),
+  ('userRemoved-toOwner', 'You have removed an user from an organization you own'),
+)
+LOCALES = ('en', 'pt-br', 'es')
+
+
+def legacy_render(template_name, subject, context={}, locale=None):
+  """ What BaseMail.sendEmail renders for every email """
+  from django.template.loader import get_template
+  from django.utils import translation
+  from ovp_core.emails import inject_client_url
+  from ovp_core.helpers import get_email_subject
+
+  with translation.override(locale):
+    subject = get_email_subject(template_name, subject)
+    ctx = inject_client_url(dict(context))
+    text_content = get_template('email/{}.txt'.format(template_name)).render(ctx)
+    html_content = get_template('email/{}.html'.format(template_name)).render(ctx)
+  return subject, text_content, html_content
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--count', type=int, default=2000, help='emails to render per implementation')
+  args = parser.parse_args()
+
+  environment.setup(emails=True)
+
+  from ovp_users.models import User
+  from ovp_organizations import email_templates
+  from ovp_organizations.emails import OrganizationMail
+  from ovp_organizations.models import Organization, OrganizationInvite
+
+  owner = User.objects.create_user(email='bench@organizations.com', password='bench')
+  invited = User.objects.create_user(email='invited@organizations.com', password='bench')
+  organization = Organization(name='organization', owner=owner)
+  organization.save()
+  context = {'invite': OrganizationInvite(organization=organization, invitator=owner, invited=invited), 'organization': organization, 'user': invited}
+
+  mailer = OrganizationMail(organization)
+  jobs = [EMAILS[i % len(EMAILS)] + (LOCALES[i % len(LOCALES)],) for i in range(args.count)]
+
+  email_templates.clear()
+  results = {}
+  for label, render in (('compiled cache', mailer.renderEmail), ('per email', legacy_render)):
+    with environment.Timer() as timer:
+      for template_name, subject, locale in jobs:
+        output = render(template_name, subject, context, locale=locale)
+    results[label] = output
+    print('{:<15} {:.3f}s  {:.1f}us/email'.format(label, timer.elapsed, timer.elapsed / args.count * 1000000))
+
+  print('same output: {}'.format(results['compiled cache'] == results['per email']))
+
+
+if __name__ == '__main__':
+  main()
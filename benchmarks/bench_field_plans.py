@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Serializes a list of organizations, half of them with hidden addresses, for a
+viewer who is not a member and reports the time spent per organization,
+comparing the compiled field plans of OrganizationRetrieveSerializer against
+the hide_address decorator it replaced.
+
+  python benchmarks/bench_field_plans.py [--count 1000] [--rounds 5]
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmarks import environment
+
+
+def legacy_hide_address(func):
+  """ The decorator OrganizationRetrieveSerializer.to_representation used to have """
+  from ovp_organizations.membership import get_membership
+
+  def _impl(self, instance):
+    if instance.hidden_address and "address" in self.fields:
+      for i, field in enumerate(self._readable_fields):
+        if field.field_name == "address":
+          address = self._readable_fields.pop(i)
+
+      ret = func(self, instance)
+      self._readable_fields.insert(i, address)
+
+      request = self.context["request"]
+      if get_membership(request, instance.pk, instance.owner_id).is_owner_or_member:
+        ret["address"] = self.fields["address"].to_representation(instance.address)
+      else:
+        ret["address"] = None
+    else:
+      ret = func(self, instance)
+    return ret
+  return _impl
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--count', type=int, default=1000, help='organizations to serialize')
+  parser.add_argument('--rounds', type=int, default=5, help='serializations per implementation, the best is reported')
+  args = parser.parse_args()
+
+  environment.setup()
+
+  from rest_framework import serializers
+  from rest_framework.request import Request
+  from rest_framework.test import APIRequestFactory
+  from ovp_core.models import GoogleAddress
+  from ovp_users.models import User
+  from ovp_organizations.membership import prefetch_memberships
+  from ovp_organizations.models import Organization
+  from ovp_organizations.serializers import OrganizationRetrieveSerializer
+
+  class LegacyRetrieveSerializer(OrganizationRetrieveSerializer):
+    @legacy_hide_address
+    def to_representation(self, instance):
+      return serializers.ModelSerializer.to_representation(self, instance)
+
+  owner = User.objects.create_user(email='bench@organizations.com', password='bench')
+  viewer = User.objects.create_user(email='viewer@organizations.com', password='bench')
+
+  for i in range(args.count):
+    address = GoogleAddress(typed_address='address {}'.format(i), address_line='address {}'.format(i), city_state='Sao Paulo, SP')
+    address.save_base(raw=True)
+    Organization(name='organization {}'.format(i), owner=owner, address=address, hidden_address=bool(i % 2)).save()
+
+  organizations = list(Organization.objects.select_related('owner', 'address', 'image', 'cover').prefetch_related('causes'))
+
+  results = {}
+  for label, serializer_class in (('field plans', OrganizationRetrieveSerializer), ('hide_address', LegacyRetrieveSerializer)):
+    best = None
+    for _ in range(args.rounds):
+      request = Request(APIRequestFactory().get('/'))
+      request.user = viewer
+      # Membership is resolved up front, only serialization is measured
+      prefetch_memberships(request, organizations)
+
+      with environment.Timer() as timer:
+        data = serializer_class(organizations, many=True, context={'request': request}).data
+      best = timer.elapsed if best is None else min(best, timer.elapsed)
+
+    results[label] = data
+    print('{:<13} {:.3f}s  {:.1f}us/organization'.format(label, best, best / args.count * 1000000))
+
+  # hide_address appended hidden addresses after the other fields, so only
+  # the contents are compared
+  same = [dict(organization) for organization in results['field plans']] == [dict(organization) for organization in results['hide_address']]
+  print('same output: {}'.format(same))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Dumps thousands of organizations with an address and an image, the way search
+indexing and map views read the list, and reports rows per second and memory
+allocations of the values() based FlatOrganizationSearchSerializer against
+OrganizationSearchSerializer over model instances.
+
+  python benchmarks/bench_flat_list.py [--count 5000] [--rounds 3]
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmarks import environment
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--count', type=int, default=5000, help='organizations to dump')
+  parser.add_argument('--rounds', type=int, default=3, help='dumps per implementation, the best is reported')
+  args = parser.parse_args()
+
+  environment.setup()
+
+  from rest_framework.renderers import JSONRenderer
+  from rest_framework.request import Request
+  from rest_framework.test import APIRequestFactory
+  from ovp_core.models import GoogleAddress
+  from ovp_uploads.models import UploadedImage
+  from ovp_users.models import User
+  from ovp_organizations.flat import FlatOrganizationSearchSerializer
+  from ovp_organizations.models import Organization
+  from ovp_organizations.serializers import OrganizationSearchSerializer
+
+  owner = User.objects.create_user(email='bench@organizations.com', password='bench')
+  for i in range(args.count):
+    address = GoogleAddress(typed_address='address {}'.format(i), city_state='Sao Paulo, SP')
+    address.save_base(raw=True)
+    image = UploadedImage.objects.create(image='user-uploaded/images/{}.jpg'.format(i))
+    Organization(name='organization {}'.format(i), owner=owner, address=address, image=image, published=True).save()
+
+  request = Request(APIRequestFactory().get('/'))
+  queryset = Organization.objects.public().order_by('-created_date', '-id')
+
+  def drf():
+    organizations = queryset.select_related('address', 'image')
+    return OrganizationSearchSerializer(organizations, many=True, context={'request': request}).data
+
+  def flat():
+    serializer = FlatOrganizationSearchSerializer(request)
+    return serializer.serialize(serializer.get_queryset(queryset))
+
+  output = {}
+  for label, dump in (('values() rows', flat), ('DRF', drf)):
+    best = None
+    for _ in range(args.rounds):
+      with environment.Timer() as timer:
+        data = dump()
+      best = timer.elapsed if best is None else min(best, timer.elapsed)
+
+    tracemalloc.start()
+    before = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    data = dump()
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename')) - before
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    output[label] = JSONRenderer().render(data)
+    print('{:<14} {:>9.0f} rows/s  peak {:>8.1f}KB  {:>8} live blocks'.format(label, args.count / best, peak / 1024, blocks))
+
+  print('byte identical: {}'.format(output['values() rows'] == output['DRF']))
+
+
+if __name__ == '__main__':
+  main()
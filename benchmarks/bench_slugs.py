@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Creates thousands of same-named organizations and reports the queries and
+time spent per create, comparing the single-query slug allocator against the
+previous count() loop.
+
+  python benchmarks/bench_slugs.py [--count 2000]
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmarks import environment
+
+
+def legacy_generate_slug(organization):
+  """ The count() loop Organization.generate_slug used to run """
+  from django.template.defaultfilters import slugify
+  from ovp_organizations.models import Organization
+
+  slug = slugify(organization.name)[0:99]
+  append = ''
+  i = 0
+
+  query = Organization.objects.filter(slug=slug + append)
+  while query.count() > 0:
+    i += 1
+    append = '-' + str(i)
+    query = Organization.objects.filter(slug=slug + append)
+  return slug + append
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--count', type=int, default=2000, help='organizations to create')
+  parser.add_argument('--name', default='Escola Municipal', help='name shared by every organization')
+  args = parser.parse_args()
+
+  environment.setup()
+
+  from django.db import connection
+  from django.db import reset_queries
+  from django.test.utils import CaptureQueriesContext
+  from ovp_users.models import User
+  from ovp_organizations.models import Organization
+
+  owner = User.objects.create_user(email='bench@organizations.com', password='bench')
+
+  checkpoints = sorted(set([1, 10, 100, 1000, args.count]))
+  queries = 0
+  with environment.Timer() as total:
+    for i in range(1, args.count + 1):
+      # The query log keeps the last 9000 queries, once full it stops
+      # growing and CaptureQueriesContext would count nothing
+      reset_queries()
+      with CaptureQueriesContext(connection) as ctx:
+        Organization(name=args.name, owner=owner).save()
+      queries += len(ctx.captured_queries)
+
+      if i in checkpoints:
+        print('{:>6} creates  queries/create={:.2f}  last create={} queries'.format(i, queries / i, len(ctx.captured_queries)))
+
+  print('total {:.3f}s  {:.3f}ms/create'.format(total.elapsed, total.elapsed / args.count * 1000))
+
+  probe = Organization(name=args.name, owner=owner)
+  for label, generate in (('allocator', probe.generate_slug), ('count() loop', lambda: legacy_generate_slug(probe))):
+    reset_queries()
+    with CaptureQueriesContext(connection) as ctx:
+      with environment.Timer() as timer:
+        slug = generate()
+    print('{:<13} next slug {!r}: {} queries, {:.3f}ms'.format(label, slug, len(ctx.captured_queries), timer.elapsed * 1000))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,71 @@
+"""
+Bootstraps a throwaway django environment for the benchmark scripts.
+
+The settings mirror ovp_organizations/tests/runtests.py, with emails going to
+the locmem backend and every organization email disabled unless a benchmark
+asks for them.
+"""
+import os
+import sys
+import time
+
+import django
+from django.conf import settings
+
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.abspath(os.path.join(BASE_DIR, '..')))
+
+ORGANIZATION_EMAILS = (
+  'organizationCreated', 'organizationCreatedToAdmin', 'organizationPublished',
+)
+
+
+def setup(emails=False, **extra_settings):
+  """ Configures settings, sets django up and creates the database schema """
+  if not settings.configured:
+    options = dict(
+      SECRET_KEY="django_benchmarks_secret_key",
+      DEBUG=False,
+      ALLOWED_HOSTS=['*'],
+      INSTALLED_APPS=(
+        'django.contrib.auth',
+        'django.contrib.contenttypes',
+        'django.contrib.sessions',
+        'django.contrib.messages',
+        'ovp_core',
+        'ovp_users',
+        'ovp_uploads',
+        'ovp_organizations',
+        'ovp_projects',
+      ),
+      AUTH_USER_MODEL='ovp_users.User',
+      ROOT_URLCONF='ovp_organizations.urls',
+      DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+      LANGUAGE_CODE='en-us',
+      TIME_ZONE='UTC',
+      USE_I18N=True,
+      USE_TZ=True,
+      PASSWORD_HASHERS=('django.contrib.auth.hashers.MD5PasswordHasher',),
+      EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+      DEFAULT_SEND_EMAIL='sync',
+      TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates', 'APP_DIRS': True}],
+      OVP_EMAILS={} if emails else {name: {'disabled': True} for name in ORGANIZATION_EMAILS},
+    )
+    options.update(extra_settings)
+    settings.configure(**options)
+
+  django.setup()
+
+  from django.core.management import call_command
+  call_command('migrate', verbosity=0, interactive=False)
+
+
+class Timer(object):
+  """ Context manager measuring wall clock time in seconds """
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.elapsed = time.perf_counter() - self.start
@@ -0,0 +1 @@
+default_app_config = 'ovp_organizations.apps.OrganizationsConfig'
@@ -0,0 +1,85 @@
+from ovp_core.helpers import get_address_model
+from ovp_core.helpers import get_address_serializers
+
+from ovp_organizations.models import touch_address
+
+# Fields filled by geocoding and the field geocoding reads from
+GEOCODED_FIELDS = ('address_line', 'city_state', 'lat', 'lng')
+GEOCODED_INPUT = 'typed_address'
+
+
+def get_changes(address, data):
+  """ Returns the items of data that differ from the address """
+  return {name: value for name, value in data.items() if getattr(address, name) != value}
+
+
+def save_address(address, data):
+  """ Creates, updates or keeps an address from serializer data, returning it.
+
+      Addresses are updated in place instead of replaced. Unchanged data
+      writes nothing, and queryset updates skip the post_save signal so
+      geocoding only runs when the typed address changes to a value no
+      other address was already geocoded for. """
+  if address is None:
+    return get_address_serializers()[0](data=data).create(data)
+
+  changes = get_changes(address, data)
+  if not changes:
+    return address
+
+  Address = get_address_model()
+  field_names = set(field.name for field in Address._meta.get_fields())
+
+  if GEOCODED_INPUT not in changes or GEOCODED_INPUT not in field_names:
+    update_fields(address, changes)
+    return address
+
+  donor = get_geocoded(Address, changes[GEOCODED_INPUT], exclude=address.pk)
+  if donor is None:
+    # Nothing to reuse, saving in place lets the signal geocode it
+    for name, value in changes.items():
+      setattr(address, name, value)
+    address.save()
+    return address
+
+  for name in GEOCODED_FIELDS:
+    if name in field_names:
+      changes[name] = getattr(donor, name)
+  update_fields(address, changes)
+
+  if 'address_components' in field_names:
+    address.address_components.set(donor.address_components.all())
+
+  return address
+
+
+def update_fields(address, changes):
+  """ Writes changes with a single UPDATE, without sending post_save """
+  type(address).objects.filter(pk=address.pk).update(**changes)
+  for name, value in changes.items():
+    setattr(address, name, value)
+
+  # post_save is what usually changes the retrieve ETag and drops cached
+  # responses
+  touch_address(address.pk)
+
+
+def get_geocoded(Address, typed_address, exclude=None):
+  """ Returns the latest address already geocoded for typed_address, if any """
+  queryset = Address.objects.filter(**{GEOCODED_INPUT: typed_address}).exclude(pk=exclude)
+  if 'lat' in set(field.name for field in Address._meta.get_fields()):
+    queryset = queryset.filter(lat__isnull=False, lng__isnull=False)
+  return queryset.order_by('-pk').first()
+
+
+def get_orphaned(Address=None):
+  """ Returns a queryset of addresses no model references anymore """
+  Address = Address or get_address_model()
+  queryset = Address.objects.all()
+  for relation in Address._meta.related_objects:
+    if relation.many_to_many:
+      continue
+    # Reverse relations pointing at the address, eg: Organization.address
+    referenced = relation.related_model._base_manager.filter(**{'{}__isnull'.format(relation.field.name): False}).values(relation.field.attname)
+    queryset = queryset.exclude(pk__in=referenced)
+  return queryset
@@ -3,6 +3,7 @@ from django import forms
 from django.utils.translation import ugettext_lazy as _
 
 from ovp_organizations.models import Organization
+from ovp_organizations.models import OutboxEmail
 
 from ovp_core.mixins import CountryFilterMixin
 
@@ -50,6 +51,18 @@ class OrganizationAdmin(admin.ModelAdmin, CountryFilterMixin):
 
   filter_horizontal = ('causes', 'members')
 
+  actions = ['publish_organizations', 'unpublish_organizations']
+
+  def publish_organizations(self, request, queryset): #pragma: no cover
+    changed = queryset.publish()
+    self.message_user(request, _('%d organizations published.') % len(changed))
+  publish_organizations.short_description = _('Publish selected organizations')
+
+  def unpublish_organizations(self, request, queryset): #pragma: no cover
+    changed = queryset.unpublish()
+    self.message_user(request, _('%d organizations unpublished.') % len(changed))
+  unpublish_organizations.short_description = _('Unpublish selected organizations')
+
   def owner__name(self, obj): #pragma: no cover
     if obj.owner:
       return obj.owner.name
@@ -82,3 +95,20 @@ class OrganizationAdmin(admin.ModelAdmin, CountryFilterMixin):
 admin.site.register(Organization, OrganizationAdmin)
 
 
+class OutboxEmailAdmin(admin.ModelAdmin):
+  list_display = [
+    'id', 'created_date', 'template_name', 'email_address', 'status', 'attempts', 'next_attempt_date', 'sent_date'
+  ]
+
+  list_filter = [
+    'status', 'template_name', 'created_date'
+  ]
+
+  search_fields = [
+    'email_address', 'subject'
+  ]
+
+  readonly_fields = ['created_date', 'sent_date', 'last_error']
+
+
+admin.site.register(OutboxEmail, OutboxEmailAdmin)
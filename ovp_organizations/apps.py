@@ -1,5 +1,24 @@
+from importlib import import_module
+
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import post_migrate
+
+
+def ensure_project_index(sender, using, **kwargs):
+    # The projects index of 0032 isn't in migration state, so ovp_projects
+    # migrations rebuilding their table on SQLite drop it
+    from django.apps import apps
+    project_index = import_module('ovp_organizations.migrations.0032_project_organization_index')
+    project_index.ensure_index(apps, connections[using])
 
 
 class OrganizationsConfig(AppConfig):
     name = 'ovp_organizations'
+
+    def ready(self):
+        post_migrate.connect(ensure_project_index, sender=self)
+
+        # Compile email templates once instead of on the first emails sent
+        from ovp_organizations import email_templates
+        email_templates.warm()
@@ -0,0 +1,115 @@
+import time
+
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.db import transaction
+
+from ovp_organizations.helpers import get_settings
+
+KEY_PREFIX = 'ovp_organizations:retrieve'
+STATS_KEYS = ('hits', 'misses', 'invalidations')
+
+
+def is_enabled():
+  """ Retrieve responses are not cached by default. Returns true if
+      OVP_ORGANIZATIONS['RETRIEVE_CACHE'] is set on settings.py
+  """
+  return bool(get_settings().get('RETRIEVE_CACHE', False))
+
+
+def get_cache():
+  return caches[get_settings().get('RETRIEVE_CACHE_ALIAS', 'default')]
+
+
+def get_timeout():
+  return get_settings().get('RETRIEVE_CACHE_TIMEOUT', 300)
+
+
+def version_key(slug):
+  return '{}:version:{}'.format(KEY_PREFIX, slug)
+
+
+def get_version(cache, slug):
+  version = cache.get(version_key(slug))
+  if version is None:
+    # Versions start from the clock, so a version evicted from the cache
+    # never comes back with a number older entries were stored under.
+    # add() so concurrent first requests agree on it
+    cache.add(version_key(slug), int(time.time() * 1000000), None)
+    version = cache.get(version_key(slug), 0)
+  return version
+
+
+def data_key(slug, version, etag):
+  return '{}:{}:{}:{}'.format(KEY_PREFIX, slug, version, etag)
+
+
+def get_or_render(slug, etag, render):
+  """ Returns the cached representation of an organization, calling render()
+      on a miss.
+
+      The ETag computed for conditional requests is part of the key. It
+      already varies with the viewer class, the language and the
+      organization row, so the signal driven version only has to cover
+      what the ETag can't see, like address or cause contents. """
+  cache = get_cache()
+  key = data_key(slug, get_version(cache, slug), etag)
+
+  data = cache.get(key)
+  if data is not None:
+    incr_stat(cache, 'hits')
+    return data
+
+  incr_stat(cache, 'misses')
+  data = OrderedDict(render())
+  cache.set(key, data, get_timeout())
+  return data
+
+
+def invalidate(slugs):
+  """ Bumps the version of the given organizations so every cached viewer
+      and language variant is dropped at once.
+
+      The version is bumped right away and again on commit, otherwise a
+      request running before the commit could cache the old row again. """
+  slugs = [slug for slug in slugs if slug]
+  if not slugs or not is_enabled():
+    return
+
+  bump_versions(slugs)
+  transaction.on_commit(lambda: bump_versions(slugs))
+
+
+def bump_versions(slugs):
+  cache = get_cache()
+  for slug in slugs:
+    try:
+      cache.incr(version_key(slug))
+    except ValueError:
+      # Nothing cached for this organization yet
+      pass
+  incr_stat(cache, 'invalidations', len(slugs))
+
+
+def incr_stat(cache, name, delta=1):
+  key = '{}:stats:{}'.format(KEY_PREFIX, name)
+  try:
+    cache.incr(key, delta)
+  except ValueError:
+    if not cache.add(key, delta, None):
+      cache.incr(key, delta)
+
+
+def get_stats():
+  """ Returns hits, misses, invalidations and the hit ratio """
+  cache = get_cache()
+  values = cache.get_many(['{}:stats:{}'.format(KEY_PREFIX, name) for name in STATS_KEYS])
+  stats = OrderedDict((name, values.get('{}:stats:{}'.format(KEY_PREFIX, name), 0)) for name in STATS_KEYS)
+  lookups = stats['hits'] + stats['misses']
+  stats['ratio'] = stats['hits'] / lookups if lookups else 0.0
+  return stats
+
+
+def reset_stats():
+  get_cache().delete_many(['{}:stats:{}'.format(KEY_PREFIX, name) for name in STATS_KEYS])
@@ -0,0 +1,50 @@
+import calendar
+import copy
+import hashlib
+
+from django.utils import translation
+from django.utils.cache import get_conditional_response
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date
+from django.utils.http import quote_etag
+
+
+def make_etag(*parts):
+  """ Returns a strong ETag for a representation identified by parts, which
+      always include the active language """
+  value = '|'.join(str(part) for part in parts + (translation.get_language(),))
+  return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+def to_timestamp(*dates):
+  """ Returns the latest of dates as an epoch timestamp, ignoring Nones """
+  dates = [date for date in dates if date is not None]
+  if not dates:
+    return None
+  return calendar.timegm(max(dates).utctimetuple())
+
+
+def not_modified(request, etag, last_modified):
+  """ Returns a 304 response if the request validators match, None otherwise.
+      Without last_modified, eg: for viewer dependent bodies, date
+      preconditions are ignored and only the ETag is compared """
+  request = getattr(request, '_request', request)
+  if last_modified is None:
+    request = copy.copy(request)
+    request.META = {key: value for key, value in request.META.items() if key not in ('HTTP_IF_MODIFIED_SINCE', 'HTTP_IF_UNMODIFIED_SINCE')}
+  response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+  if response is not None and response.status_code == 304:
+    response['ETag'] = quote_etag(etag)
+  return response
+
+
+def set_validators(response, etag, last_modified, private=False):
+  """ Sets ETag and Last-Modified on a 200 response """
+  if response.status_code == 200:
+    response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+      response['Last-Modified'] = http_date(last_modified)
+    if private:
+      # Viewer dependent bodies must not be stored by shared caches
+      patch_cache_control(response, private=True)
+  return response
@@ -0,0 +1,146 @@
+import atexit
+import smtplib
+import threading
+import time
+
+from django.core.mail import get_connection
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from ovp_organizations.helpers import get_settings
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class PooledConnection(object):
+  """ An open email backend connection and how it has been used """
+  def __init__(self, connection):
+    self.connection = connection
+    self.sent = 0
+    self.last_used = time.monotonic()
+
+
+class ConnectionPool(object):
+  """
+  Keeps email backend connections open between messages, eg: SMTP sessions
+  that already paid for the TCP and TLS handshakes and AUTH.
+
+  At most size connections are open at once, a connection is closed after
+  sending max_messages messages, and idle connections are closed after
+  idle_timeout seconds, before servers drop them
+  """
+  def __init__(self, size=4, max_messages=100, idle_timeout=30, backend=None):
+    self.size = size
+    self.max_messages = max_messages
+    self.idle_timeout = idle_timeout
+    self.backend = backend
+    self.idle = []
+    self.lock = threading.Lock()
+    self.slots = threading.BoundedSemaphore(size)
+
+  def acquire(self):
+    """ Returns the most recently used idle connection, or opens a new one """
+    self.slots.acquire()
+    try:
+      self.evict_idle()
+      with self.lock:
+        if self.idle:
+          return self.idle.pop()
+
+      connection = get_connection(self.backend, fail_silently=False)
+      connection.open()
+      return PooledConnection(connection)
+    except Exception:
+      self.slots.release()
+      raise
+
+  def release(self, pooled, discard=False):
+    """ Puts a connection back in the pool, closing it if it's worn out or broken """
+    try:
+      pooled.last_used = time.monotonic()
+      if discard or pooled.sent >= self.max_messages:
+        close(pooled)
+      else:
+        with self.lock:
+          self.idle.append(pooled)
+    finally:
+      self.slots.release()
+
+  def send(self, message):
+    """ Sends an EmailMessage through a pooled connection, returning true if
+        it was sent. A connection the server closed while idle is replaced
+        once """
+    for attempt in range(2):
+      pooled = self.acquire()
+      try:
+        sent = pooled.connection.send_messages([message])
+      except smtplib.SMTPServerDisconnected:
+        self.release(pooled, discard=True)
+        if attempt:
+          raise
+        continue
+      except Exception:
+        self.release(pooled, discard=True)
+        raise
+
+      pooled.sent += 1
+      self.release(pooled)
+      return bool(sent)
+
+  def evict_idle(self):
+    """ Closes connections left idle for longer than idle_timeout """
+    deadline = time.monotonic() - self.idle_timeout
+    with self.lock:
+      expired = [pooled for pooled in self.idle if pooled.last_used <= deadline]
+      self.idle = [pooled for pooled in self.idle if pooled.last_used > deadline]
+    for pooled in expired:
+      close(pooled)
+
+  def close_all(self):
+    with self.lock:
+      idle, self.idle = self.idle, []
+    for pooled in idle:
+      close(pooled)
+
+
+def close(pooled):
+  try:
+    pooled.connection.close()
+  except Exception:
+    # Closing a dropped connection must not hide the message result
+    pass
+
+
+def is_enabled():
+  """ Each email opens its own connection by default. Returns true if
+      OVP_ORGANIZATIONS['EMAIL_CONNECTION_POOL'] is set on settings.py
+  """
+  return bool(get_settings().get('EMAIL_CONNECTION_POOL', False))
+
+
+def get_pool():
+  """ Returns the process wide pool configured by EMAIL_CONNECTION_POOL,
+      either True or a dict of ConnectionPool arguments """
+  global _pool
+  if _pool is None:
+    with _pool_lock:
+      if _pool is None:
+        options = get_settings().get('EMAIL_CONNECTION_POOL', {})
+        _pool = ConnectionPool(**(options if isinstance(options, dict) else {}))
+  return _pool
+
+
+@atexit.register
+def close_pool():
+  global _pool
+  with _pool_lock:
+    pool, _pool = _pool, None
+  if pool is not None:
+    pool.close_all()
+
+
+@receiver(setting_changed)
+def close_pool_on_setting_changed(sender, setting, **kwargs):
+  if setting in ('OVP_ORGANIZATIONS', 'EMAIL_BACKEND', 'EMAIL_HOST', 'EMAIL_PORT'):
+    close_pool()
@@ -0,0 +1,79 @@
+import os
+import threading
+
+from collections import namedtuple
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template import TemplateDoesNotExist
+from django.template.loader import get_template
+from django.utils import translation
+
+from ovp_core.helpers import get_email_subject
+from ovp_core.helpers import is_email_enabled
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'email')
+
+CompiledEmail = namedtuple('CompiledEmail', ['subject', 'text', 'html'])
+
+_templates = {}
+_emails = {}
+_lock = threading.Lock()
+
+
+def get_compiled_template(path):
+  """ Returns the compiled template for path, loading it on first use """
+  template = _templates.get(path, None)
+  if template is None:
+    template = get_template(path)
+    with _lock:
+      template = _templates.setdefault(path, template)
+  return template
+
+
+def get_compiled_email(template_name, subject, locale):
+  """ Returns the translated subject and the compiled text and html templates
+      of an email, cached by (template name, locale).
+
+      Templates are locale independent and shared by every locale, only the
+      subject is translated once per locale """
+  key = (template_name, locale)
+  email = _emails.get(key, None)
+  if email is None:
+    with translation.override(locale):
+      translated = str(get_email_subject(template_name, subject))
+    email = CompiledEmail(
+      translated,
+      get_compiled_template('email/{}.txt'.format(template_name)),
+      get_compiled_template('email/{}.html'.format(template_name)),
+    )
+    with _lock:
+      email = _emails.setdefault(key, email)
+  return email
+
+
+def warm():
+  """ Compiles the email templates shipped with the app, skipping disabled
+      emails. Runs while django is set up, so templates the configured
+      engines can't find are left to fail when the email is sent """
+  for filename in sorted(os.listdir(TEMPLATES_DIR)):
+    template_name, extension = os.path.splitext(filename)
+    if extension not in ('.txt', '.html') or not is_email_enabled(template_name):
+      continue
+    try:
+      get_compiled_template('email/{}'.format(filename))
+    except TemplateDoesNotExist:
+      pass
+
+
+def clear():
+  with _lock:
+    _templates.clear()
+    _emails.clear()
+
+
+@receiver(setting_changed)
+def clear_on_setting_changed(sender, setting, **kwargs):
+  # Templates and subjects depend on these, eg: with override_settings
+  if setting in ('TEMPLATES', 'OVP_EMAILS', 'LANGUAGE_CODE', 'LOCALE_PATHS', 'INSTALLED_APPS'):
+    clear()
@@ -1,7 +1,122 @@
+import copy
+import threading
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.utils import translation
+
 from ovp_core.emails import BaseMail
-from ovp_core.helpers import get_settings
+from ovp_core.emails import EmailThread
+from ovp_core.emails import inject_client_url
+from ovp_core.helpers import get_settings, is_email_enabled
+
+from ovp_organizations import connection_pool
+from ovp_organizations import email_templates
+from ovp_organizations import fanout
+from ovp_organizations import outbox
+
+class OrganizationBaseMail(BaseMail):
+  """
+  Base class for organization emails. Emails are written to the outbox
+  instead of being sent when OVP_ORGANIZATIONS['EMAIL_OUTBOX'] is enabled.
+
+  Subjects and templates come from the compiled email cache, and any user
+  can be given as receiver without re-initializing the mailer
+  """
+  # None follows the setting, True or False overrides it for this instance
+  use_outbox = None
+
+  def sendEmail(self, template_name, subject, context={}, receiver=None):
+    if not is_email_enabled(template_name):
+      return False
+
+    email_address, locale = self.get_receiver(receiver)
+    use_outbox = outbox.is_enabled() if self.use_outbox is None else self.use_outbox
+    if use_outbox and not email_address:
+      return False
+
+    subject, text_content, html_content = self.renderEmail(template_name, subject, context, locale=locale)
+    if use_outbox:
+      return outbox.enqueue(template_name, self.from_email, email_address, subject, text_content, html_content)
+
+    msg = EmailMultiAlternatives(subject, text_content, self.from_email, [email_address])
+    msg.attach_alternative(html_content, "text/html")
+    return self.deliver(msg)
+
+  def sendEmails(self, emails):
+    """
+    Sends a list of (template_name, subject, context, receiver) and returns
+    their results in order.
+
+    With OVP_ORGANIZATIONS['EMAIL_FANOUT_WORKERS'] set, emails sent
+    synchronously are rendered and sent concurrently on a bounded thread
+    pool. Every email is attempted and fanout.FanoutError is raised
+    afterwards if some failed. Async emails already leave the caller
+    thread one by one, and outbox emails are always written one after
+    another, inside the caller transaction
+    """
+    use_outbox = outbox.is_enabled() if self.use_outbox is None else self.use_outbox
+    if use_outbox or self.is_async() or len(emails) < 2 or not fanout.is_enabled():
+      return [self.sendEmail(*email) for email in emails]
+
+    # Workers already run concurrently, they send without another thread
+    mailer = copy.copy(self)
+    mailer.async_mail = False
+    return fanout.run([lambda email=email: mailer.sendEmail(*email) for email in emails])
+
+  def get_receiver(self, receiver=None):
+    """
+    Returns (email address, locale) of a receiver user, or of this mailer
+    """
+    if receiver is None:
+      return self.email_address, self.locale
+    return receiver.email, receiver.locale or get_settings().get('LANGUAGE_CODE', 'en-us')
+
+  def renderEmail(self, template_name, subject, context={}, locale=None):
+    """
+    Returns (subject, text_content, html_content) rendered in the receiver locale
+    """
+    locale = locale or self.locale
+    email = email_templates.get_compiled_email(template_name, subject, locale)
+
+    with translation.override(locale):
+      ctx = inject_client_url(dict(context))
+      text_content = email.text.render(ctx)
+      html_content = email.html.render(ctx)
+
+    return email.subject, text_content, html_content
+
+  def is_async(self):
+    """
+    Returns true if emails are sent on a thread, either set on the mailer
+    or following settings.DEFAULT_SEND_EMAIL as BaseMail does
+    """
+    return bool(self.async_mail or (self.async_mail is None and getattr(settings, "DEFAULT_SEND_EMAIL", "async") == "async"))
+
+  def deliver(self, msg):
+    """
+    Sends msg on a thread or right away, as BaseMail does. With
+    OVP_ORGANIZATIONS['EMAIL_CONNECTION_POOL'] set, msg goes through a
+    pooled connection instead of opening its own
+    """
+    async_mail = self.is_async()
+
+    if connection_pool.is_enabled():
+      pool = connection_pool.get_pool()
+      if async_mail:
+        thread = threading.Thread(target=pool.send, args=(msg,))
+        thread.start()
+        return thread
+      return pool.send(msg)
+
+    if async_mail:
+      thread = EmailThread(msg)
+      thread.start()
+      return thread
+    return msg.send() > 0
 
-class OrganizationMail(BaseMail):
+
+class OrganizationMail(OrganizationBaseMail):
   """
   This class is responsible for firing emails for organizations
   """
@@ -34,72 +149,82 @@ class OrganizationMail(BaseMail):
     organization, invited, invitator = context['invite'].organization, context['invite'].invited, context['invite'].invitator
 
     # invited user email
-    self.__init__(context['invite'].organization, async_mail=self.async_mail, override_receiver=invited.email, locale=invited.locale)
-    self.sendEmail('userInvited-toUser', 'You are invited to an organization', context)
+    emails = [('userInvited-toUser', 'You are invited to an organization', context, invited)]
 
-    if organization.owner == context['invite'].invitator:
-      self.__init__(organization, async_mail=self.async_mail, override_receiver=organization.owner.email, locale=organization.owner.locale)
-      self.sendEmail('userInvited-toOwnerInviter', 'You invited a member to an organization you own', context)
+    if organization.owner == invitator:
+      emails.append(('userInvited-toOwnerInviter', 'You invited a member to an organization you own', context, organization.owner))
     else:
-      self.__init__(organization, async_mail=self.async_mail, override_receiver=organization.owner.email, locale=organization.owner.locale)
-      self.sendEmail('userInvited-toOwner', 'A member has been invited to your organization', context)
+      emails.append(('userInvited-toOwner', 'A member has been invited to your organization', context, organization.owner))
+      emails.append(('userInvited-toMemberInviter', 'You invited a member to an organization you are part of', context, invitator))
 
-      self.__init__(organization, async_mail=self.async_mail, override_receiver=invitator.email, locale=invitator.locale)
-      self.sendEmail('userInvited-toMemberInviter', 'You invited a member to an organization you are part of', context)
+    return self.sendEmails(emails)
 
   def sendUserInvitationRevoked(self, context={}):
     """
     Sent when user is invitation is revoked
     """
     organization, invited, invitator = context['invite'].organization, context['invite'].invited, context['invite'].invitator
+
     # invited user email
-    self.__init__(organization, async_mail=self.async_mail, override_receiver=invited.email, locale=invited.locale)
-    self.sendEmail('userInvitedRevoked-toUser', 'Your invitation to an organization has been revoked', context)
+    emails = [('userInvitedRevoked-toUser', 'Your invitation to an organization has been revoked', context, invited)]
 
     if organization.owner == invitator:
-      self.__init__(organization, async_mail=self.async_mail, override_receiver=organization.owner.email, locale=organization.owner.locale)
-      self.sendEmail('userInvitedRevoked-toOwnerInviter', 'You have revoked an user invitation', context)
+      emails.append(('userInvitedRevoked-toOwnerInviter', 'You have revoked an user invitation', context, organization.owner))
     else:
-      self.__init__(organization, async_mail=self.async_mail, override_receiver=organization.owner.email, locale=organization.owner.locale)
-      self.sendEmail('userInvitedRevoked-toOwner', 'An invitation to join your organization has been revoked', context)
+      emails.append(('userInvitedRevoked-toOwner', 'An invitation to join your organization has been revoked', context, organization.owner))
+      emails.append(('userInvitedRevoked-toMemberInviter', 'You have revoked an user invitation', context, invitator))
 
-      self.__init__(organization, async_mail=self.async_mail, override_receiver=invitator.email, locale=invitator.locale)
-      self.sendEmail('userInvitedRevoked-toMemberInviter', 'You have revoked an user invitation', context)
+    return self.sendEmails(emails)
 
 
   def sendUserLeft(self, context={}):
     """
     Sent when user leaves organization
     """
-    self.__init__(context['organization'], async_mail=self.async_mail, override_receiver=context['user'].email, locale=context['user'].locale)
-    self.sendEmail('userLeft-toUser', 'You have left an organization', context)
-
-    self.__init__(context['organization'], async_mail=self.async_mail, override_receiver=context['organization'].owner.email, locale=context['organization'].owner.locale)
-    self.sendEmail('userLeft-toOwner', 'An user has left an organization you own', context)
+    return self.sendEmails([
+      ('userLeft-toUser', 'You have left an organization', context, context['user']),
+      ('userLeft-toOwner', 'An user has left an organization you own', context, context['organization'].owner),
+    ])
 
 
   def sendUserRemoved(self, context={}):
     """
     Sent when user is removed from organization
     """
-    self.__init__(context['organization'], async_mail=self.async_mail, override_receiver=context['user'].email, locale=context['user'].locale)
-    self.sendEmail('userRemoved-toUser', 'You have have been removed from an organization', context)
-
-    self.__init__(context['organization'], async_mail=self.async_mail, override_receiver=context['organization'].owner.email, locale=context['organization'].owner.locale)
-    self.sendEmail('userRemoved-toOwner', 'You have removed an user from an organization you own', context)
+    return self.sendEmails([
+      ('userRemoved-toUser', 'You have have been removed from an organization', context, context['user']),
+      ('userRemoved-toOwner', 'You have removed an user from an organization you own', context, context['organization'].owner),
+    ])
 
   def sendUserJoined(self, context={}):
     """
     Sent when user joins organization
     """
-    self.__init__(context['organization'], async_mail=self.async_mail, override_receiver=context['user'].email, locale=context['user'].locale)
-    self.sendEmail('userJoined-toUser', 'You have joined an organization', context)
+    return self.sendEmails([
+      ('userJoined-toUser', 'You have joined an organization', context, context['user']),
+      ('userJoined-toOwner', 'An user has joined an organization you own', context, context['organization'].owner),
+    ])
 
-    self.__init__(context['organization'], async_mail=self.async_mail, override_receiver=context['organization'].owner.email, locale=context['organization'].owner.locale)
-    self.sendEmail('userJoined-toOwner', 'An user has joined an organization you own', context)
+  def sendMembersAdded(self, context={}):
+    """
+    Sent when many users are added to organization at once.
+    Each user gets their own email, the owner gets a single one listing them
+    """
+    emails = [('userJoined-toUser', 'You have joined an organization', {"user": user, "organization": context['organization']}, user) for user in context['users']]
+    emails.append(('membersAdded-toOwner', 'Users have been added to an organization you own', context, context['organization'].owner))
+    return self.sendEmails(emails)
+
+  def sendMembersRemoved(self, context={}):
+    """
+    Sent when many users are removed from organization at once.
+    Each user gets their own email, the owner gets a single one listing them
+    """
+    emails = [('userRemoved-toUser', 'You have have been removed from an organization', {"user": user, "organization": context['organization']}, user) for user in context['users']]
+    emails.append(('membersRemoved-toOwner', 'Users have been removed from an organization you own', context, context['organization'].owner))
+    return self.sendEmails(emails)
 
 
-class OrganizationAdminMail(BaseMail):
+class OrganizationAdminMail(OrganizationBaseMail):
   """
   This class is responsible for firing emails for Organization related actions
   """
@@ -0,0 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connections
+
+from ovp_organizations.helpers import get_settings
+
+
+class FanoutError(Exception):
+  """ Raised once every job of a fan-out ran, when some of them failed.
+      results holds what each job returned, None for the failed ones, and
+      errors the (index, exception) of each failure """
+  def __init__(self, results, errors):
+    self.results = results
+    self.errors = errors
+    super(FanoutError, self).__init__('{} of {} jobs failed: {}'.format(len(errors), len(results), errors[0][1]))
+
+
+def get_workers():
+  """ Emails are sent one after another by default. Returns the size of the
+      thread pool set on OVP_ORGANIZATIONS['EMAIL_FANOUT_WORKERS'] """
+  return int(get_settings().get('EMAIL_FANOUT_WORKERS', 0) or 0)
+
+
+def is_enabled():
+  return get_workers() > 0
+
+
+def run(jobs):
+  """ Runs callables concurrently on a bounded thread pool and returns their
+      results in order, waiting for all of them """
+  results, errors = [None] * len(jobs), []
+
+  with ThreadPoolExecutor(max_workers=min(get_workers(), len(jobs)) or 1) as executor:
+    futures = [executor.submit(call, job) for job in jobs]
+    for i, future in enumerate(futures):
+      try:
+        results[i] = future.result()
+      except Exception as e:
+        errors.append((i, e))
+
+  if errors:
+    raise FanoutError(results, errors)
+  return results
+
+
+def call(job):
+  try:
+    return job()
+  finally:
+    # Connections opened by pool threads are not closed by request handling
+    connections.close_all()
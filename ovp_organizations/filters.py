@@ -0,0 +1,43 @@
+from rest_framework import exceptions
+
+from ovp_organizations.models import Organization
+
+TRUE_VALUES = ('1', 'true', 'yes')
+FALSE_VALUES = ('0', 'false', 'no')
+
+
+def filter_organizations(queryset, params):
+  """ Applies the type, causes, highlighted and name query params to an organization queryset """
+  types = parse_ids(params, 'type')
+  if types:
+    queryset = queryset.filter(type__in=types)
+
+  causes = parse_ids(params, 'causes')
+  if causes:
+    # A subquery instead of a join, so organizations with many matching
+    # causes are not repeated and no DISTINCT is needed
+    Through = Organization.causes.through
+    queryset = queryset.filter(pk__in=Through.objects.filter(cause_id__in=causes).values('organization_id'))
+
+  highlighted = params.get('highlighted', '').lower()
+  if highlighted in TRUE_VALUES:
+    queryset = queryset.filter(highlighted=True)
+  elif highlighted in FALSE_VALUES:
+    queryset = queryset.filter(highlighted=False)
+  elif highlighted:
+    raise exceptions.ValidationError({'highlighted': ['Must be a valid boolean.']})
+
+  name = params.get('name', '').strip()
+  if name:
+    queryset = queryset.filter(name__icontains=name)
+
+  return queryset
+
+
+def parse_ids(params, param):
+  """ Parses a comma separated list of integers, eg: ?causes=1,2 """
+  value = params.get(param, '')
+  try:
+    return [int(v) for v in value.split(',') if v.strip()]
+  except ValueError:
+    raise exceptions.ValidationError({param: ['Must be a comma separated list of integers.']})
@@ -0,0 +1,90 @@
+from collections import OrderedDict
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Field
+
+from ovp_core.helpers import get_address_serializers
+
+from ovp_uploads.models import UploadedImage
+
+from ovp_organizations.serializers import OrganizationSearchSerializer
+
+# Columns the list paginator reads its cursor from
+CURSOR_COLUMNS = ['created_date', 'id']
+
+IMAGE_COLUMNS = ['image', 'image_small', 'image_medium', 'image_large']
+
+
+class FlatOrganizationSearchSerializer(object):
+  """
+  Renders the same data as OrganizationSearchSerializer from values() rows,
+  with the address and image columns joined in, skipping model instances and
+  the DRF field machinery. Used by the list, where search indexing and map
+  views dump thousands of organizations at once.
+  """
+  def __init__(self, request, names=None):
+    self.request = request
+    self.names = names if names is not None else OrganizationSearchSerializer.Meta.fields
+    self.address_fields = get_address_serializers()[2].Meta.fields
+    self.storages = {column: UploadedImage._meta.get_field(column).storage for column in IMAGE_COLUMNS}
+
+  @classmethod
+  def is_supported(cls):
+    """ The flat path only knows address serializers made of plain model
+        fields, others keep going through OrganizationSearchSerializer """
+    serializer = get_address_serializers()[2]
+    if serializer._declared_fields or getattr(serializer.Meta, 'extra_kwargs', None):
+      return False
+
+    for name in serializer.Meta.fields:
+      try:
+        field = serializer.Meta.model._meta.get_field(name)
+      except FieldDoesNotExist:
+        return False
+      if not isinstance(field, Field) or not field.concrete or field.is_relation:
+        return False
+    return True
+
+  def get_columns(self):
+    columns = list(CURSOR_COLUMNS)
+    for name in self.names:
+      if name == 'address':
+        columns += ['address'] + ['address__{}'.format(field) for field in self.address_fields]
+      elif name == 'image':
+        columns += ['image', 'image__user'] + ['image__{}'.format(column) for column in IMAGE_COLUMNS]
+      elif name not in columns:
+        columns.append(name)
+    return columns
+
+  def get_queryset(self, queryset):
+    return queryset.values(*self.get_columns())
+
+  def to_representation(self, row):
+    ret = OrderedDict()
+    for name in self.names:
+      if name == 'address':
+        ret[name] = self.address_representation(row)
+      elif name == 'image':
+        ret[name] = self.image_representation(row)
+      else:
+        ret[name] = row[name]
+    return ret
+
+  def address_representation(self, row):
+    if row['address'] is None:
+      return None
+    return OrderedDict((field, row['address__{}'.format(field)]) for field in self.address_fields)
+
+  def image_representation(self, row):
+    if row['image'] is None:
+      return None
+
+    ret = OrderedDict([('id', row['image']), ('user', row['image__user'])])
+    for column in IMAGE_COLUMNS:
+      name = row['image__{}'.format(column)]
+      # Same as ovp_uploads build_absolute_uri, empty files have no url
+      ret['{}_url'.format(column)] = self.request.build_absolute_uri(self.storages[column].url(name)) if name else None
+    return ret
+
+  def serialize(self, rows):
+    return [self.to_representation(row) for row in rows]
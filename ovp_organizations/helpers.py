@@ -0,0 +1,4 @@
+from django.conf import settings
+
+def get_settings(string="OVP_ORGANIZATIONS"):
+  return getattr(settings, string, {})
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from ovp_organizations.addresses import get_orphaned
+
+class Command(BaseCommand):
+  help = "Delete addresses no organization, project or other model references anymore"
+
+  def add_arguments(self, parser):
+    parser.add_argument('--batch-size', type=int, default=500, help='Addresses checked per batch')
+    parser.add_argument('--grace', type=float, default=60, help='Seconds to wait before checking addresses, letting the organizations and projects being created with them commit')
+    parser.add_argument('--dry-run', action='store_true', default=False, help='Only count orphaned addresses')
+
+  def handle(self, *args, **options):
+    batch_size = options['batch_size']
+    orphaned = get_orphaned()
+
+    # Addresses are inserted before the organization or project referencing
+    # them, eg: by ovp_projects outside a transaction. Only addresses that
+    # existed grace seconds ago are considered, so those inserts had time
+    # to commit
+    last_id = orphaned.model.objects.aggregate(last_id=Max('pk'))['last_id'] or 0
+    time.sleep(options['grace'])
+
+    # Walk primary key ranges so each DELETE stays short and locks few rows
+    deleted = 0
+    for start in range(0, last_id + 1, batch_size):
+      batch = orphaned.filter(pk__gte=start, pk__lt=min(start + batch_size, last_id + 1))
+      if options['dry_run']:
+        deleted += batch.count()
+      else:
+        deleted += batch.delete()[1].get(orphaned.model._meta.label, 0)
+
+    if options['dry_run']:
+      self.stdout.write("Found {} orphaned addresses".format(deleted))
+    else:
+      self.stdout.write("Deleted {} orphaned addresses".format(deleted))
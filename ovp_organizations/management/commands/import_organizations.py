@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+import itertools
+import json
+import sys
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db import transaction
+from django.db.models.signals import post_save
+
+from ovp_core.helpers import get_address_model
+from ovp_core.models import Cause
+from ovp_users.models import User
+
+from ovp_organizations import outbox
+from ovp_organizations.models import Organization
+
+# Columns copied straight into Organization, the same ones
+# OrganizationCreateSerializer accepts
+ORGANIZATION_FIELDS = ['name', 'website', 'facebook_page', 'details', 'description', 'type', 'hidden_address', 'contact_name', 'contact_email', 'contact_phone', 'atados_link', 'document']
+
+TRUE_VALUES = ('1', 'true', 'yes', 't', 'y')
+
+
+class RowError(Exception):
+  pass
+
+
+class Command(BaseCommand):
+  help = "Import organizations from a CSV or JSON lines file, in chunks and in constant memory"
+
+  def add_arguments(self, parser):
+    parser.add_argument('path', help="CSV or JSON lines file, '-' reads from stdin")
+    parser.add_argument('--format', choices=['csv', 'jsonl'], default=None, help='Input format, guessed from the file extension by default')
+    parser.add_argument('--owner', default=None, help="Email of the owner of rows without an 'owner' column")
+    parser.add_argument('--chunk-size', type=int, default=500, help='Rows inserted per transaction')
+    parser.add_argument('--emails', choices=['none', 'outbox', 'send'], default='none', help="'none' skips the organization created emails to the owner and the admin, 'outbox' writes them to the outbox and 'send' sends them as Organization.save() would")
+    parser.add_argument('--geocode', action='store_true', help='Fire post_save for imported addresses so they are geocoded, one request per address')
+
+  def handle(self, *args, **options):
+    fmt = options['format'] or ('jsonl' if options['path'].endswith(('.jsonl', '.json')) else 'csv')
+    if options['chunk_size'] < 1:
+      raise CommandError('--chunk-size must be positive.')
+
+    self.options = options
+    self.address_model = get_address_model()
+    self.causes = Cause.objects.in_bulk()
+    self.default_owner = None
+    if options['owner']:
+      try:
+        self.default_owner = User.objects.get(email=options['owner'])
+      except User.DoesNotExist:
+        raise CommandError("Owner '{}' does not exist.".format(options['owner']))
+
+    imported, skipped = 0, 0
+    start = time.perf_counter()
+
+    stream = sys.stdin if options['path'] == '-' else io.open(options['path'], encoding='utf-8', newline='')
+    try:
+      rows = enumerate(read_rows(stream, fmt), start=2 if fmt == 'csv' else 1)
+      while True:
+        chunk = list(itertools.islice(rows, options['chunk_size']))
+        if not chunk:
+          break
+
+        chunk_imported, chunk_skipped = self.import_chunk(chunk)
+        imported += chunk_imported
+        skipped += chunk_skipped
+
+        if options['verbosity'] > 1:
+          elapsed = time.perf_counter() - start
+          self.stdout.write("{} organizations imported ({:.0f} rows/s)".format(imported, (imported + skipped) / elapsed))
+    finally:
+      if stream is not sys.stdin:
+        stream.close()
+
+    elapsed = time.perf_counter() - start
+    rate = (imported + skipped) / elapsed if elapsed else 0
+    self.stdout.write("Imported {} organizations in {:.2f}s ({:.0f} rows/s), {} rows skipped".format(imported, elapsed, rate, skipped))
+
+  def import_chunk(self, chunk):
+    """ Inserts a chunk of (line, row) tuples. Returns an (imported, skipped) tuple """
+    owners = self.resolve_owners(chunk)
+
+    entries = []
+    for line, row in chunk:
+      try:
+        entries.append(self.build(row, owners))
+      except (RowError, ValidationError, ValueError, TypeError) as e:
+        self.stderr.write("Line {}: {}".format(line, getattr(e, 'message_dict', e)))
+
+    if not entries:
+      return 0, len(chunk)
+
+    with transaction.atomic():
+      slugs = Organization.objects.allocate_slugs([organization.name for organization, address, causes in entries])
+      for (organization, address, causes), slug in zip(entries, slugs):
+        organization.slug = slug
+
+      self.insert_addresses(entries)
+      organizations = self.insert_organizations(entries)
+
+      Through = Organization.causes.through
+      Through.objects.bulk_create([Through(organization_id=organization.pk, cause_id=cause.pk) for organization, address, causes in entries for cause in causes])
+
+      Members = Organization.members.through
+      Members.objects.bulk_create([Members(organization_id=organization.pk, user_id=organization.owner_id) for organization in organizations])
+
+      self.send_emails(organizations)
+
+    return len(entries), len(chunk) - len(entries)
+
+  def resolve_owners(self, chunk):
+    """ Loads the owners referenced by a chunk with a single query """
+    emails = set(row['owner'] for line, row in chunk if row.get('owner'))
+    return {user.email: user for user in User.objects.filter(email__in=emails)}
+
+  def build(self, row, owners):
+    """ Returns an unsaved (organization, address, causes) tuple for a row """
+    if row.get('owner'):
+      owner = owners.get(row['owner'], None)
+      if owner is None:
+        raise RowError("Owner '{}' does not exist.".format(row['owner']))
+    elif self.default_owner:
+      owner = self.default_owner
+    else:
+      raise RowError("Row has no owner and --owner was not given.")
+
+    data = {field: row[field] for field in ORGANIZATION_FIELDS if field in row}
+    if 'type' in data:
+      data['type'] = int(data['type'])
+    if 'hidden_address' in data and not isinstance(data['hidden_address'], bool):
+      data['hidden_address'] = str(data['hidden_address']).lower() in TRUE_VALUES
+
+    # The owner is inserted as the only member
+    organization = Organization(owner=owner, members_count=1, **data)
+    if not organization.name:
+      raise RowError("Row has no name.")
+    organization.clean_fields(exclude=['slug', 'owner', 'address', 'image', 'cover'])
+
+    # Same excerpt Organization.save() takes
+    if not organization.description and organization.details:
+      organization.description = organization.details[0:100]
+
+    address = None
+    if row.get('address'):
+      address = self.address_model(**row['address'])
+      address.clean_fields()
+
+    causes = []
+    for cause_id in parse_causes(row.get('causes')):
+      if cause_id not in self.causes:
+        raise RowError("Cause with 'id' {} does not exist.".format(cause_id))
+      causes.append(self.causes[cause_id])
+
+    return organization, address, causes
+
+  def insert_addresses(self, entries):
+    addresses = [address for organization, address, causes in entries if address is not None]
+    if connection.features.can_return_ids_from_bulk_insert:
+      self.address_model.objects.bulk_create(addresses)
+    else:
+      # Raw saves skip the geocoding signal just like bulk_create does
+      for address in addresses:
+        address.save_base(raw=True)
+
+    for organization, address, causes in entries:
+      if address is not None:
+        organization.address = address
+
+    if self.options['geocode']:
+      for address in addresses:
+        post_save.send(sender=self.address_model, instance=address, created=True, raw=False, using=address._state.db, update_fields=None)
+
+  def insert_organizations(self, entries):
+    organizations = [organization for organization, address, causes in entries]
+    Organization.objects.bulk_create(organizations)
+
+    if not connection.features.can_return_ids_from_bulk_insert:
+      # Slugs are unique, so they tell us which ids were assigned
+      ids = {}
+      slugs = [organization.slug for organization in organizations]
+      for i in range(0, len(slugs), 500):
+        ids.update(Organization.objects.filter(slug__in=slugs[i:i + 500]).values_list('slug', 'pk'))
+      for organization in organizations:
+        organization.pk = ids[organization.slug]
+
+    for organization in organizations:
+      organization._state.adding = False
+      organization._snapshot_fields()
+    return organizations
+
+  def send_emails(self, organizations):
+    if self.options['emails'] == 'none':
+      return
+
+    with outbox.batch():
+      for organization in organizations:
+        mail, admin_mail = organization.mailing(), organization.admin_mailing()
+        if self.options['emails'] == 'outbox':
+          mail.use_outbox = admin_mail.use_outbox = True
+
+        mail.sendOrganizationCreated()
+        try:
+          admin_mail.sendOrganizationCreated()
+        except Exception:
+          # As in Organization.save(), a failing admin email doesn't stop the import
+          pass
+
+
+#
+# Helpers
+#
+
+def read_rows(stream, fmt):
+  """ Lazily yields normalized rows from a CSV or JSON lines stream """
+  if fmt == 'csv':
+    for row in csv.DictReader(stream):
+      yield normalize_row(row)
+  else:
+    for line in stream:
+      line = line.strip()
+      if line:
+        yield normalize_row(json.loads(line))
+
+
+def normalize_row(row):
+  """ Drops empty values and nests 'address.<field>' columns under 'address' """
+  normalized = {}
+  for key, value in row.items():
+    if value is None or value == '' or key is None:
+      continue
+    if key.startswith('address.'):
+      normalized.setdefault('address', {})[key[len('address.'):]] = value
+    else:
+      normalized[key] = value
+  return normalized
+
+
+def parse_causes(value):
+  """ Accepts '1,2', [1, 2] and [{'id': 1}, {'id': 2}] """
+  if not value:
+    return []
+  if isinstance(value, str):
+    value = [v for v in value.replace(';', ',').split(',') if v.strip()]
+  return [int(v['id'] if isinstance(v, dict) else v) for v in value]
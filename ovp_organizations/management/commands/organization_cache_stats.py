@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from ovp_organizations import cache
+
+class Command(BaseCommand):
+  help = "Report hit and miss statistics of the organization retrieve cache"
+
+  def add_arguments(self, parser):
+    parser.add_argument('--reset', action='store_true', help='Reset the statistics after reporting them')
+
+  def handle(self, *args, **options):
+    stats = cache.get_stats()
+    self.stdout.write("Hits: {hits}, misses: {misses}, invalidations: {invalidations}, hit ratio: {ratio:.2%}".format(**stats))
+
+    if options['reset']:
+      cache.reset_stats()
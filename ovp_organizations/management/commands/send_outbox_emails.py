@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.core.management.base import BaseCommand
+from ovp_organizations import outbox
+
+class Command(BaseCommand):
+  help = "Deliver emails queued in the organization email outbox"
+
+  def add_arguments(self, parser):
+    parser.add_argument('--batch-size', type=int, default=100, help='Emails claimed and sent per connection')
+    parser.add_argument('--max-attempts', type=int, default=5, help='Attempts before an email is marked as failed')
+    parser.add_argument('--loop', action='store_true', help='Keep polling the outbox instead of exiting once it is drained')
+    parser.add_argument('--interval', type=float, default=5, help='Seconds to wait between polls when --loop is set')
+
+  def handle(self, *args, **options):
+    total_sent, total_failed = 0, 0
+
+    try:
+      while True:
+        sent, failed = outbox.deliver(options['batch_size'], options['max_attempts'])
+        total_sent += sent
+        total_failed += failed
+
+        if sent or failed:
+          if options['verbosity'] > 1:
+            self.stdout.write("Batch: sent {} emails, {} failed".format(sent, failed))
+          continue
+        if not options['loop']:
+          break
+        time.sleep(options['interval'])
+    except KeyboardInterrupt: # pragma: no cover
+      pass
+
+    self.stdout.write("Sent {} emails, {} failed".format(total_sent, total_failed))
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from ovp_organizations.models import Organization
+
+class Command(BaseCommand):
+  help = "Recompute organization member, invite and project counters, repairing any drift"
+
+  def add_arguments(self, parser):
+    parser.add_argument('--batch-size', type=int, default=500, help='Organizations recomputed per batch')
+
+  def handle(self, *args, **options):
+    batch_size = options['batch_size']
+    last_id = Organization.objects.aggregate(last_id=Max('pk'))['last_id'] or 0
+
+    # Walk primary key ranges so every batch is an indexed range scan
+    updated = 0
+    for start in range(0, last_id + 1, batch_size):
+      updated += Organization.objects.filter(pk__gte=start, pk__lt=start + batch_size).update_counters()
+
+    self.stdout.write("Updated counters of {} organizations".format(updated))
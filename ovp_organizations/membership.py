@@ -0,0 +1,76 @@
+from ovp_organizations.models import Organization
+from ovp_organizations.models import OrganizationInvite
+
+
+class Membership(object):
+  """
+  Relationship of a user with an organization. Each question is answered
+  with at most one EXISTS query, on the indexed through and invite tables,
+  and only when asked.
+  """
+  def __init__(self, user, organization_id, owner_id):
+    self.user = user
+    self.organization_id = organization_id
+    self.owner_id = owner_id
+    self._is_member = None
+    self._is_invited = None
+
+  @property
+  def is_authenticated(self):
+    return self.user is not None and self.user.is_authenticated
+
+  @property
+  def is_owner(self):
+    return self.is_authenticated and self.user.pk == self.owner_id
+
+  @property
+  def is_member(self):
+    if self._is_member is None:
+      self._is_member = self.is_authenticated and Organization.members.through.objects.filter(organization_id=self.organization_id, user_id=self.user.pk).exists()
+    return self._is_member
+
+  @property
+  def is_invited(self):
+    if self._is_invited is None:
+      self._is_invited = self.is_authenticated and OrganizationInvite.objects.filter(organization_id=self.organization_id, invited_id=self.user.pk).exists()
+    return self._is_invited
+
+  @property
+  def is_owner_or_member(self):
+    return self.is_owner or self.is_member
+
+
+def get_membership(request, organization_id, owner_id):
+  """ Returns the Membership of the request user, memoized on the request
+      so permissions, views and serializers share the same answers.
+
+      Memoized answers are not refreshed if the request itself changes the
+      membership, so check permissions before making changes. """
+  user = getattr(request, 'user', None)
+
+  # DRF wraps the HttpRequest in a new Request for each view
+  request = getattr(request, '_request', request)
+  memberships = request.__dict__.setdefault('_organization_memberships', {})
+
+  key = (getattr(user, 'pk', None), organization_id)
+  if key not in memberships:
+    memberships[key] = Membership(user, organization_id, owner_id)
+  return memberships[key]
+
+
+def prefetch_memberships(request, organizations):
+  """ Resolves whether the request user is a member of each organization
+      with a single query, so later checks run no query at all """
+  memberships = [get_membership(request, organization.pk, organization.owner_id) for organization in organizations]
+  pending = [membership for membership in memberships if membership._is_member is None]
+  if not pending:
+    return
+
+  user = pending[0].user
+  if user is None or not user.is_authenticated:
+    member_of = set()
+  else:
+    member_of = set(Organization.members.through.objects.filter(user_id=user.pk, organization_id__in=[membership.organization_id for membership in pending]).values_list('organization_id', flat=True))
+
+  for membership in pending:
+    membership._is_member = membership.organization_id in member_of
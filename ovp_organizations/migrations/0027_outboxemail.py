@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 11:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ovp_organizations', '0026_organization_document'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('template_name', models.CharField(max_length=100, verbose_name='Template name')),
+                ('from_email', models.CharField(blank=True, default='', max_length=254, verbose_name='From')),
+                ('email_address', models.CharField(max_length=254, verbose_name='To')),
+                ('subject', models.CharField(max_length=255, verbose_name='Subject')),
+                ('text_content', models.TextField(verbose_name='Text content')),
+                ('html_content', models.TextField(verbose_name='HTML content')),
+                ('status', models.PositiveSmallIntegerField(choices=[(0, 'Pending'), (1, 'Sending'), (2, 'Sent'), (3, 'Failed')], default=0, verbose_name='Status')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Attempts')),
+                ('last_error', models.TextField(blank=True, default=None, null=True, verbose_name='Last error')),
+                ('next_attempt_date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Next attempt date')),
+                ('created_date', models.DateTimeField(auto_now_add=True, verbose_name='Created date')),
+                ('sent_date', models.DateTimeField(blank=True, null=True, verbose_name='Sent date')),
+            ],
+            options={
+                'verbose_name': 'outbox email',
+                'verbose_name_plural': 'outbox emails',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='outboxemail',
+            index_together=set([('status', 'next_attempt_date')]),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+INDEX_NAME = 'ovp_organizations_organization_public'
+
+# Backends which support partial indexes and the literal the ORM
+# uses for deleted=False on each of them
+PARTIAL_INDEX_PREDICATES = {
+  'postgresql': 'false',
+  'sqlite': '0',
+}
+
+
+def create_index(apps, schema_editor):
+  Organization = apps.get_model('ovp_organizations', 'Organization')
+  qn = schema_editor.quote_name
+  table = Organization._meta.db_table
+
+  sql = 'CREATE INDEX {} ON {} ({}, {})'.format(qn(INDEX_NAME), qn(table), qn('published'), qn('deleted'))
+  predicate = PARTIAL_INDEX_PREDICATES.get(schema_editor.connection.vendor, None)
+  if predicate is not None:
+    sql = '{} WHERE {} = {}'.format(sql, qn('deleted'), predicate)
+
+  schema_editor.execute(sql)
+
+
+def drop_index(apps, schema_editor):
+  Organization = apps.get_model('ovp_organizations', 'Organization')
+  qn = schema_editor.quote_name
+  schema_editor.execute(schema_editor.sql_delete_index % {'name': qn(INDEX_NAME), 'table': qn(Organization._meta.db_table)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ovp_organizations', '0027_outboxemail'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
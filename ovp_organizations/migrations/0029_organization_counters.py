@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 11:50
+from __future__ import unicode_literals
+
+from importlib import import_module
+
+from django.db import migrations, models
+from django.db.models import Count
+
+public_index = import_module('ovp_organizations.migrations.0028_organization_public_index')
+
+
+def restore_public_index(apps, schema_editor):
+    """ SQLite adds and removes columns by rebuilding the table, which drops the
+        index created by 0028 """
+    if schema_editor.connection.vendor == 'sqlite':
+        public_index.create_index(apps, schema_editor)
+
+
+def populate_counters(apps, schema_editor):
+    Organization = apps.get_model('ovp_organizations', 'Organization')
+    OrganizationInvite = apps.get_model('ovp_organizations', 'OrganizationInvite')
+    Project = apps.get_model('ovp_projects', 'Project')
+
+    counters = {
+        'members_count': Organization.members.through.objects.all(),
+        'invites_count': OrganizationInvite.objects.all(),
+        'projects_count': Project.objects.filter(published=True, deleted=False),
+    }
+    for field, queryset in counters.items():
+        counts = queryset.order_by().values('organization_id').annotate(count=Count('pk')).values_list('organization_id', 'count')
+        for organization_id, count in counts:
+            Organization.objects.filter(pk=organization_id).update(**{field: count})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ovp_organizations', '0028_organization_public_index'),
+        ('ovp_projects', '0036_merge_20170323_1944'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, restore_public_index),
+        migrations.AddField(
+            model_name='organization',
+            name='invites_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Invites count'),
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='members_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Members count'),
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='projects_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Published projects count'),
+        ),
+        migrations.RunPython(restore_public_index, migrations.RunPython.noop),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
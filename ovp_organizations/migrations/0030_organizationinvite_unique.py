@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 11:52
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min
+import django.db.models.deletion
+
+
+def delete_duplicate_invites(apps, schema_editor):
+    """ Keeps the oldest invite of each (organization, invited) pair """
+    OrganizationInvite = apps.get_model('ovp_organizations', 'OrganizationInvite')
+    Organization = apps.get_model('ovp_organizations', 'Organization')
+
+    duplicates = OrganizationInvite.objects.order_by().values('organization_id', 'invited_id').annotate(first=Min('pk'), count=Count('pk')).filter(count__gt=1)
+    organizations = set()
+    for duplicate in duplicates:
+        OrganizationInvite.objects.filter(organization_id=duplicate['organization_id'], invited_id=duplicate['invited_id']).exclude(pk=duplicate['first']).delete()
+        organizations.add(duplicate['organization_id'])
+
+    # Historical models don't fire the counter signals
+    for organization_id in organizations:
+        count = OrganizationInvite.objects.filter(organization_id=organization_id).count()
+        Organization.objects.filter(pk=organization_id).update(invites_count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('ovp_organizations', '0029_organization_counters'),
+    ]
+
+    # The composite indexes are created before the foreign key indexes
+    # they replace are dropped
+    operations = [
+        migrations.RunPython(delete_duplicate_invites, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='organizationinvite',
+            unique_together=set([('organization', 'invited')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='organizationinvite',
+            index_together=set([('invited', 'organization')]),
+        ),
+        migrations.AlterField(
+            model_name='organizationinvite',
+            name='invited',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='been_invited', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='organizationinvite',
+            name='organization',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='ovp_organizations.Organization'),
+        ),
+    ]
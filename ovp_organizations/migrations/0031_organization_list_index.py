@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+INDEX_NAME = 'ovp_organizations_organization_list'
+
+# Backends which support partial indexes and the predicate the ORM
+# generates for published=True, deleted=False on each of them
+PARTIAL_INDEX_PREDICATES = {
+  'postgresql': '{published} = true AND {deleted} = false',
+  'sqlite': '{published} = 1 AND {deleted} = 0',
+}
+
+
+def create_index(apps, schema_editor):
+  Organization = apps.get_model('ovp_organizations', 'Organization')
+  qn = schema_editor.quote_name
+  table = Organization._meta.db_table
+
+  # Serves the keyset pagination of the organization list, newest first
+  sql = 'CREATE INDEX {} ON {} ({}, {})'.format(qn(INDEX_NAME), qn(table), qn('created_date'), qn('id'))
+  predicate = PARTIAL_INDEX_PREDICATES.get(schema_editor.connection.vendor, None)
+  if predicate is not None:
+    sql = '{} WHERE {}'.format(sql, predicate.format(published=qn('published'), deleted=qn('deleted')))
+
+  schema_editor.execute(sql)
+
+
+def drop_index(apps, schema_editor):
+  Organization = apps.get_model('ovp_organizations', 'Organization')
+  qn = schema_editor.quote_name
+  schema_editor.execute(schema_editor.sql_delete_index % {'name': qn(INDEX_NAME), 'table': qn(Organization._meta.db_table)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ovp_organizations', '0030_organizationinvite_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.migrations.recorder import MigrationRecorder
+
+# This index lives on the ovp_projects project table but is owned by this
+# migration. Django 1.10 can't declare indexes in migration state, let alone
+# on another app's model, so ovp_projects migrations don't know about it and
+# a SQLite table rebuild (eg: AddField) drops it. OrganizationsConfig
+# recreates it after every migrate through ensure_index. Dropping or renaming
+# Project.organization, published, created_date or id in ovp_projects must
+# come with a migration here
+INDEX_NAME = 'ovp_organizations_project_organization'
+COLUMNS = ('organization_id', 'published', 'created_date', 'id')
+MIGRATION = ('ovp_organizations', '0032_project_organization_index')
+
+
+def index_exists(connection, table):
+  with connection.cursor() as cursor:
+    if table not in connection.introspection.table_names(cursor):
+      return False
+    return INDEX_NAME in connection.introspection.get_constraints(cursor, table)
+
+
+def create_index(apps, schema_editor):
+  # Serves the organization projects route, which lists the published
+  # projects of an organization newest first
+  Project = apps.get_model('ovp_projects', 'Project')
+  qn = schema_editor.quote_name
+  table = Project._meta.db_table
+  if index_exists(schema_editor.connection, table):
+    return
+  columns = ', '.join(qn(column) for column in COLUMNS)
+  schema_editor.execute('CREATE INDEX {} ON {} ({})'.format(qn(INDEX_NAME), qn(table), columns))
+
+
+def drop_index(apps, schema_editor):
+  Project = apps.get_model('ovp_projects', 'Project')
+  qn = schema_editor.quote_name
+  table = Project._meta.db_table
+  if not index_exists(schema_editor.connection, table):
+    return
+  schema_editor.execute(schema_editor.sql_delete_index % {'name': qn(INDEX_NAME), 'table': qn(table)})
+
+
+def ensure_index(apps, connection):
+  """ Recreates the index if this migration is applied but the index is
+      gone, eg: after ovp_projects rebuilt its table """
+  recorder = MigrationRecorder(connection)
+  if MIGRATION not in recorder.applied_migrations():
+    return
+  with connection.schema_editor() as schema_editor:
+    create_index(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ovp_organizations', '0031_organization_list_index'),
+        ('ovp_projects', '0036_merge_20170323_1944'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,57 @@
+class ChangeTrackingMixin(object):
+  """
+  Tracks changes to concrete model fields so that saving an existing
+  instance only writes the columns that changed. Saving an instance
+  without changes does nothing, not even bumping auto_now fields.
+  """
+  def __init__(self, *args, **kwargs):
+    super(ChangeTrackingMixin, self).__init__(*args, **kwargs)
+    self._loaded_values = {}
+    self._snapshot_fields()
+
+  def _snapshot_fields(self, fields=None):
+    """ Records current values as the persisted state. Deferred fields are left out """
+    for field in self._meta.concrete_fields:
+      if fields is not None and field.attname not in fields and field.name not in fields:
+        continue
+      if field.attname in self.__dict__:
+        self._loaded_values[field.attname] = self.__dict__[field.attname]
+
+  def get_original_value(self, field_name):
+    """ Returns the value field_name had when the instance was loaded or last saved """
+    field = self._meta.get_field(field_name)
+    return self._loaded_values.get(field.attname, field.get_default())
+
+  def has_changed(self, field_name):
+    return field_name in self.get_dirty_fields()
+
+  def has_unsaved_changes(self):
+    """ Returns False for persisted instances without changes """
+    return self.pk is None or self._state.adding or bool(self.get_dirty_fields())
+
+  def get_dirty_fields(self):
+    """ Returns the names of concrete fields changed since the instance was loaded or last saved """
+    dirty = []
+    for field in self._meta.concrete_fields:
+      if field.primary_key or field.attname not in self.__dict__:
+        continue
+      if field.attname not in self._loaded_values or self._loaded_values[field.attname] != self.__dict__[field.attname]:
+        dirty.append(field.name)
+    return dirty
+
+  def refresh_from_db(self, using=None, fields=None):
+    super(ChangeTrackingMixin, self).refresh_from_db(using=using, fields=fields)
+    self._snapshot_fields(fields)
+
+  def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+    if self.pk is not None and not self._state.adding and not force_insert and update_fields is None:
+      update_fields = self.get_dirty_fields()
+      if not update_fields:
+        return
+
+      update_fields += [field.name for field in self._meta.concrete_fields if getattr(field, 'auto_now', False) and field.name not in update_fields]
+
+    super(ChangeTrackingMixin, self).save(force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+
+    # Fields left out of update_fields were not written and stay dirty
+    self._snapshot_fields(update_fields)
@@ -1,10 +1,21 @@
+from collections import OrderedDict
+
+from django.apps import apps
 from django.db import models
+from django.db import transaction
+from django.db import IntegrityError
+from django.db.models import Case, Count, F, Q, Value, When
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.template.defaultfilters import slugify
 from ovp_core.helpers import get_address_model
 
+from ovp_organizations import cache
+from ovp_organizations import outbox
 from ovp_organizations.emails import OrganizationMail
 from ovp_organizations.emails import OrganizationAdminMail
+from ovp_organizations.mixins import ChangeTrackingMixin
 
 from django.utils.translation import ugettext_lazy as _
 
@@ -15,7 +26,174 @@ ORGANIZATION_TYPES = (
   (3, _('Group of volunteers')),
 )
 
-class Organization(models.Model):
+# How many times Organization.save() retries an insert whose slug was
+# taken by a concurrent create between allocation and INSERT
+SLUG_ALLOCATION_ATTEMPTS = 5
+
+# Slug bases looked up per query by OrganizationQuerySet.allocate_slugs()
+SLUG_QUERY_BATCH = 200
+
+# Organizations a single bulk publish request may change
+BULK_PUBLISH_LIMIT = 500
+
+# Organizations updated per statement by OrganizationQuerySet.unpublish(),
+# keeps pk lists under sqlite's 999 parameters limit
+UNPUBLISH_BATCH = 500
+
+BULK_INVITE_LIMIT = 500
+
+BULK_MEMBERS_LIMIT = 500
+
+BULK_RETRIEVE_LIMIT = 200
+
+COUNTER_FIELDS = ('members_count', 'invites_count', 'projects_count')
+
+# Organizations updated per statement by OrganizationQuerySet.update_counters(),
+# keeps the CASE expressions under sqlite's 999 parameters limit
+COUNTER_UPDATE_BATCH = 100
+
+def count_by_organization(queryset):
+  """ Returns a {organization_id: count} dict for rows of queryset """
+  return dict(queryset.order_by().values('organization_id').annotate(count=Count('pk')).values_list('organization_id', 'count'))
+
+
+def next_free_slug(base, taken):
+  """ Returns the first free slug among base, base-1, base-2, ...
+
+      taken is an iterable of slugs already in use that share the base prefix.
+      Slugs that only look like the base (eg. 'base-abc') are ignored. """
+  used = set()
+  prefix = base + '-'
+  for slug in taken:
+    if slug == base:
+      used.add(0)
+    elif slug.startswith(prefix):
+      suffix = slug[len(prefix):]
+      if suffix.isdigit() and not suffix.startswith('0'):
+        used.add(int(suffix))
+
+  i = 0
+  while i in used:
+    i += 1
+  return base if i == 0 else '{}-{}'.format(base, i)
+
+class OrganizationQuerySet(models.QuerySet):
+  def allocate_slugs(self, names):
+    """ Allocates a unique slug for each name with one query per SLUG_QUERY_BATCH
+        distinct bases. Names sharing a base get consecutive free suffixes.
+        Returns a list aligned with names, with None for empty names. """
+    bases = [slugify(name)[0:99] if name else None for name in names]
+    distinct = list(OrderedDict.fromkeys(base for base in bases if base))
+    taken = {}
+
+    for i in range(0, len(distinct), SLUG_QUERY_BATCH):
+      query = Q()
+      for base in distinct[i:i + SLUG_QUERY_BATCH]:
+        taken[base] = set()
+        query |= Q(slug=base) | Q(slug__startswith=base + '-')
+
+      for slug in self.model._default_manager.filter(query).values_list('slug', flat=True):
+        # A slug only matters to its own base or to the base before a numeric suffix
+        head, _, tail = slug.rpartition('-')
+        for base in (slug, head if tail.isdigit() else None):
+          if base in taken:
+            taken[base].add(slug)
+
+    slugs = []
+    for base in bases:
+      slug = None
+      if base:
+        slug = next_free_slug(base, taken[base])
+        taken[base].add(slug)
+      slugs.append(slug)
+    return slugs
+
+  def alive(self):
+    """ Organizations which have not been deleted """
+    return self.filter(deleted=False)
+
+  def public(self):
+    """ Organizations anyone can see: published and not deleted """
+    return self.filter(published=True, deleted=False)
+
+  def soft_delete(self):
+    """ Deletes every organization in the queryset with a single UPDATE,
+        the same way Organization.delete() does for a single instance.
+        Returns the number of organizations deleted. """
+    now = timezone.now()
+    return self.filter(deleted=False).update(deleted=True, published=False, deleted_date=now, modified_date=now)
+
+  def update_counters(self, counters=COUNTER_FIELDS):
+    """ Recomputes counters for the organizations in the queryset with one
+        aggregate query per counter, then writes only the counters that
+        drifted with one UPDATE per COUNTER_UPDATE_BATCH organizations.
+        Returns the number of organizations updated. """
+    current = {values[0]: values[1:] for values in self.values_list('pk', *counters)}
+    if not current:
+      return 0
+
+    ids = list(current)
+    counts = {}
+    if 'members_count' in counters:
+      counts['members_count'] = count_by_organization(self.model.members.through.objects.filter(organization_id__in=ids))
+    if 'invites_count' in counters:
+      counts['invites_count'] = count_by_organization(OrganizationInvite.objects.filter(organization_id__in=ids))
+    if 'projects_count' in counters:
+      Project = apps.get_model('ovp_projects', 'Project')
+      counts['projects_count'] = count_by_organization(Project.objects.filter(organization_id__in=ids, published=True, deleted=False))
+
+    drifted = {}
+    for pk in ids:
+      values = tuple(counts[counter].get(pk, 0) for counter in counters)
+      if values != current[pk]:
+        drifted[pk] = values
+
+    drifted = list(drifted.items())
+    for i in range(0, len(drifted), COUNTER_UPDATE_BATCH):
+      batch = drifted[i:i + COUNTER_UPDATE_BATCH]
+      updates = {}
+      for position, counter in enumerate(counters):
+        whens = [When(pk=pk, then=Value(values[position])) for pk, values in batch]
+        updates[counter] = Case(*whens, default=F(counter), output_field=models.PositiveIntegerField())
+      self.model._default_manager.filter(pk__in=[pk for pk, values in batch]).update(modified_date=timezone.now(), **updates)
+
+    return len(drifted)
+
+  def publish(self, notify=True):
+    """ Publishes unpublished organizations with a conditional UPDATE.
+
+        Only rows flipped by this call get this call's published_date, which
+        is how they are told apart from rows published concurrently by someone
+        else. Returns the list of organizations that changed and, if notify is
+        True, sends them the published email as a single batch. """
+    with transaction.atomic():
+      stamp = timezone.now()
+      self.filter(published=False, deleted=False).update(published=True, published_date=stamp, modified_date=stamp)
+      changed = list(self.model.objects.filter(published=True, published_date=stamp).select_related('owner'))
+
+      if notify:
+        with outbox.batch():
+          for organization in changed:
+            organization.mailing().sendOrganizationPublished()
+
+    return changed
+
+  def unpublish(self):
+    """ Unpublishes published organizations, locking them first so the rows
+        updated are exactly the ones selected. Returns the list of
+        organizations that changed. """
+    with transaction.atomic():
+      ids = list(self.filter(published=True).select_for_update().values_list('pk', flat=True))
+      stamp = timezone.now()
+      changed = []
+      for i in range(0, len(ids), UNPUBLISH_BATCH):
+        batch = self.model.objects.filter(pk__in=ids[i:i + UNPUBLISH_BATCH])
+        batch.update(published=False, modified_date=stamp)
+        changed.extend(batch.all())
+    return changed
+
+
+class Organization(ChangeTrackingMixin, models.Model):
   # Relationships
   owner = models.ForeignKey('ovp_users.User', verbose_name=_('owner'))
   address = models.OneToOneField(get_address_model(), blank=True, null=True, verbose_name=_('address'), db_constraint=False)
@@ -50,10 +228,12 @@ class Organization(models.Model):
   created_date = models.DateTimeField(_('Created date'), auto_now_add=True)
   modified_date = models.DateTimeField(_('Modified date'), auto_now=True)
 
-  def __init__(self, *args, **kwargs):
-    super(Organization, self).__init__(*args, **kwargs)
-    self.__orig_deleted = self.deleted
-    self.__orig_published = self.published
+  # Counters, kept in sync by signals and repaired by update_organization_counters
+  members_count = models.PositiveIntegerField(_('Members count'), default=0)
+  invites_count = models.PositiveIntegerField(_('Invites count'), default=0)
+  projects_count = models.PositiveIntegerField(_('Published projects count'), default=0)
+
+  objects = OrganizationQuerySet.as_manager()
 
   def __str__(self):
     return self.name
@@ -63,6 +243,52 @@ class Organization(models.Model):
     self.published = False
     self.save()
 
+  def invite_users(self, invitator, users):
+    """ Invites users with a single INSERT, skipping users who are already
+        invited. Returns the created invites.
+
+        bulk_create does not send post_save, so invites_count is updated
+        here. If a concurrent request invites one of the users first, the
+        unique index makes us fall back to one savepoint per invite. """
+    users = list(users)
+    invited = set(OrganizationInvite.objects.filter(organization=self, invited__in=users).values_list('invited_id', flat=True))
+    invites = [OrganizationInvite(organization=self, invitator=invitator, invited=user) for user in users if user.pk not in invited]
+    if not invites:
+      return []
+
+    try:
+      with transaction.atomic():
+        OrganizationInvite.objects.bulk_create(invites)
+        Organization.objects.filter(pk=self.pk).update(invites_count=F('invites_count') + len(invites))
+    except IntegrityError:
+      created = []
+      for invite in invites:
+        try:
+          with transaction.atomic():
+            invite.save()
+          created.append(invite)
+        except IntegrityError:
+          pass
+      invites = created
+
+    return invites
+
+  def update_members(self, add=(), remove=()):
+    """ Adds and removes members with at most one through table INSERT and
+        one DELETE, so m2m_changed fires once per direction. Returns the
+        (added, removed) lists of users which actually changed """
+    add = list(OrderedDict((user.pk, user) for user in add).values())
+    remove = list(OrderedDict((user.pk, user) for user in remove).values())
+    current = set(self.members.through.objects.filter(organization=self, user__in=add + remove).values_list('user_id', flat=True))
+
+    added = [user for user in add if user.pk not in current]
+    removed = [user for user in remove if user.pk in current]
+    if added:
+      self.members.add(*added)
+    if removed:
+      self.members.remove(*removed)
+    return added, removed
+
   def mailing(self):
     return OrganizationMail(self)
 
@@ -70,12 +296,20 @@ class Organization(models.Model):
     return OrganizationAdminMail(self)
 
   def save(self, *args, **kwargs):
+    if not args and not kwargs and not self.has_unsaved_changes():
+      return
+
+    # Outbox emails are written in the same transaction as the organization
+    with transaction.atomic():
+      return self._save(*args, **kwargs)
+
+  def _save(self, *args, **kwargs):
     if self.pk is not None:
-      if not self.__orig_published and self.published:
+      if self.published and not self.get_original_value('published'):
         self.published_date = timezone.now()
         self.mailing().sendOrganizationPublished()
 
-      if not self.__orig_deleted and self.deleted:
+      if self.deleted and not self.get_original_value('deleted'):
         self.deleted_date = timezone.now()
     else:
       # Organization being created
@@ -93,20 +327,29 @@ class Organization(models.Model):
       else:
         self.description = self.details
 
-    return super(Organization, self).save(*args, **kwargs)
+    if self.pk is not None:
+      return super(Organization, self).save(*args, **kwargs)
+    return self._insert_with_unique_slug(*args, **kwargs)
+
+  def _insert_with_unique_slug(self, *args, **kwargs):
+    """ Inserts the organization, allocating a new slug if a concurrent
+        create took ours between generate_slug() and the INSERT """
+    attempt = 1
+    while True:
+      try:
+        with transaction.atomic():
+          return super(Organization, self).save(*args, **kwargs)
+      except IntegrityError:
+        if attempt >= SLUG_ALLOCATION_ATTEMPTS or self.slug is None or not Organization.objects.filter(slug=self.slug).exists():
+          raise
+        attempt += 1
+        self.pk = None
+        self.slug = self.generate_slug()
 
   def generate_slug(self):
+    """ Fetches every slug and slug-N for the base slug in one query and picks the first free one """
     if self.name:
-      slug = slugify(self.name)[0:99]
-      append = ''
-      i = 0
-
-      query = Organization.objects.filter(slug=slug + append)
-      while query.count() > 0:
-        i += 1
-        append = '-' + str(i)
-        query = Organization.objects.filter(slug=slug + append)
-      return slug + append
+      return Organization.objects.allocate_slugs([self.name])[0]
     return None
 
   class Meta:
@@ -116,10 +359,189 @@ class Organization(models.Model):
 
 
 class OrganizationInvite(models.Model):
-  organization = models.ForeignKey("ovp_organizations.Organization")
+  # Lookups by organization and by invited are served by the composite
+  # indexes below, so the single column foreign key indexes are dropped
+  organization = models.ForeignKey("ovp_organizations.Organization", db_index=False)
   invitator = models.ForeignKey("ovp_users.User", related_name="has_invited")
-  invited = models.ForeignKey("ovp_users.User", related_name="been_invited")
+  invited = models.ForeignKey("ovp_users.User", related_name="been_invited", db_index=False)
 
   class Meta:
     app_label = 'ovp_organizations'
     verbose_name = _('organization_invite')
+    unique_together = [('organization', 'invited')]
+    index_together = [('invited', 'organization')]
+
+
+class OutboxEmail(models.Model):
+  """
+  Rendered email waiting to be delivered by the send_outbox_emails command
+  """
+  PENDING = 0
+  SENDING = 1
+  SENT = 2
+  FAILED = 3
+  STATUSES = (
+    (PENDING, _('Pending')),
+    (SENDING, _('Sending')),
+    (SENT, _('Sent')),
+    (FAILED, _('Failed')),
+  )
+
+  template_name = models.CharField(_('Template name'), max_length=100)
+  from_email = models.CharField(_('From'), max_length=254, blank=True, default='')
+  email_address = models.CharField(_('To'), max_length=254)
+  subject = models.CharField(_('Subject'), max_length=255)
+  text_content = models.TextField(_('Text content'))
+  html_content = models.TextField(_('HTML content'))
+
+  status = models.PositiveSmallIntegerField(_('Status'), choices=STATUSES, default=PENDING)
+  attempts = models.PositiveSmallIntegerField(_('Attempts'), default=0)
+  last_error = models.TextField(_('Last error'), blank=True, null=True, default=None)
+  next_attempt_date = models.DateTimeField(_('Next attempt date'), default=timezone.now)
+  created_date = models.DateTimeField(_('Created date'), auto_now_add=True)
+  sent_date = models.DateTimeField(_('Sent date'), blank=True, null=True)
+
+  def __str__(self):
+    return '{} to {}'.format(self.template_name, self.email_address)
+
+  class Meta:
+    app_label = 'ovp_organizations'
+    verbose_name = _('outbox email')
+    verbose_name_plural = _('outbox emails')
+    index_together = [('status', 'next_attempt_date')]
+
+
+#
+# Counters
+#
+# Counters are part of the organization representation, so changing them
+# also bumps modified_date, which conditional requests rely on
+#
+
+@receiver(m2m_changed, sender=Organization.members.through)
+def update_members_count(sender, instance, action, reverse, pk_set, **kwargs):
+  if action == 'pre_clear' and reverse:
+    # Remember which organizations the user belonged to before the rows are gone
+    instance._cleared_organization_ids = list(sender.objects.filter(user_id=instance.pk).values_list('organization_id', flat=True))
+  elif action == 'post_add' and pk_set:
+    # pk_set only holds rows which were actually inserted
+    if reverse:
+      Organization.objects.filter(pk__in=pk_set).update(members_count=F('members_count') + 1, modified_date=timezone.now())
+    else:
+      Organization.objects.filter(pk=instance.pk).update(members_count=F('members_count') + len(pk_set), modified_date=timezone.now())
+  elif action in ('post_remove', 'post_clear'):
+    if not reverse:
+      ids = [instance.pk]
+    elif action == 'post_remove':
+      ids = pk_set
+    else:
+      ids = instance.__dict__.pop('_cleared_organization_ids', [])
+    Organization.objects.filter(pk__in=ids).update_counters(counters=('members_count',))
+
+
+@receiver(post_save, sender=OrganizationInvite)
+def increment_invites_count(sender, instance, created, raw=False, **kwargs):
+  if created and not raw:
+    Organization.objects.filter(pk=instance.organization_id).update(invites_count=F('invites_count') + 1)
+
+
+@receiver(post_delete, sender=OrganizationInvite)
+def decrement_invites_count(sender, instance, **kwargs):
+  Organization.objects.filter(pk=instance.organization_id, invites_count__gt=0).update(invites_count=F('invites_count') - 1)
+
+
+@receiver(pre_save, sender='ovp_projects.Project')
+def remember_project_organization(sender, instance, raw=False, **kwargs):
+  # Remember the organization a project may be moving away from
+  if instance.pk is not None and not raw:
+    instance._previous_organization_id = sender._base_manager.filter(pk=instance.pk).values_list('organization_id', flat=True).first()
+
+
+@receiver(post_save, sender='ovp_projects.Project')
+@receiver(post_delete, sender='ovp_projects.Project')
+def update_projects_count(sender, instance, raw=False, **kwargs):
+  ids = set([instance.organization_id, instance.__dict__.pop('_previous_organization_id', None)]) - set([None])
+  if ids and not raw:
+    Organization.objects.filter(pk__in=ids).update_counters(counters=('projects_count',))
+
+
+#
+# Causes
+#
+
+@receiver(m2m_changed, sender=Organization.causes.through)
+def touch_on_causes_changed(sender, instance, action, reverse, pk_set, **kwargs):
+  """ Bumps modified_date when causes change, as saving the organization
+      is skipped if none of its own columns changed """
+  if action == 'pre_clear' and reverse:
+    instance._cleared_organization_ids = list(sender.objects.filter(cause_id=instance.pk).values_list('organization_id', flat=True))
+  elif action in ('post_add', 'post_remove', 'post_clear'):
+    if not reverse:
+      ids = [instance.pk]
+    elif action == 'post_clear':
+      ids = instance.__dict__.pop('_cleared_organization_ids', [])
+    else:
+      ids = pk_set
+    if ids and (pk_set or action == 'post_clear'):
+      Organization.objects.filter(pk__in=ids).update(modified_date=timezone.now())
+
+
+@receiver(post_save, sender='ovp_core.Cause')
+def touch_on_cause_saved(sender, instance, created, raw=False, **kwargs):
+  """ Organizations render their causes' names, renaming a cause bumps
+      their modified_date and drops their cached responses """
+  if not created and not raw:
+    ids = list(Organization.causes.through.objects.filter(cause_id=instance.pk).values_list('organization_id', flat=True))
+    if ids:
+      Organization.objects.filter(pk__in=ids).update(modified_date=timezone.now())
+      invalidate_cached(pk__in=ids)
+
+
+#
+# Retrieve cache
+#
+
+def invalidate_cached(*args, **filters):
+  """ Drops cached retrieve responses of the organizations matching filters """
+  if cache.is_enabled():
+    cache.invalidate(list(Organization.objects.filter(*args, **filters).values_list('slug', flat=True)))
+
+
+@receiver(post_save, sender=Organization)
+def invalidate_cached_organization(sender, instance, raw=False, **kwargs):
+  if not raw:
+    cache.invalidate([instance.slug])
+
+
+@receiver(m2m_changed, sender=Organization.causes.through)
+@receiver(m2m_changed, sender=Organization.members.through)
+def invalidate_cached_relations(sender, instance, action, reverse, pk_set, **kwargs):
+  if not reverse:
+    if action in ('post_add', 'post_remove', 'post_clear'):
+      cache.invalidate([instance.slug])
+  elif action == 'pre_clear':
+    # After the clear there is no way to tell which organizations were related
+    related = 'user_id' if sender is Organization.members.through else 'cause_id'
+    invalidate_cached(pk__in=sender.objects.filter(**{related: instance.pk}).values('organization_id'))
+  elif action in ('post_add', 'post_remove') and pk_set:
+    invalidate_cached(pk__in=pk_set)
+
+
+def touch_address(address_id):
+  """ Marks the organizations using an address as modified, so their
+      retrieve ETag follows the address contents, and drops their cached
+      responses """
+  Organization.objects.filter(address_id=address_id).update(modified_date=timezone.now())
+  invalidate_cached(address_id=address_id)
+
+
+@receiver(post_save, sender=get_address_model())
+def invalidate_cached_address(sender, instance, raw=False, **kwargs):
+  if not raw:
+    touch_address(instance.pk)
+
+
+@receiver(post_save, sender='ovp_uploads.UploadedImage')
+def invalidate_cached_image(sender, instance, raw=False, **kwargs):
+  if not raw:
+    invalidate_cached(Q(image_id=instance.pk) | Q(cover_id=instance.pk))
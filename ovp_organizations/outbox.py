@@ -0,0 +1,127 @@
+import threading
+
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.core.mail import EmailMultiAlternatives
+from django.core.mail import get_connection
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Q
+from django.utils import timezone
+
+from ovp_organizations.helpers import get_settings
+
+_local = threading.local()
+
+
+def is_enabled():
+  """ Emails are sent right away by default. Returns true if
+      OVP_ORGANIZATIONS['EMAIL_OUTBOX'] is set on settings.py
+  """
+  return bool(get_settings().get('EMAIL_OUTBOX', False))
+
+
+def enqueue(template_name, from_email, email_address, subject, text_content, html_content):
+  """ Writes a rendered email to the outbox. As it's a regular insert,
+      the email is discarded if the surrounding transaction rolls back """
+  from ovp_organizations.models import OutboxEmail
+  email = OutboxEmail(template_name=template_name, from_email=from_email, email_address=email_address, subject=subject, text_content=text_content, html_content=html_content)
+
+  pending = getattr(_local, 'batch', None)
+  if pending is not None:
+    pending.append(email)
+  else:
+    email.save()
+  return email
+
+
+@contextmanager
+def batch():
+  """ Collects emails enqueued inside the block and writes them
+      with a single bulk insert when the block exits """
+  from ovp_organizations.models import OutboxEmail
+
+  if getattr(_local, 'batch', None) is not None:
+    # Nested batch, the outermost one writes the emails
+    yield
+    return
+
+  _local.batch = []
+  try:
+    yield
+    OutboxEmail.objects.bulk_create(_local.batch)
+  finally:
+    _local.batch = None
+
+
+def claim(batch_size):
+  """ Locks a batch of due emails and marks them as being sent.
+
+      While an email is being sent its next_attempt_date is the end of the
+      claim lease, OVP_ORGANIZATIONS['EMAIL_OUTBOX_LEASE'] seconds. Emails
+      left sending by a worker killed mid batch are claimed again once
+      their lease expires """
+  from ovp_organizations.models import OutboxEmail
+
+  now = timezone.now()
+  with transaction.atomic():
+    emails = list(OutboxEmail.objects.select_for_update().filter(Q(status=OutboxEmail.PENDING) | Q(status=OutboxEmail.SENDING), next_attempt_date__lte=now).order_by('next_attempt_date', 'pk')[:batch_size])
+    lease = now + timedelta(seconds=get_settings().get('EMAIL_OUTBOX_LEASE', 600))
+    OutboxEmail.objects.filter(pk__in=[email.pk for email in emails]).update(status=OutboxEmail.SENDING, next_attempt_date=lease)
+  return emails
+
+
+def deliver(batch_size=100, max_attempts=5):
+  """ Delivers a batch of due emails through a single backend connection.
+      Failed emails are retried with exponential backoff until max_attempts.
+
+      Returns a (sent, failed) tuple.
+  """
+  from ovp_organizations.models import OutboxEmail
+
+  emails = claim(batch_size)
+  if not emails:
+    return 0, 0
+
+  sent = []
+  failed = 0
+  pending = list(emails)
+  try:
+    with get_connection() as connection:
+      while pending:
+        email = pending.pop(0)
+        try:
+          connection.send_messages([build_message(email, connection)])
+          sent.append(email.pk)
+        except Exception as e:
+          reschedule(email, repr(e), max_attempts)
+          failed += 1
+  except Exception as e:
+    # Opening the connection failed, nothing left in the batch went out
+    for email in pending:
+      reschedule(email, repr(e), max_attempts)
+      failed += 1
+
+  OutboxEmail.objects.filter(pk__in=sent).update(status=OutboxEmail.SENT, sent_date=timezone.now(), attempts=F('attempts') + 1)
+  return len(sent), failed
+
+
+def build_message(email, connection=None):
+  msg = EmailMultiAlternatives(email.subject, email.text_content, email.from_email, [email.email_address], connection=connection)
+  msg.attach_alternative(email.html_content, "text/html")
+  return msg
+
+
+def reschedule(email, error, max_attempts):
+  from ovp_organizations.models import OutboxEmail
+
+  email.attempts += 1
+  email.last_error = error
+  if email.attempts >= max_attempts:
+    email.status = OutboxEmail.FAILED
+  else:
+    delay = get_settings().get('EMAIL_OUTBOX_RETRY_DELAY', 60) * 2 ** (email.attempts - 1)
+    email.status = OutboxEmail.PENDING
+    email.next_attempt_date = timezone.now() + timedelta(seconds=delay)
+  email.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_date'])
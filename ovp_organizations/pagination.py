@@ -0,0 +1,119 @@
+from base64 import urlsafe_b64decode
+from base64 import urlsafe_b64encode
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from rest_framework import exceptions
+from rest_framework import pagination
+from rest_framework import response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(pagination.BasePagination):
+  """
+  Paginates newest first on (created_date, id) with an opaque cursor.
+
+  Each page is fetched with a WHERE clause on the last row seen instead of
+  an OFFSET, and no COUNT(*) is issued, so every page costs the same no
+  matter how deep it is.
+  """
+  cursor_query_param = 'cursor'
+  page_size = 20
+  page_size_query_param = 'page_size'
+  max_page_size = 100
+  invalid_cursor_message = 'Invalid cursor.'
+
+  def paginate_queryset(self, queryset, request, view=None):
+    self.request = request
+    self.base_url = request.build_absolute_uri()
+    self.page_size = self.get_page_size(request)
+
+    cursor = self.decode_cursor(request)
+    self.reverse = cursor is not None and cursor[2]
+
+    if self.reverse:
+      queryset = queryset.order_by('created_date', 'id')
+    else:
+      queryset = queryset.order_by('-created_date', '-id')
+
+    if cursor is not None:
+      created_date, pk, reverse = cursor
+      if reverse:
+        queryset = queryset.filter(Q(created_date__gt=created_date) | Q(created_date=created_date, id__gt=pk))
+      else:
+        queryset = queryset.filter(Q(created_date__lt=created_date) | Q(created_date=created_date, id__lt=pk))
+
+    # One extra row tells whether there is another page in this direction
+    results = list(queryset[:self.page_size + 1])
+    has_more = len(results) > self.page_size
+    results = results[:self.page_size]
+
+    if self.reverse:
+      results.reverse()
+      self.has_next = True
+      self.has_previous = has_more
+    else:
+      self.has_next = has_more
+      self.has_previous = cursor is not None
+
+    self.page = results
+    return results
+
+  def get_paginated_response(self, data):
+    return response.Response(OrderedDict([
+      ('next', self.get_next_link()),
+      ('previous', self.get_previous_link()),
+      ('results', data)
+    ]))
+
+  def get_page_size(self, request):
+    try:
+      page_size = int(request.query_params[self.page_size_query_param])
+    except (KeyError, ValueError):
+      return self.page_size
+    if page_size < 1:
+      return self.page_size
+    return min(page_size, self.max_page_size)
+
+  def get_next_link(self):
+    if not self.has_next or not self.page:
+      return None
+    return self.encode_cursor(self.page[-1], reverse=False)
+
+  def get_previous_link(self):
+    if not self.has_previous or not self.page:
+      return None
+    return self.encode_cursor(self.page[0], reverse=True)
+
+  def encode_cursor(self, instance, reverse):
+    created_date, pk = self.get_position(instance)
+    value = '{}|{}|{}'.format(created_date.isoformat(), pk, int(reverse))
+    cursor = urlsafe_b64encode(value.encode('ascii')).decode('ascii')
+    return replace_query_param(self.base_url, self.cursor_query_param, cursor)
+
+  def get_position(self, instance):
+    """ Returns (created_date, id) of a model instance or a values() row """
+    if isinstance(instance, dict):
+      return instance['created_date'], instance['id']
+    return instance.created_date, instance.pk
+
+  def decode_cursor(self, request):
+    """ Returns a (created_date, id, reverse) tuple or None if no cursor was given """
+    encoded = request.query_params.get(self.cursor_query_param)
+    if not encoded:
+      return None
+
+    try:
+      created_date, pk, reverse = urlsafe_b64decode(encoded.encode('ascii')).decode('ascii').split('|')
+      created_date = parse_datetime(created_date)
+      pk = int(pk)
+      reverse = bool(int(reverse))
+    except (TypeError, ValueError, UnicodeError):
+      raise exceptions.NotFound(self.invalid_cursor_message)
+
+    if created_date is None:
+      raise exceptions.NotFound(self.invalid_cursor_message)
+
+    return created_date, pk, reverse
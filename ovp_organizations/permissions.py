@@ -1,13 +1,11 @@
 from rest_framework import permissions
 from rest_framework import exceptions
-from ovp_organizations.models import Organization, OrganizationInvite
+from ovp_organizations.membership import get_membership
 
 class OwnsOrIsOrganizationMember(permissions.BasePermission):
   def has_object_permission(self, request, view, obj):
     if request.user.is_authenticated:
-      if obj.owner == request.user:
-        return True
-      if request.user in obj.members.all():
+      if get_membership(request, obj.pk, obj.owner_id).is_owner_or_member:
         return True
       raise exceptions.PermissionDenied() #403
     return False #401 #pragma: no cover
@@ -15,7 +13,7 @@ class OwnsOrIsOrganizationMember(permissions.BasePermission):
 class OwnsOrganization(permissions.BasePermission):
   def has_object_permission(self, request, view, obj):
     if request.user.is_authenticated:
-      if obj.owner == request.user:
+      if get_membership(request, obj.pk, obj.owner_id).is_owner:
         return True
       raise exceptions.PermissionDenied() #403
     return False #401 #pragma: no cover
@@ -23,7 +21,7 @@ class OwnsOrganization(permissions.BasePermission):
 class IsOrganizationMember(permissions.BasePermission):
   def has_object_permission(self, request, view, obj):
     if request.user.is_authenticated:
-      if request.user in obj.members.all():
+      if get_membership(request, obj.pk, obj.owner_id).is_member:
         return True
       raise exceptions.PermissionDenied() #403
     return False #401 #pragma: no cover
@@ -31,9 +29,7 @@ class IsOrganizationMember(permissions.BasePermission):
 class IsInvitedToOrganization(permissions.BasePermission):
   def has_object_permission(self, request, view, obj):
     if request.user.is_authenticated:
-      try:
-        OrganizationInvite.objects.get(invited=request.user, organization=obj)
+      if get_membership(request, obj.pk, obj.owner_id).is_invited:
         return True
-      except OrganizationInvite.DoesNotExist:
-        raise exceptions.PermissionDenied() #403
+      raise exceptions.PermissionDenied() #403
     return False #401 #pragma: no cover
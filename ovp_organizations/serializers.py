@@ -1,4 +1,9 @@
+from collections import OrderedDict
+from operator import attrgetter
+
 from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils.functional import cached_property
 
 from ovp_uploads.serializers import UploadedImageSerializer
 
@@ -9,12 +14,14 @@ from ovp_core.helpers import get_address_serializers
 from ovp_core.serializers.cause import CauseSerializer, CauseAssociationSerializer
 
 from ovp_organizations import models
+from ovp_organizations.addresses import save_address
 from ovp_organizations import validators
-from ovp_organizations.decorators import hide_address
+from ovp_organizations.membership import get_membership
 
 from rest_framework import serializers
 from rest_framework import permissions
 from rest_framework import fields
+from rest_framework.relations import PKOnlyObject
 from rest_framework.compat import set_many
 from rest_framework.utils import model_meta
 
@@ -23,21 +30,149 @@ from rest_framework.utils import model_meta
 address_serializers = get_address_serializers()
 
 
+""" Sparse fieldsets """
+
+class SparseFieldsMixin(object):
+  """
+  Lets clients choose fields with comma separated ?fields= or ?omit= query
+  params. Fields are dropped before serialization and the view uses
+  sparse_field_names() to drop the matching joins and columns
+  """
+  def __init__(self, *args, **kwargs):
+    super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+
+    names = self.sparse_field_names(self.context.get('request', None))
+    if names is not None:
+      for name in list(self.fields):
+        if name not in names:
+          self.fields.pop(name)
+
+  @classmethod
+  def sparse_field_names(cls, request):
+    """ Returns the field names kept for a request, or None when every field is kept """
+    params = getattr(request, 'query_params', {})
+    fields = [name for name in params.get('fields', '').split(',') if name]
+    omit = [name for name in params.get('omit', '').split(',') if name]
+    if not fields and not omit:
+      return None
+
+    names = [name for name in cls.Meta.fields if not fields or name in fields]
+    return [name for name in names if name not in omit]
+
+
+""" Field plans """
+
+class FieldPlansMixin(object):
+  """
+  Serializes each instance with a field plan picked for it, eg: per viewer,
+  instead of removing and restoring fields around every instance.
+
+  Plans are compiled once per serializer class and bound to the fields of a
+  serializer the first time it is used. Nothing is mutated afterwards, so
+  many=True lists can mix plans and shared serializers stay thread safe
+  """
+  # {plan name: fields represented as None with that plan}
+  field_plans = {}
+
+  _compiled_field_plans = {}
+
+  @classmethod
+  def compile_field_plans(cls):
+    """ Returns {plan name: ((field name, visible, direct), ...)}, None being
+        the plan showing every field. Direct fields are model fields read
+        with a plain getattr """
+    plans = FieldPlansMixin._compiled_field_plans.get(cls, None)
+    if plans is None:
+      model_fields = cls.Meta.model._meta.get_fields()
+      direct = set(field.name for field in model_fields if field.concrete or (field.many_to_many and not field.auto_created))
+
+      plans = {None: tuple((name, True, name in direct) for name in cls.Meta.fields)}
+      for plan, hidden in cls.field_plans.items():
+        plans[plan] = tuple((name, name not in hidden, name in direct) for name in cls.Meta.fields)
+
+      # Compiling twice under concurrent requests gives the same plans
+      FieldPlansMixin._compiled_field_plans[cls] = plans
+    return plans
+
+  @cached_property
+  def bound_field_plans(self):
+    """ Compiled plans bound to this serializer readable fields, as
+        (field name, field or None if hidden, attribute getter) """
+    readable = OrderedDict((field.field_name, field) for field in self._readable_fields)
+
+    def bind(name, visible, direct):
+      if not visible:
+        return (name, None, None)
+      field = readable[name]
+      if direct and field.source_attrs == [name] and type(field).get_attribute is fields.Field.get_attribute:
+        return (name, field, attrgetter(name))
+      return (name, field, field.get_attribute)
+
+    return {plan: tuple(bind(*entry) for entry in entries if entry[0] in readable) for plan, entries in self.compile_field_plans().items()}
+
+  def get_field_plan(self, instance):
+    return None
+
+  def to_representation(self, instance):
+    ret = OrderedDict()
+
+    for name, field, get_attribute in self.bound_field_plans[self.get_field_plan(instance)]:
+      if field is None:
+        ret[name] = None
+        continue
+
+      try:
+        attribute = get_attribute(instance)
+      except fields.SkipField:
+        continue
+
+      # Same as ModelSerializer, None values skip to_representation
+      check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+      ret[name] = None if check_for_none is None else field.to_representation(attribute)
+
+    return ret
+
+
+""" Causes """
+
+class BulkCauseAssociationSerializer(CauseAssociationSerializer):
+  """ Existence is checked for every cause at once by validate_causes """
+  class Meta(CauseAssociationSerializer.Meta):
+    validators = []
+
+
+def resolve_causes(value):
+  """ Returns the Cause instances for a list of {'id': ...} with one query,
+      raising a ValidationError for the items with unknown ids """
+  causes = Cause.objects.in_bulk([item['id'] for item in value])
+
+  errors = [{} if item['id'] in causes else {'id': ["Cause with 'id' {} does not exist.".format(item['id'])]} for item in value]
+  if any(errors):
+    raise serializers.ValidationError(errors)
+
+  return list(OrderedDict((item['id'], causes[item['id']]) for item in value).values())
+
+
 """ Serializers """
 
 class OrganizationCreateSerializer(serializers.ModelSerializer):
   address = address_serializers[0](required=False)
-  causes = CauseAssociationSerializer(many=True, required=False)
+  causes = BulkCauseAssociationSerializer(many=True, required=False)
 
   class Meta:
     model = models.Organization
     fields = ['id', 'slug', 'owner', 'name', 'website', 'facebook_page', 'address', 'details', 'description', 'type', 'image', 'cover', 'hidden_address', 'causes', 'contact_name', 'contact_email', 'contact_phone', 'atados_link', 'document']
 
+  def validate_causes(self, value):
+    return resolve_causes(value)
+
+  @transaction.atomic
   def create(self, validated_data):
     causes = validated_data.pop('causes', [])
     address_data = validated_data.pop('address', None)
 
-    # Address
+    # Address, committed with the organization so delete_orphaned_addresses
+    # never sees it unreferenced
     if address_data:
       address_sr = address_serializers[0](data=address_data)
       address = address_sr.create(address_data)
@@ -47,9 +182,8 @@ class OrganizationCreateSerializer(serializers.ModelSerializer):
     organization = models.Organization.objects.create(**validated_data)
 
     # Associate causes
-    for cause in causes:
-      c = Cause.objects.get(pk=cause['id'])
-      organization.causes.add(c)
+    if causes:
+      organization.causes.add(*causes)
 
     return organization
 
@@ -65,18 +199,18 @@ class OrganizationCreateSerializer(serializers.ModelSerializer):
       else:
         setattr(instance, attr, value)
 
-    # Save related resources
+    # Save related resources, updating the current address in place
     if address_data:
-      address_sr = address_serializers[0](data=address_data)
-      address = address_sr.create(address_data)
-      instance.address = address
+      instance.address = save_address(instance.address, address_data)
 
-    # Associate causes
+    # Associate causes, an empty list leaves them untouched
     if causes:
-      instance.causes.clear()
-      for cause in causes:
-        c = Cause.objects.get(pk=cause['id'])
-        instance.causes.add(c)
+      current = set(instance.causes.values_list('pk', flat=True))
+      wanted = set(cause.pk for cause in causes)
+      if current - wanted:
+        instance.causes.remove(*(current - wanted))
+      if wanted - current:
+        instance.causes.add(*[cause for cause in causes if cause.pk not in current])
 
     instance.save()
 
@@ -87,15 +221,15 @@ class UserOrganizationRetrieveSerializer(serializers.ModelSerializer):
     model = User
     fields = ['name', 'email', 'phone']
 
-class OrganizationSearchSerializer(serializers.ModelSerializer):
+class OrganizationSearchSerializer(SparseFieldsMixin, serializers.ModelSerializer):
   address = address_serializers[2]()
   image = UploadedImageSerializer()
 
   class Meta:
     model = models.Organization
-    fields = ['id', 'slug', 'owner', 'name', 'website', 'facebook_page', 'address', 'details', 'description', 'type', 'image']
+    fields = ['id', 'slug', 'owner', 'name', 'website', 'facebook_page', 'address', 'details', 'description', 'type', 'image', 'members_count', 'projects_count']
 
-class OrganizationRetrieveSerializer(serializers.ModelSerializer):
+class OrganizationRetrieveSerializer(SparseFieldsMixin, FieldPlansMixin, serializers.ModelSerializer):
   address = address_serializers[0]()
   image = UploadedImageSerializer()
   cover = UploadedImageSerializer()
@@ -104,11 +238,16 @@ class OrganizationRetrieveSerializer(serializers.ModelSerializer):
 
   class Meta:
     model = models.Organization
-    fields = ['slug', 'owner', 'name', 'website', 'facebook_page', 'address', 'details', 'description', 'type', 'image', 'cover', 'published', 'hidden_address', 'causes', 'contact_name', 'contact_phone', 'contact_email']
+    fields = ['slug', 'owner', 'name', 'website', 'facebook_page', 'address', 'details', 'description', 'type', 'image', 'cover', 'published', 'hidden_address', 'causes', 'contact_name', 'contact_phone', 'contact_email', 'members_count', 'projects_count']
 
-  @hide_address
-  def to_representation(self, instance):
-    return super(OrganizationRetrieveSerializer, self).to_representation(instance)
+  # Hidden addresses are only shown to owners and members
+  field_plans = {'hidden_address': ('address',)}
+
+  def get_field_plan(self, instance):
+    if instance.hidden_address and 'address' in self.fields:
+      if not get_membership(self.context['request'], instance.pk, instance.owner_id).is_owner_or_member:
+        return 'hidden_address'
+    return None
 
 
 class OrganizationInviteSerializer(serializers.Serializer):
@@ -117,8 +256,68 @@ class OrganizationInviteSerializer(serializers.Serializer):
   class Meta:
     fields = ['email']
 
+class OrganizationBulkInviteSerializer(serializers.Serializer):
+  # Emails are validated one by one by the view, so a single bad email
+  # is reported back instead of failing the whole request
+  emails = fields.ListField(child=fields.CharField(max_length=254))
+
+  class Meta:
+    fields = ['emails']
+
+  def validate_emails(self, value):
+    if not value:
+      raise serializers.ValidationError("This list may not be empty.")
+    if len(value) > models.BULK_INVITE_LIMIT:
+      raise serializers.ValidationError("Ensure this list has no more than {} emails.".format(models.BULK_INVITE_LIMIT))
+    return value
+
+class OrganizationMembersSerializer(serializers.Serializer):
+  # Users are given by email or id
+  add = fields.ListField(child=fields.CharField(max_length=254), default=[])
+  remove = fields.ListField(child=fields.CharField(max_length=254), default=[])
+
+  class Meta:
+    fields = ['add', 'remove']
+
+  def validate(self, data):
+    if not data['add'] and not data['remove']:
+      raise serializers.ValidationError("Either 'add' or 'remove' must be given.")
+    if len(data['add']) + len(data['remove']) > models.BULK_MEMBERS_LIMIT:
+      raise serializers.ValidationError("Ensure no more than {} users are given.".format(models.BULK_MEMBERS_LIMIT))
+    if set(data['add']) & set(data['remove']):
+      raise serializers.ValidationError("A user can't be added and removed at once.")
+    return data
+
+class OrganizationBulkRetrieveSerializer(serializers.Serializer):
+  slugs = fields.ListField(child=fields.CharField(max_length=100), default=[])
+  ids = fields.ListField(child=fields.IntegerField(), default=[])
+
+  class Meta:
+    fields = ['slugs', 'ids']
+
+  def validate(self, data):
+    if not data['slugs'] and not data['ids']:
+      raise serializers.ValidationError("Either 'slugs' or 'ids' must be given.")
+    if len(data['slugs']) + len(data['ids']) > models.BULK_RETRIEVE_LIMIT:
+      raise serializers.ValidationError("Ensure no more than {} organizations are requested.".format(models.BULK_RETRIEVE_LIMIT))
+    return data
+
 class MemberRemoveSerializer(serializers.Serializer):
   email = fields.EmailField(validators=[validators.invite_email_validator])
 
   class Meta:
     fields = ['email']
+
+class OrganizationBulkPublishSerializer(serializers.Serializer):
+  slugs = fields.ListField(child=fields.CharField(max_length=100))
+  published = fields.BooleanField(default=True)
+
+  class Meta:
+    fields = ['slugs', 'published']
+
+  def validate_slugs(self, value):
+    if not value:
+      raise serializers.ValidationError("This list may not be empty.")
+    if len(value) > models.BULK_PUBLISH_LIMIT:
+      raise serializers.ValidationError("Ensure this list has no more than {} slugs.".format(models.BULK_PUBLISH_LIMIT))
+    return value
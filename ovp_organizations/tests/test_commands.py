@@ -0,0 +1,173 @@
+import json
+import os
+import tempfile
+
+from io import StringIO
+from unittest import mock
+
+from django.core import mail
+from django.core.management import call_command
+from django.test import TestCase
+from django.test import override_settings
+from django.utils import timezone
+
+from ovp_core.helpers import is_email_enabled
+from ovp_users.models import User
+
+from ovp_organizations import outbox
+from ovp_organizations.models import Organization
+from ovp_organizations.models import OutboxEmail
+
+
+def queue_email(**kwargs):
+  data = {"template_name": "organizationCreated", "email_address": "test@email.com", "subject": "subject", "text_content": "text", "html_content": "<p>html</p>"}
+  data.update(kwargs)
+  return OutboxEmail.objects.create(**data)
+
+
+@override_settings(OVP_ORGANIZATIONS={"EMAIL_OUTBOX": True, "EMAIL_OUTBOX_RETRY_DELAY": 60})
+class TestSendOutboxEmailsCommand(TestCase):
+  def setUp(self):
+    mail.outbox = []
+
+  def test_send_outbox_emails(self):
+    """Test send_outbox_emails drains the outbox in batches"""
+    for i in range(5):
+      queue_email(email_address="test{}@email.com".format(i))
+
+    out = StringIO()
+    call_command("send_outbox_emails", batch_size=2, stdout=out)
+
+    self.assertTrue(out.getvalue().strip() == "Sent 5 emails, 0 failed")
+    self.assertTrue(len(mail.outbox) == 5)
+    self.assertTrue(mail.outbox[0].to == ["test0@email.com"])
+    self.assertTrue(mail.outbox[0].alternatives == [("<p>html</p>", "text/html")])
+    self.assertTrue(OutboxEmail.objects.filter(status=OutboxEmail.SENT, attempts=1).count() == 5)
+
+  def test_failed_emails_are_retried_with_backoff(self):
+    """Test failed deliveries are rescheduled and eventually marked as failed"""
+    email = queue_email()
+
+    with mock.patch("django.core.mail.backends.locmem.EmailBackend.send_messages", side_effect=IOError("down")):
+      self.assertTrue(outbox.deliver() == (0, 1))
+
+      email.refresh_from_db()
+      self.assertTrue(email.status == OutboxEmail.PENDING)
+      self.assertTrue(email.attempts == 1)
+      self.assertTrue("down" in email.last_error)
+      self.assertTrue(email.next_attempt_date > timezone.now() + timezone.timedelta(seconds=50))
+
+      # Not due yet
+      self.assertTrue(outbox.deliver() == (0, 0))
+
+      OutboxEmail.objects.filter(pk=email.pk).update(next_attempt_date=timezone.now())
+      self.assertTrue(outbox.deliver(max_attempts=2) == (0, 1))
+
+    email.refresh_from_db()
+    self.assertTrue(email.status == OutboxEmail.FAILED)
+    self.assertTrue(email.attempts == 2)
+    self.assertTrue(len(mail.outbox) == 0)
+
+  def test_abandoned_claims_are_reclaimed(self):
+    """Test emails left sending by a killed worker are sent once their lease expires"""
+    email = queue_email()
+    self.assertTrue([claimed.pk for claimed in outbox.claim(10)] == [email.pk])
+
+    # The worker died before sending, the lease keeps other workers away
+    self.assertTrue(outbox.deliver() == (0, 0))
+    email.refresh_from_db()
+    self.assertTrue(email.status == OutboxEmail.SENDING)
+
+    OutboxEmail.objects.filter(pk=email.pk).update(next_attempt_date=timezone.now())
+    self.assertTrue(outbox.deliver() == (1, 0))
+    self.assertTrue(OutboxEmail.objects.get(pk=email.pk).status == OutboxEmail.SENT)
+    self.assertTrue(len(mail.outbox) == 1)
+
+
+class TestImportOrganizationsCommand(TestCase):
+  def setUp(self):
+    self.owner = User.objects.create_user(email="owner@email.com", password="test_owner")
+    self.other = User.objects.create_user(email="other@email.com", password="test_owner")
+    Organization(name="Escola Municipal", owner=self.owner).save()
+    mail.outbox = []
+
+  def write(self, suffix, content):
+    f = tempfile.NamedTemporaryFile("w", suffix=suffix, delete=False, encoding="utf-8")
+    f.write(content)
+    f.close()
+    self.addCleanup(os.unlink, f.name)
+    return f.name
+
+  def test_import_csv(self):
+    """Test import_organizations imports CSV rows in chunks"""
+    path = self.write(".csv", "\n".join([
+      "name,owner,type,details,causes,address.typed_address,hidden_address",
+      "Escola Municipal,,1,{},\"1,2\",\"r. tecainda, 81, sao paulo\",true".format("a" * 120),
+      "Escola Municipal,other@email.com,0,,2,,",
+      "Another Organization,,,,,,",
+    ]))
+
+    out, err = StringIO(), StringIO()
+    call_command("import_organizations", path, owner="owner@email.com", chunk_size=2, stdout=out, stderr=err)
+
+    self.assertTrue(out.getvalue().startswith("Imported 3 organizations in"))
+    self.assertTrue(err.getvalue() == "")
+    self.assertTrue(len(mail.outbox) == 0)
+
+    first = Organization.objects.get(slug="escola-municipal-1")
+    self.assertTrue(first.owner == self.owner)
+    self.assertTrue(first.type == 1)
+    self.assertTrue(first.hidden_address)
+    self.assertTrue(first.description == "a" * 100)
+    self.assertTrue(first.address.typed_address == "r. tecainda, 81, sao paulo")
+    self.assertTrue(sorted(first.causes.values_list("pk", flat=True)) == [1, 2])
+    self.assertTrue(list(first.members.all()) == [self.owner])
+
+    second = Organization.objects.get(slug="escola-municipal-2")
+    self.assertTrue(second.owner == self.other)
+    self.assertTrue(second.address is None)
+    self.assertTrue(list(second.causes.values_list("pk", flat=True)) == [2])
+
+    self.assertTrue(Organization.objects.filter(slug="another-organization").exists())
+
+  def test_import_jsonl_skips_invalid_rows(self):
+    """Test import_organizations reports invalid JSON lines rows and imports the rest"""
+    path = self.write(".jsonl", "\n".join([
+      json.dumps({"name": "Valid", "owner": "owner@email.com", "causes": [{"id": 1}], "address": {"typed_address": "sao paulo"}}),
+      json.dumps({"name": "Unknown owner", "owner": "nobody@email.com"}),
+      json.dumps({"name": "Unknown cause", "owner": "owner@email.com", "causes": [999]}),
+      json.dumps({"owner": "owner@email.com"}),
+      json.dumps({"name": "Invalid website", "owner": "owner@email.com", "website": "not a url"}),
+    ]))
+
+    out, err = StringIO(), StringIO()
+    call_command("import_organizations", path, stdout=out, stderr=err)
+
+    self.assertTrue("Imported 1 organizations" in out.getvalue())
+    self.assertTrue("4 rows skipped" in out.getvalue())
+    self.assertTrue("Line 2: Owner 'nobody@email.com' does not exist." in err.getvalue())
+    self.assertTrue("Line 3: Cause with 'id' 999 does not exist." in err.getvalue())
+    self.assertTrue("Line 4: Row has no name." in err.getvalue())
+    self.assertTrue("Line 5: {'website'" in err.getvalue())
+
+    organization = Organization.objects.get(slug="valid")
+    self.assertTrue(organization.address.typed_address == "sao paulo")
+
+  def test_import_sends_admin_email(self):
+    """Test import_organizations sends the admin email as Organization.save() does"""
+    path = self.write(".jsonl", "\n".join(json.dumps({"name": "Valid {}".format(i), "owner": "owner@email.com"}) for i in range(2)))
+    with mock.patch("ovp_organizations.emails.OrganizationAdminMail.sendOrganizationCreated", side_effect=IOError("down")) as send:
+      call_command("import_organizations", path, emails="send", stdout=StringIO())
+
+    # A failing admin email doesn't stop the import
+    self.assertTrue(send.call_count == 2)
+    self.assertTrue(Organization.objects.filter(name__startswith="Valid").count() == 2)
+
+  def test_import_can_defer_emails(self):
+    """Test import_organizations can write created emails to the outbox"""
+    path = self.write(".jsonl", json.dumps({"name": "Valid", "owner": "owner@email.com"}))
+    call_command("import_organizations", path, emails="outbox", stdout=StringIO())
+
+    self.assertTrue(len(mail.outbox) == 0)
+    if is_email_enabled("organizationCreated"): # pragma: no cover
+      self.assertTrue(OutboxEmail.objects.filter(template_name="organizationCreated", email_address="owner@email.com").count() == 1)
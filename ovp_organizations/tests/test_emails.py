@@ -1,9 +1,25 @@
+from unittest import mock
+
+import asyncore
+import smtpd
+import threading
+
+from django.db import models
 from django.test import TestCase
+from django.test import override_settings
 from django.core import mail
+from django.core.mail import EmailMultiAlternatives
+from django.utils import translation
 
 from ovp_core.helpers import get_email_subject, is_email_enabled
 from ovp_users.models import User
 from ovp_organizations.models import Organization
+from ovp_organizations.models import OutboxEmail
+from ovp_organizations import email_templates
+from ovp_organizations.emails import OrganizationMail
+from ovp_organizations import connection_pool
+from ovp_organizations.fanout import FanoutError
+from ovp_organizations.models import OrganizationInvite
 
 class TestEmailTriggers(TestCase):
   def setUp(self):
@@ -34,3 +50,209 @@ class TestEmailTriggers(TestCase):
       self.assertTrue(mail.outbox[0].subject == get_email_subject("organizationPublished", "Your organization was published"))
     else: # pragma: no cover
       self.assertTrue(len(mail.outbox) == 0)
+
+
+@override_settings(OVP_ORGANIZATIONS={"EMAIL_OUTBOX": True})
+class TestEmailOutbox(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="test_project@project.com", password="test_project")
+    mail.outbox = []
+
+  def test_organization_creation_writes_to_outbox(self):
+    """Assert that emails are written to the outbox instead of being sent"""
+    organization = Organization(name="test organization", type=0, owner=self.user)
+    organization.save()
+
+    self.assertTrue(len(mail.outbox) == 0)
+    if is_email_enabled("organizationCreated"): # pragma: no cover
+      email = OutboxEmail.objects.get(template_name="organizationCreated")
+      self.assertTrue(email.email_address == self.user.email)
+      self.assertTrue(email.subject == get_email_subject("organizationCreated", "Your organization was created"))
+      self.assertTrue(email.status == OutboxEmail.PENDING)
+      self.assertTrue(email.text_content)
+      self.assertTrue(email.html_content)
+
+  def test_rolled_back_save_discards_outbox_emails(self):
+    """Assert that emails written by a failed save are not kept"""
+    organization = Organization(name="test organization", type=0, owner=self.user)
+
+    with mock.patch.object(models.Model, "save", side_effect=RuntimeError):
+      with self.assertRaises(RuntimeError):
+        organization.save()
+
+    self.assertTrue(OutboxEmail.objects.count() == 0)
+
+
+@override_settings(DEFAULT_SEND_EMAIL="sync")
+class TestEmailTemplateCache(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="test_project@project.com", password="test_project")
+    self.member = User.objects.create_user(email="member@project.com", password="test_project")
+    self.organization = Organization(name="test organization", type=0, owner=self.user)
+    self.organization.save()
+    email_templates.clear()
+    mail.outbox = []
+
+  def test_templates_are_compiled_once(self):
+    """Assert templates and subjects are compiled once per template and locale"""
+    with mock.patch("ovp_organizations.email_templates.get_template", wraps=email_templates.get_template) as get_template:
+      for i in range(3):
+        self.organization.mailing().sendUserJoined(context={"user": self.member, "organization": self.organization})
+
+    self.assertTrue(get_template.call_count == 4)
+    self.assertTrue(len(mail.outbox) == 6)
+    self.assertTrue(set(email_templates._emails) == set([("userJoined-toUser", "en"), ("userJoined-toOwner", "en")]))
+
+  def test_subjects_are_cached_per_locale(self):
+    """Assert subjects are translated for each receiver locale and follow settings changes"""
+    self.member.locale = "pt-br"
+    with mock.patch("ovp_organizations.email_templates.get_email_subject", side_effect=lambda name, subject: "{} ({})".format(subject, translation.get_language())):
+      self.organization.mailing().sendUserJoined(context={"user": self.member, "organization": self.organization})
+    self.assertTrue(mail.outbox[0].subject == "You have joined an organization (pt-br)")
+    self.assertTrue(mail.outbox[1].subject == "An user has joined an organization you own (en)")
+
+    with override_settings(OVP_EMAILS={"userJoined-toUser": {"subject": "Welcome"}}):
+      self.organization.mailing().sendUserJoined(context={"user": self.member, "organization": self.organization})
+    self.assertTrue(mail.outbox[2].subject == "Welcome")
+
+  def test_warm_is_best_effort(self):
+    """Assert warming skips disabled emails and templates the engines can't find"""
+    with override_settings(OVP_EMAILS={"userJoined-toUser": {"disabled": True}}):
+      email_templates.warm()
+      self.assertTrue("email/userJoined-toOwner.txt" in email_templates._templates)
+      self.assertTrue("email/userJoined-toUser.txt" not in email_templates._templates)
+
+    with override_settings(TEMPLATES=[]):
+      email_templates.warm()
+      self.assertTrue(not email_templates._templates)
+
+  def test_receivers_do_not_change_the_mailer(self):
+    """Assert sending to other users keeps the mailer receiver"""
+    mailer = OrganizationMail(self.organization, async_mail=False)
+    mailer.sendUserJoined(context={"user": self.member, "organization": self.organization})
+
+    self.assertTrue([email.to for email in mail.outbox] == [[self.member.email], [self.user.email]])
+    self.assertTrue(mailer.email_address == self.user.email)
+
+
+@override_settings(DEFAULT_SEND_EMAIL="sync", OVP_ORGANIZATIONS={"EMAIL_FANOUT_WORKERS": 4})
+class TestEmailFanout(TestCase):
+  def setUp(self):
+    self.owner = User.objects.create_user(email="owner@project.com", password="test_project")
+    self.invitator = User.objects.create_user(email="invitator@project.com", password="test_project")
+    self.invited = User.objects.create_user(email="invited@project.com", password="test_project")
+    self.organization = Organization(name="test organization", type=0, owner=self.owner)
+    self.organization.save()
+    self.invite = OrganizationInvite(organization=self.organization, invitator=self.invitator, invited=self.invited)
+    mail.outbox = []
+
+  def test_emails_are_sent_concurrently(self):
+    """Assert every email of a notification is sent at the same time"""
+    barrier = threading.Barrier(3, timeout=5)
+    send = EmailMultiAlternatives.send
+
+    def concurrent_send(message, *args, **kwargs):
+      barrier.wait()
+      return send(message, *args, **kwargs)
+
+    with mock.patch.object(EmailMultiAlternatives, "send", autospec=True, side_effect=concurrent_send):
+      results = self.organization.mailing().sendUserInvited(context={"invite": self.invite})
+
+    self.assertTrue(results == [True, True, True])
+    self.assertTrue(sorted(email.to[0] for email in mail.outbox) == ["invitator@project.com", "invited@project.com", "owner@project.com"])
+
+  def test_failures_are_collected(self):
+    """Assert a failed email does not stop the others and is reported afterwards"""
+    send = EmailMultiAlternatives.send
+
+    def failing_send(message, *args, **kwargs):
+      if message.to == ["owner@project.com"]:
+        raise ConnectionError("refused")
+      return send(message, *args, **kwargs)
+
+    with mock.patch.object(EmailMultiAlternatives, "send", autospec=True, side_effect=failing_send):
+      with self.assertRaises(FanoutError) as raised:
+        self.organization.mailing().sendUserInvited(context={"invite": self.invite})
+
+    self.assertTrue(raised.exception.results == [True, None, True])
+    self.assertTrue([i for i, error in raised.exception.errors] == [1])
+    self.assertTrue(len(mail.outbox) == 2)
+
+  @override_settings(DEFAULT_SEND_EMAIL="async")
+  def test_async_emails_are_not_fanned_out(self):
+    """Assert async emails return their threads without waiting on the fan-out pool"""
+    with mock.patch("ovp_organizations.fanout.run") as run:
+      results = self.organization.mailing().sendUserInvited(context={"invite": self.invite})
+    for thread in results:
+      thread.join()
+
+    self.assertTrue(not run.called)
+    self.assertTrue(all(isinstance(thread, threading.Thread) for thread in results))
+    self.assertTrue(len(mail.outbox) == 3)
+
+
+class LocalSMTPServer(smtpd.SMTPServer):
+  """ SMTP stand-in counting connections and received messages """
+  def __init__(self):
+    self.map = {}
+    self.connections = 0
+    self.messages = []
+    smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None, map=self.map, decode_data=False)
+    self.port = self.socket.getsockname()[1]
+
+  def handle_accepted(self, conn, addr):
+    self.connections += 1
+    smtpd.SMTPServer.handle_accepted(self, conn, addr)
+
+  def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+    self.messages.extend(rcpttos)
+
+  def start(self):
+    self.running = True
+    self.thread = threading.Thread(target=self.serve)
+    self.thread.start()
+
+  def serve(self):
+    while self.running:
+      asyncore.loop(timeout=0.01, count=1, map=self.map)
+
+  def stop(self):
+    self.running = False
+    self.thread.join()
+    asyncore.close_all(map=self.map)
+
+
+class TestEmailConnectionPool(TestCase):
+  def setUp(self):
+    self.server = LocalSMTPServer()
+    self.server.start()
+    self.addCleanup(self.server.stop)
+    self.addCleanup(connection_pool.close_pool)
+
+    self.owner = User.objects.create_user(email="owner@project.com", password="test_project")
+    self.users = [User.objects.create_user(email="user{}@project.com".format(i), password="test_project") for i in range(4)]
+    self.organization = Organization(name="test organization", type=0, owner=self.owner)
+    self.organization.save()
+
+  def send(self, pool):
+    with self.settings(EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend", EMAIL_HOST="127.0.0.1", EMAIL_PORT=self.server.port, OVP_ORGANIZATIONS={"EMAIL_CONNECTION_POOL": pool}):
+      results = OrganizationMail(self.organization, async_mail=False).sendMembersAdded(context={"users": self.users, "organization": self.organization})
+      connection_pool.close_pool()
+    return results
+
+  def test_connections_are_reused(self):
+    """Assert a batch of emails reuses pooled connections up to max_messages"""
+    self.assertTrue(self.send({"max_messages": 2}) == [True] * 5)
+    self.assertTrue(sorted(self.server.messages) == sorted([user.email for user in self.users] + ["owner@project.com"]))
+    self.assertTrue(self.server.connections == 3)
+
+  def test_without_pool(self):
+    """Assert emails open their own connection when the pool is disabled"""
+    self.send(False)
+    self.assertTrue(self.server.connections == 5)
+
+  def test_idle_connections_are_evicted(self):
+    """Assert connections idle for longer than idle_timeout are not reused"""
+    self.send({"idle_timeout": 0})
+    self.assertTrue(len(self.server.messages) == 5)
+    self.assertTrue(self.server.connections == 5)
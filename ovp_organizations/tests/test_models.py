@@ -1,7 +1,28 @@
+from importlib import import_module
+from io import StringIO
+from unittest import mock
+
+from django.apps import apps
+from django.contrib.auth.models import AnonymousUser
+from django.core import mail
+from django.core.management import call_command
+from django.db import IntegrityError
+from django.db import connection
+from django.db import transaction
+from django.test import RequestFactory
 from django.test import TestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
+from ovp_core.helpers import is_email_enabled
+from ovp_organizations.membership import get_membership
 from ovp_organizations.models import Organization
+from ovp_organizations.models import OrganizationInvite
+from ovp_organizations.models import OutboxEmail
+from ovp_organizations.models import next_free_slug
 from ovp_users.models import User
+from ovp_projects.models import Project
 
 class OrganizationModelTestCase(TestCase):
   def setUp(self):
@@ -85,3 +106,336 @@ class OrganizationModelTestCase(TestCase):
     """ Assert that slug is not generated without name """
     organization = Organization()
     self.assertTrue(organization.generate_slug() == None)
+
+
+  def test_slug_fills_first_free_suffix(self):
+    """ Assert that slug allocation ignores look-alike slugs and picks the first free suffix """
+    Organization.objects.filter(pk=self.organization.pk).update(slug="test-organization-2")
+    Organization(name="test organization abc", owner=self.user).save()
+
+    organization = Organization(name="test organization", owner=self.user)
+    organization.save()
+    self.assertTrue(organization.slug == "test-organization")
+
+    organization = Organization(name="test organization", owner=self.user)
+    organization.save()
+    self.assertTrue(organization.slug == "test-organization-1")
+
+    organization = Organization(name="test organization", owner=self.user)
+    organization.save()
+    self.assertTrue(organization.slug == "test-organization-3")
+
+  def test_slug_generation_runs_a_single_query(self):
+    """ Assert that slug generation costs one query regardless of how many slugs are taken """
+    for i in range(5):
+      Organization(name="test organization", owner=self.user).save()
+
+    organization = Organization(name="test organization", owner=self.user)
+    with self.assertNumQueries(1):
+      slug = organization.generate_slug()
+    self.assertTrue(slug == "test-organization-6")
+
+  def test_slug_is_reallocated_on_concurrent_create(self):
+    """ Assert that a slug taken between allocation and insert is replaced instead of failing """
+    stale = mock.Mock(side_effect=["test-organization", "test-organization-1"])
+    organization = Organization(name="test organization", owner=self.user)
+
+    with mock.patch.object(Organization, "generate_slug", stale):
+      organization.save()
+
+    self.assertTrue(stale.call_count == 2)
+    self.assertTrue(organization.slug == "test-organization-1")
+    self.assertTrue(Organization.objects.filter(slug="test-organization-1").count() == 1)
+
+  def test_next_free_slug(self):
+    """ Assert next_free_slug only considers numeric suffixes """
+    self.assertTrue(next_free_slug("a", []) == "a")
+    self.assertTrue(next_free_slug("a", ["a", "a-1", "a-b", "a-01"]) == "a-2")
+    self.assertTrue(next_free_slug("a", ["a-1"]) == "a")
+
+  def test_save_without_changes_is_skipped(self):
+    """ Assert that saving an unchanged organization runs no queries and keeps modified_date """
+    organization = Organization.objects.get(pk=self.organization.pk)
+    modified_date = organization.modified_date
+
+    with self.assertNumQueries(0):
+      organization.save()
+
+    organization.name = organization.name
+    with self.assertNumQueries(0):
+      organization.save()
+
+    self.assertTrue(Organization.objects.get(pk=organization.pk).modified_date == modified_date)
+
+  def test_save_only_writes_changed_columns(self):
+    """ Assert that saving an organization only updates the changed columns and modified_date """
+    organization = Organization.objects.get(pk=self.organization.pk)
+    self.assertTrue(organization.get_dirty_fields() == [])
+
+    organization.name = "changed name"
+    self.assertTrue(organization.get_dirty_fields() == ["name"])
+    self.assertTrue(organization.get_original_value("name") == "test organization")
+
+    with CaptureQueriesContext(connection) as ctx:
+      organization.save()
+    update = [q["sql"] for q in ctx.captured_queries if q["sql"].startswith("UPDATE")][0]
+    self.assertTrue('"name"' in update)
+    self.assertTrue('"modified_date"' in update)
+    self.assertTrue('"details"' not in update)
+    self.assertTrue(organization.get_dirty_fields() == [])
+
+    organization = Organization.objects.get(pk=self.organization.pk)
+    self.assertTrue(organization.name == "changed name")
+    self.assertTrue(organization.modified_date > self.organization.modified_date)
+
+  def test_explicit_update_fields_keep_other_changes(self):
+    """ Assert that fields left out of update_fields stay dirty and are written by the next save """
+    organization = Organization.objects.get(pk=self.organization.pk)
+    organization.name = "changed name"
+    organization.details = "changed details"
+
+    organization.save(update_fields=["name"])
+    self.assertTrue("details" in organization.get_dirty_fields())
+    self.assertTrue("name" not in organization.get_dirty_fields())
+
+    organization.save()
+    organization = Organization.objects.get(pk=self.organization.pk)
+    self.assertTrue(organization.name == "changed name")
+    self.assertTrue(organization.details == "changed details")
+
+    organization.deleted = True
+    organization.save(update_fields=["deleted"])
+    self.assertTrue("deleted_date" in organization.get_dirty_fields())
+    organization.save()
+    self.assertTrue(Organization.objects.get(pk=self.organization.pk).deleted_date is not None)
+
+  def test_deferred_fields_are_not_written(self):
+    """ Assert that loading a deferred field does not mark it as changed """
+    organization = Organization.objects.only("id", "name").get(pk=self.organization.pk)
+    organization.details
+    self.assertTrue(organization.get_dirty_fields() == [])
+
+    organization.details = "new details"
+    self.assertTrue(organization.get_dirty_fields() == ["details"])
+
+
+class OrganizationQuerySetTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="testemail@email.com", password="test_returned")
+
+    for i in range(3):
+      Organization(name="published {}".format(i), owner=self.user, published=True).save()
+    for i in range(2):
+      Organization(name="unpublished {}".format(i), owner=self.user).save()
+    Organization(name="deleted", owner=self.user, published=True, deleted=True).save()
+
+  def test_alive_and_public(self):
+    """ Assert alive() excludes deleted organizations and public() also excludes unpublished ones """
+    self.assertTrue(Organization.objects.count() == 6)
+    self.assertTrue(Organization.objects.alive().count() == 5)
+    self.assertTrue(Organization.objects.public().count() == 3)
+
+  def test_soft_delete(self):
+    """ Assert QuerySet.soft_delete() deletes and unpublishes organizations in a single query """
+    with self.assertNumQueries(1):
+      deleted = Organization.objects.filter(name__startswith="published").soft_delete()
+
+    self.assertTrue(deleted == 3)
+    self.assertTrue(Organization.objects.public().count() == 0)
+    for organization in Organization.objects.filter(name__startswith="published"):
+      self.assertTrue(organization.deleted)
+      self.assertTrue(organization.deleted_date)
+      self.assertFalse(organization.published)
+
+    # Already deleted organizations are not touched again
+    self.assertTrue(Organization.objects.all().soft_delete() == 2)
+
+  def test_publish(self):
+    """ Assert QuerySet.publish() only returns the organizations it actually published """
+    mail.outbox = []
+    changed = Organization.objects.filter(name__startswith="unpublished").publish()
+
+    self.assertTrue(sorted(o.name for o in changed) == ["unpublished 0", "unpublished 1"])
+    self.assertTrue(Organization.objects.public().count() == 5)
+    for organization in changed:
+      self.assertTrue(organization.published_date)
+    if is_email_enabled("organizationPublished"): # pragma: no cover
+      self.assertTrue(len(mail.outbox) == 2)
+
+    # Publishing again changes nothing, deleted organizations are never published
+    self.assertTrue(Organization.objects.all().publish() == [])
+
+  @override_settings(OVP_ORGANIZATIONS={"EMAIL_OUTBOX": True})
+  def test_publish_writes_emails_in_a_single_batch(self):
+    """ Assert published emails are written to the outbox with one insert """
+    with CaptureQueriesContext(connection) as ctx:
+      changed = Organization.objects.publish(notify=True)
+
+    inserts = [q["sql"] for q in ctx.captured_queries if q["sql"].startswith("INSERT")]
+    self.assertTrue(len(changed) == 2)
+    if is_email_enabled("organizationPublished"): # pragma: no cover
+      self.assertTrue(len(inserts) == 1)
+      self.assertTrue(OutboxEmail.objects.filter(template_name="organizationPublished").count() == 2)
+
+  def test_unpublish(self):
+    """ Assert QuerySet.unpublish() only returns the organizations it actually unpublished """
+    changed = Organization.objects.filter(name__in=["published 0", "unpublished 0"]).unpublish()
+    self.assertTrue([o.name for o in changed] == ["published 0"])
+    self.assertTrue(Organization.objects.public().count() == 2)
+
+  def test_unpublish_ignores_other_modifications(self):
+    """ Assert QuerySet.unpublish() doesn't return organizations touched at the same instant """
+    stamp = timezone.now()
+    Organization.objects.filter(name="unpublished 1").update(modified_date=stamp)
+    with mock.patch("ovp_organizations.models.timezone.now", return_value=stamp):
+      changed = Organization.objects.filter(name="published 0").unpublish()
+    self.assertTrue([o.name for o in changed] == ["published 0"])
+
+
+class ProjectIndexTestCase(TestCase):
+  def test_index_restored_after_migrate(self):
+    """ Assert migrate recreates the projects index dropped by an ovp_projects table rebuild """
+    project_index = import_module("ovp_organizations.migrations.0032_project_organization_index")
+    table = Project._meta.db_table
+    self.assertTrue(project_index.index_exists(connection, table))
+
+    with connection.schema_editor() as schema_editor:
+      project_index.drop_index(apps, schema_editor)
+    self.assertFalse(project_index.index_exists(connection, table))
+
+    call_command("migrate", verbosity=0)
+    self.assertTrue(project_index.index_exists(connection, table))
+
+
+class OrganizationCountersTestCase(TestCase):
+  def setUp(self):
+    self.owner = User.objects.create_user(email="owner@email.com", password="test_returned")
+    self.users = [User.objects.create_user(email="user{}@email.com".format(i), password="test_returned") for i in range(3)]
+
+    self.organization = Organization(name="test organization", owner=self.owner, published=True)
+    self.organization.save()
+
+  def counters(self):
+    return Organization.objects.values_list("members_count", "invites_count", "projects_count").get(pk=self.organization.pk)
+
+  def test_members_count(self):
+    """ Assert members_count follows members changes from both sides of the relation """
+    self.organization.members.add(*self.users)
+    self.organization.members.add(self.users[0])
+    self.assertTrue(self.counters()[0] == 3)
+
+    self.organization.members.remove(self.users[0], self.owner)
+    self.assertTrue(self.counters()[0] == 2)
+
+    self.users[0].organizations_member.add(self.organization)
+    self.assertTrue(self.counters()[0] == 3)
+
+    self.users[1].organizations_member.clear()
+    self.assertTrue(self.counters()[0] == 2)
+
+    self.organization.members.clear()
+    self.assertTrue(self.counters()[0] == 0)
+
+  def test_invites_count(self):
+    """ Assert invites_count follows invites being created and deleted """
+    invites = [OrganizationInvite.objects.create(organization=self.organization, invitator=self.owner, invited=user) for user in self.users]
+    self.assertTrue(self.counters()[1] == 3)
+
+    invites[0].delete()
+    self.assertTrue(self.counters()[1] == 2)
+
+  def test_projects_count(self):
+    """ Assert projects_count only counts published projects """
+    project = Project(name="project", details="details", owner=self.owner, organization=self.organization)
+    project.save()
+    self.assertTrue(self.counters()[2] == 0)
+
+    project.published = True
+    project.save()
+    Project(name="project", details="details", owner=self.owner, organization=self.organization, published=True).save()
+    self.assertTrue(self.counters()[2] == 2)
+
+    project.delete()
+    self.assertTrue(self.counters()[2] == 1)
+
+  def test_projects_count_follows_moved_projects(self):
+    """ Assert moving a project recounts both the old and the new organization """
+    other = Organization(name="other organization", owner=self.owner)
+    other.save()
+    project = Project(name="project", details="details", owner=self.owner, organization=self.organization, published=True)
+    project.save()
+    self.assertTrue(self.counters()[2] == 1)
+
+    project.organization = other
+    project.save()
+    self.assertTrue(self.counters()[2] == 0)
+    self.assertTrue(Organization.objects.get(pk=other.pk).projects_count == 1)
+
+  def test_duplicate_invite_is_rejected(self):
+    """ Assert the database rejects a second invite of the same user """
+    OrganizationInvite.objects.create(organization=self.organization, invitator=self.owner, invited=self.users[0])
+    with self.assertRaises(IntegrityError):
+      with transaction.atomic():
+        OrganizationInvite.objects.create(organization=self.organization, invitator=self.users[1], invited=self.users[0])
+    self.assertTrue(self.counters()[1] == 1)
+
+  def test_update_counters_repairs_drift(self):
+    """ Assert update_organization_counters repairs drifted counters """
+    self.organization.members.add(*self.users)
+    OrganizationInvite.objects.create(organization=self.organization, invitator=self.owner, invited=self.users[0])
+    Project(name="project", details="details", owner=self.owner, organization=self.organization, published=True).save()
+    other = Organization(name="other organization", owner=self.owner)
+    other.save()
+
+    Organization.objects.update(members_count=10, invites_count=10, projects_count=10)
+    Organization.objects.filter(pk=other.pk).update(members_count=0, invites_count=0, projects_count=0)
+
+    out = StringIO()
+    call_command("update_organization_counters", batch_size=1, stdout=out)
+
+    self.assertTrue(out.getvalue().strip() == "Updated counters of 1 organizations")
+    self.assertTrue(self.counters() == (3, 1, 1))
+
+
+class MembershipTestCase(TestCase):
+  def setUp(self):
+    self.owner = User.objects.create_user(email="owner@email.com", password="test_returned")
+    self.member = User.objects.create_user(email="member@email.com", password="test_returned")
+    self.invited = User.objects.create_user(email="invited@email.com", password="test_returned")
+
+    self.organization = Organization(name="test organization", owner=self.owner)
+    self.organization.save()
+    self.organization.members.add(self.member)
+    OrganizationInvite.objects.create(organization=self.organization, invitator=self.owner, invited=self.invited)
+
+  def membership(self, request):
+    return get_membership(request, self.organization.pk, self.organization.owner_id)
+
+  def test_membership(self):
+    """ Assert membership answers owner, member and invited questions """
+    request = RequestFactory().get("/")
+
+    request.user = self.owner
+    self.assertTrue(self.membership(request).is_owner and not self.membership(request).is_member)
+
+    request = RequestFactory().get("/")
+    request.user = self.member
+    self.assertTrue(self.membership(request).is_owner_or_member and not self.membership(request).is_invited)
+
+    request = RequestFactory().get("/")
+    request.user = self.invited
+    self.assertTrue(self.membership(request).is_invited and not self.membership(request).is_owner_or_member)
+
+    request = RequestFactory().get("/")
+    request.user = AnonymousUser()
+    with self.assertNumQueries(0):
+      self.assertTrue(not self.membership(request).is_owner_or_member and not self.membership(request).is_invited)
+
+  def test_membership_is_memoized(self):
+    """ Assert membership is resolved once per request """
+    request = RequestFactory().get("/")
+    request.user = self.member
+
+    with self.assertNumQueries(1):
+      for i in range(3):
+        self.assertTrue(self.membership(request).is_member)
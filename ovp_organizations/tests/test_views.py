@@ -1,15 +1,35 @@
 from django.test import TestCase
+from django.test import override_settings
 from django.core import mail
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db.models.signals import m2m_changed
+from django.utils import timezone
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from rest_framework.reverse import reverse
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
 from rest_framework.test import APIClient
+from rest_framework.test import APIRequestFactory
 
 from ovp_core.helpers import get_email_subject, is_email_enabled
+from ovp_core.models import Cause
+from ovp_core.models import GoogleAddress
 from ovp_users.models import User
+from ovp_organizations import cache
 from ovp_organizations.models import Organization, OrganizationInvite
+from ovp_organizations.serializers import OrganizationSearchSerializer
 from ovp_projects.models import Project
+from ovp_projects.models import Job, JobDate, Work
+from ovp_uploads.models import UploadedImage
+
+from io import StringIO
+from unittest import mock
 
 import copy
+import datetime
 
 base_organization = {"name": "test organization", "slug": "test-override-slug", "description": "test description", "details": "test details", "type": 0, "address": {"typed_address": "r. tecainda, 81, sao paulo"}, "causes": [{"id": 1}, {"id": 2}], "contact_name": "test contact name", "contact_phone": "+551112345678", "contact_email": "test@contact.com"}
 
@@ -197,6 +217,18 @@ class OrganizationInviteTestCase(TestCase):
     self.assertTrue(response.status_code == 400)
     self.assertTrue(response.data["email"] == ["This user is already invited to this organization."])
 
+  def test_already_invited_sends_no_email(self):
+    """ Test a rejected duplicate invite does not send an email or count as an invite """
+    response = self.client.post(reverse("organization-invite-user", ["test-organization"]), {"email": "valid@user.com"}, format="json")
+    self.assertTrue(response.status_code == 200)
+    mail.outbox = []
+
+    response = self.client.post(reverse("organization-invite-user", ["test-organization"]), {"email": "valid@user.com"}, format="json")
+    self.assertTrue(response.status_code == 400)
+    self.assertTrue(len(mail.outbox) == 0)
+    self.assertTrue(OrganizationInvite.objects.all().count() == 1)
+    self.assertTrue(Organization.objects.get(pk=self.organization.pk).invites_count == 1)
+
   def test_can_invite_user(self):
     """ Test it's possible to invite user """
     mail.outbox = []
@@ -449,3 +481,818 @@ class OrganizationLeaveTestCase(TestCase):
       self.assertTrue(get_email_subject("userRemoved-toUser", "You have have been removed from an organization"))
     if is_email_enabled("userRemoved-toOwner"): # pragma: no cover
       self.assertTrue(get_email_subject("userRemoved-toOwner", "You have removed an user from an organization you own"))
+
+
+class OrganizationBulkPublishTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="testemail@email.com", password="test_returned")
+    self.staff = User.objects.create_user(email="staff@email.com", password="test_returned")
+    self.staff.is_staff = True
+    self.staff.save()
+
+    for i in range(3):
+      Organization(name="organization {}".format(i), owner=self.user).save()
+    Organization.objects.filter(slug="organization-0").update(published=True)
+
+    self.client = APIClient()
+
+  def test_cant_bulk_publish_unless_staff(self):
+    """ Assert only staff can bulk publish organizations """
+    response = self.client.post(reverse("organization-bulk-publish"), {"slugs": ["organization-1"]}, format="json")
+    self.assertTrue(response.status_code == 401)
+
+    self.client.force_authenticate(self.user)
+    response = self.client.post(reverse("organization-bulk-publish"), {"slugs": ["organization-1"]}, format="json")
+    self.assertTrue(response.status_code == 403)
+
+  def test_can_bulk_publish(self):
+    """ Assert bulk publishing only reports organizations which changed """
+    self.client.force_authenticate(self.staff)
+    response = self.client.post(reverse("organization-bulk-publish"), {"slugs": ["organization-0", "organization-1", "organization-2"]}, format="json")
+
+    self.assertTrue(response.status_code == 200)
+    self.assertTrue(sorted(response.data["changed"]) == ["organization-1", "organization-2"])
+    self.assertTrue(Organization.objects.public().count() == 3)
+
+    response = self.client.post(reverse("organization-bulk-publish"), {"slugs": ["organization-0", "organization-2"], "published": False}, format="json")
+    self.assertTrue(sorted(response.data["changed"]) == ["organization-0", "organization-2"])
+    self.assertTrue(Organization.objects.public().count() == 1)
+
+  def test_cant_bulk_publish_empty_list(self):
+    """ Assert bulk publishing requires slugs """
+    self.client.force_authenticate(self.staff)
+    response = self.client.post(reverse("organization-bulk-publish"), {"slugs": []}, format="json")
+    self.assertTrue(response.status_code == 400)
+    self.assertTrue(response.data["slugs"] == ["This list may not be empty."])
+
+
+class OrganizationListTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="testemail@email.com", password="test_returned")
+
+    for i in range(7):
+      Organization(name="organization {}".format(i), owner=self.user, type=i % 2, published=True).save()
+    Organization(name="unpublished", owner=self.user).save()
+    Organization(name="deleted", owner=self.user, published=True, deleted=True).save()
+
+    # Two organizations created at the same instant must still be paginated once each
+    created_date = Organization.objects.get(slug="organization-3").created_date
+    Organization.objects.filter(slug="organization-4").update(created_date=created_date)
+
+    Organization.objects.filter(slug="organization-1").update(highlighted=True)
+    Organization.objects.get(slug="organization-2").causes.add(Cause.objects.get(pk=1), Cause.objects.get(pk=2))
+
+    self.client = APIClient()
+
+  def slugs(self, response):
+    return [organization["slug"] for organization in response.data["results"]]
+
+  def test_lists_public_organizations_newest_first(self):
+    """ Assert the list only includes published, non deleted organizations, newest first """
+    response = self.client.get(reverse("organization-list"), format="json")
+    self.assertTrue(response.status_code == 200)
+    self.assertTrue(self.slugs(response) == ["organization-{}".format(i) for i in [6, 5, 4, 3, 2, 1, 0]])
+    self.assertTrue(response.data["next"] is None)
+    self.assertTrue(response.data["previous"] is None)
+    self.assertTrue("count" not in response.data)
+
+  def test_keyset_pagination(self):
+    """ Assert next and previous links walk every organization exactly once """
+    response = self.client.get(reverse("organization-list"), {"page_size": 2}, format="json")
+    pages = [self.slugs(response)]
+    while response.data["next"]:
+      response = self.client.get(response.data["next"], format="json")
+      pages.append(self.slugs(response))
+
+    self.assertTrue(sum(pages, []) == ["organization-{}".format(i) for i in [6, 5, 4, 3, 2, 1, 0]])
+    self.assertTrue(len(pages) == 4)
+
+    previous = []
+    while response.data["previous"]:
+      response = self.client.get(response.data["previous"], format="json")
+      previous.append(self.slugs(response))
+    self.assertTrue(previous == pages[-2::-1])
+
+  def test_page_costs_constant_queries(self):
+    """ Assert a page costs the same number of queries regardless of its size """
+    for i in range(7):
+      Organization.objects.filter(slug="organization-{}".format(i)).update(image=UploadedImage.objects.create())
+
+    with CaptureQueriesContext(connection) as small:
+      self.client.get(reverse("organization-list"), {"page_size": 1}, format="json")
+    with CaptureQueriesContext(connection) as large:
+      response = self.client.get(reverse("organization-list"), {"page_size": 7}, format="json")
+
+    self.assertTrue(len(response.data["results"]) == 7)
+    self.assertTrue(len(small) == len(large) == 1)
+    self.assertTrue("OFFSET" not in large.captured_queries[0]["sql"])
+    self.assertTrue("COUNT" not in large.captured_queries[0]["sql"])
+
+  def test_filters(self):
+    """ Assert the list can be filtered by type, causes, highlighted and name """
+    response = self.client.get(reverse("organization-list"), {"type": "1"}, format="json")
+    self.assertTrue(self.slugs(response) == ["organization-5", "organization-3", "organization-1"])
+
+    response = self.client.get(reverse("organization-list"), {"causes": "1,2"}, format="json")
+    self.assertTrue(self.slugs(response) == ["organization-2"])
+
+    response = self.client.get(reverse("organization-list"), {"highlighted": "true"}, format="json")
+    self.assertTrue(self.slugs(response) == ["organization-1"])
+
+    response = self.client.get(reverse("organization-list"), {"name": "ORGANIZATION 6"}, format="json")
+    self.assertTrue(self.slugs(response) == ["organization-6"])
+
+  def test_flat_list_matches_search_serializer(self):
+    """ Assert the list renders the same bytes as OrganizationSearchSerializer """
+    address = GoogleAddress(typed_address="r. tecainda, 81, sao paulo", city_state="Sao Paulo, SP")
+    address.save_base(raw=True)
+    image = UploadedImage.objects.create(image="user-uploaded/images/organization.jpg", user=None)
+    Organization.objects.filter(slug="organization-1").update(address=address, image=image, website="http://example.com")
+
+    response = self.client.get(reverse("organization-list"), format="json")
+
+    request = APIRequestFactory().get(reverse("organization-list"))
+    organizations = Organization.objects.public().order_by("-created_date", "-id")
+    expected = OrganizationSearchSerializer(organizations, many=True, context={"request": Request(request)}).data
+    self.assertTrue(JSONRenderer().render(response.data["results"]) == JSONRenderer().render(expected))
+
+    response = self.client.get(reverse("organization-list"), {"fields": "slug,address,image", "name": "organization 1"}, format="json")
+    self.assertTrue(response.data["results"][0]["address"] == {"city_state": "Sao Paulo, SP"})
+    self.assertTrue(response.data["results"][0]["image"]["image_url"].startswith("http://testserver/"))
+    self.assertTrue(response.data["results"][0]["image"]["image_small_url"] is None)
+    self.assertTrue(list(response.data["results"][0]) == ["slug", "address", "image"])
+
+  def test_invalid_params(self):
+    """ Assert invalid filters and cursors are rejected """
+    response = self.client.get(reverse("organization-list"), {"type": "a"}, format="json")
+    self.assertTrue(response.status_code == 400)
+    self.assertTrue(response.data["type"] == ["Must be a comma separated list of integers."])
+
+    response = self.client.get(reverse("organization-list"), {"highlighted": "maybe"}, format="json")
+    self.assertTrue(response.status_code == 400)
+
+    response = self.client.get(reverse("organization-list"), {"cursor": "invalid"}, format="json")
+    self.assertTrue(response.status_code == 404)
+
+
+class OrganizationRetrieveQueriesTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="testemail@email.com", password="test_returned")
+    self.member = User.objects.create_user(email="member@email.com", password="test_returned")
+
+    # Saved raw so the geocoding signal does not run
+    address = GoogleAddress(typed_address="r. tecainda, 81, sao paulo")
+    address.save_base(raw=True)
+
+    self.organization = Organization(name="test organization", owner=self.user, published=True, address=address, image=UploadedImage.objects.create(), cover=UploadedImage.objects.create())
+    self.organization.save()
+    self.organization.causes.add(Cause.objects.get(pk=1))
+    self.organization.members.add(self.member)
+
+    self.client = APIClient()
+
+  def grow(self):
+    """ Adds more causes and members, which must not add queries """
+    self.organization.causes.add(*Cause.objects.exclude(pk=1))
+    self.organization.members.add(*[User.objects.create_user(email="user{}@email.com".format(i), password="test_returned") for i in range(5)])
+
+  def test_retrieve_queries(self):
+    """ Assert retrieving an organization costs a fixed number of queries """
+    with self.assertNumQueries(3):
+      response = self.client.get(reverse("organization-detail", ["test-organization"]), format="json")
+    self.assertTrue(response.data["owner"]["email"] == "testemail@email.com")
+    self.assertTrue(response.data["address"]["typed_address"] == "r. tecainda, 81, sao paulo")
+    self.assertTrue(response.data["image"] is not None and response.data["cover"] is not None)
+    self.assertTrue(len(response.data["causes"]) == 1)
+
+    self.grow()
+    with self.assertNumQueries(3):
+      response = self.client.get(reverse("organization-detail", ["test-organization"]), format="json")
+    self.assertTrue(len(response.data["causes"]) == Cause.objects.count())
+
+  def test_retrieve_hidden_address_queries(self):
+    """ Assert hidden addresses cost a single membership check """
+    Organization.objects.filter(pk=self.organization.pk).update(hidden_address=True)
+    self.grow()
+
+    with self.assertNumQueries(3):
+      response = self.client.get(reverse("organization-detail", ["test-organization"]), format="json")
+    self.assertTrue(response.data["address"] is None)
+
+    self.client.force_authenticate(self.member)
+    with self.assertNumQueries(4):
+      response = self.client.get(reverse("organization-detail", ["test-organization"]), format="json")
+    self.assertTrue(response.data["address"]["typed_address"] == "r. tecainda, 81, sao paulo")
+
+    self.client.force_authenticate(self.user)
+    with self.assertNumQueries(3):
+      response = self.client.get(reverse("organization-detail", ["test-organization"]), format="json")
+    self.assertTrue(response.data["address"]["typed_address"] == "r. tecainda, 81, sao paulo")
+
+
+class OrganizationConditionalGetTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="testemail@email.com", password="test_returned")
+    self.member = User.objects.create_user(email="member@email.com", password="test_returned")
+
+    self.organization = Organization(name="test organization", owner=self.user, published=True, hidden_address=True)
+    self.organization.save()
+    self.organization.members.add(self.member)
+
+    self.client = APIClient()
+
+  def get(self, name, **headers):
+    return self.client.get(reverse(name, ["test-organization"]), format="json", **headers)
+
+  def test_retrieve_not_modified(self):
+    """ Assert retrieve answers 304 to a matching ETag without serializing """
+    response = self.get("organization-detail")
+    self.assertTrue(response.status_code == 200)
+    self.assertTrue(not response.has_header("Last-Modified"))
+    self.assertTrue("private" in response["Cache-Control"])
+    etag = response["ETag"]
+
+    with self.assertNumQueries(1):
+      response = self.get("organization-detail", HTTP_IF_NONE_MATCH=etag)
+    self.assertTrue(response.status_code == 304)
+    self.assertTrue(response["ETag"] == etag)
+
+  def test_retrieve_etag_changes(self):
+    """ Assert the ETag changes with the organization, its causes and its counters """
+    etags = [self.get("organization-detail")["ETag"]]
+
+    Organization.objects.filter(pk=self.organization.pk).update(modified_date=self.organization.modified_date - datetime.timedelta(days=1))
+    etags.append(self.get("organization-detail")["ETag"])
+
+    self.organization.causes.add(Cause.objects.get(pk=1))
+    etags.append(self.get("organization-detail")["ETag"])
+
+    self.organization.members.remove(self.member)
+    etags.append(self.get("organization-detail")["ETag"])
+
+    cause = Cause.objects.get(pk=1)
+    cause.name = "renamed cause"
+    cause.save()
+    response = self.get("organization-detail")
+    etags.append(response["ETag"])
+    self.assertTrue(response.data["causes"][0]["name"] == "renamed cause")
+
+    self.assertTrue(len(set(etags)) == 5)
+    response = self.get("organization-detail", HTTP_IF_NONE_MATCH=etags[0])
+    self.assertTrue(response.status_code == 200)
+
+  def test_hidden_address_etag_depends_on_viewer(self):
+    """ Assert owners and strangers never share a hidden address representation """
+    stranger = self.get("organization-detail")
+    self.assertTrue(stranger.data["address"] is None)
+
+    self.client.force_authenticate(self.user)
+    owner = self.get("organization-detail", HTTP_IF_NONE_MATCH=stranger["ETag"])
+    self.assertTrue(owner.status_code == 200)
+    self.assertTrue(owner["ETag"] != stranger["ETag"])
+
+    self.client.force_authenticate(self.member)
+    member = self.get("organization-detail", HTTP_IF_NONE_MATCH=owner["ETag"])
+    self.assertTrue(member.status_code == 304)
+
+  def test_if_modified_since(self):
+    """ Assert If-Modified-Since is only honored when the body doesn't depend on the viewer """
+    stranger = self.get("organization-detail")
+    since = "Fri, 01 Jan 2100 00:00:00 GMT"
+
+    self.client.force_authenticate(self.member)
+    member = self.get("organization-detail", HTTP_IF_MODIFIED_SINCE=since)
+    self.assertTrue(member.status_code == 200)
+    self.assertTrue(member["ETag"] != stranger["ETag"])
+    self.assertTrue(self.get("organization-detail", HTTP_IF_NONE_MATCH=member["ETag"], HTTP_IF_MODIFIED_SINCE=since).status_code == 304)
+
+    Organization.objects.filter(pk=self.organization.pk).update(hidden_address=False)
+    response = self.get("organization-detail")
+    self.assertTrue(response.has_header("Last-Modified"))
+    self.assertTrue(self.get("organization-detail", HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]).status_code == 304)
+
+  def test_projects_not_modified(self):
+    """ Assert projects answers 304 until a project is published or changed """
+    project = Project(name="project", details="details", owner=self.user, organization=self.organization, published=True)
+    project.save()
+
+    response = self.get("organization-projects")
+    self.assertTrue(response.status_code == 200)
+    etag = response["ETag"]
+
+    response = self.get("organization-projects", HTTP_IF_NONE_MATCH=etag)
+    self.assertTrue(response.status_code == 304)
+
+    Project(name="other project", details="details", owner=self.user, organization=self.organization, published=True).save()
+    response = self.get("organization-projects", HTTP_IF_NONE_MATCH=etag)
+    self.assertTrue(response.status_code == 200)
+    self.assertTrue(response["ETag"] != etag)
+
+  def test_projects_hidden_address_etag_depends_on_viewer(self):
+    """ Assert members never get the projects ETag of a stranger when a project address is hidden """
+    address = GoogleAddress(typed_address="r. tecainda, 81, sao paulo")
+    address.save_base(raw=True)
+    Project(name="project", details="details", owner=self.user, organization=self.organization, published=True, hidden_address=True, address=address).save()
+
+    stranger = self.get("organization-projects")
+    self.assertTrue(stranger.data["results"][0]["address"] is None)
+    self.assertTrue("private" in stranger["Cache-Control"])
+
+    self.client.force_authenticate(self.member)
+    member = self.get("organization-projects", HTTP_IF_NONE_MATCH=stranger["ETag"])
+    self.assertTrue(member.status_code == 200)
+    self.assertTrue(member.data["results"][0]["address"]["typed_address"] == "r. tecainda, 81, sao paulo")
+    self.assertTrue(self.get("organization-projects", HTTP_IF_NONE_MATCH=member["ETag"]).status_code == 304)
+
+
+@override_settings(OVP_ORGANIZATIONS={"RETRIEVE_CACHE": True}, CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "ovp-organizations-tests"}})
+class OrganizationRetrieveCacheTestCase(TestCase):
+  def setUp(self):
+    caches["default"].clear()
+
+    self.user = User.objects.create_user(email="testemail@email.com", password="test_returned")
+    self.member = User.objects.create_user(email="member@email.com", password="test_returned")
+
+    address = GoogleAddress(typed_address="r. tecainda, 81, sao paulo")
+    address.save_base(raw=True)
+    self.address = address
+
+    self.organization = Organization(name="test organization", owner=self.user, published=True, hidden_address=True, address=address)
+    self.organization.save()
+    self.organization.members.add(self.member)
+
+    self.client = APIClient()
+
+  def get(self):
+    return self.client.get(reverse("organization-detail", ["test-organization"]), format="json")
+
+  def test_cached_retrieve(self):
+    """ Assert a cached retrieve skips the serializer queries and is counted as a hit """
+    cache.reset_stats()
+    first = self.get()
+
+    with self.assertNumQueries(1):
+      second = self.get()
+    self.assertTrue(first.data == second.data)
+
+    stats = cache.get_stats()
+    self.assertTrue(stats["hits"] == 1 and stats["misses"] == 1)
+
+  def test_viewer_variants(self):
+    """ Assert owners, members and strangers never share a hidden address body """
+    self.assertTrue(self.get().data["address"] is None)
+
+    self.client.force_authenticate(self.member)
+    self.assertTrue(self.get().data["address"]["typed_address"] == "r. tecainda, 81, sao paulo")
+
+    self.client.force_authenticate(self.user)
+    self.assertTrue(self.get().data["address"]["typed_address"] == "r. tecainda, 81, sao paulo")
+
+    self.client.force_authenticate(None)
+    self.assertTrue(self.get().data["address"] is None)
+
+  def test_invalidation(self):
+    """ Assert saves of the organization, its causes and its address drop the cached body """
+    self.client.force_authenticate(self.user)
+    self.get()
+
+    self.organization.causes.add(Cause.objects.get(pk=1))
+    response = self.get()
+    self.assertTrue(len(response.data["causes"]) == 1)
+
+    etag = response["ETag"]
+    self.address.typed_address2 = "apt 1"
+    with mock.patch("ovp_core.models.address.google_address.requests.get") as geocode:
+      geocode.return_value.json.return_value = {"results": []}
+      self.address.save()
+    response = self.client.get(reverse("organization-detail", ["test-organization"]), format="json", HTTP_IF_NONE_MATCH=etag)
+    self.assertTrue(response.status_code == 200)
+    self.assertTrue(response.data["address"]["typed_address2"] == "apt 1")
+
+    organization = Organization.objects.get(pk=self.organization.pk)
+    organization.name = "renamed organization"
+    organization.save()
+    self.assertTrue(self.get().data["name"] == "renamed organization")
+
+    self.assertTrue(cache.get_stats()["hits"] == 0)
+
+  def test_stats_command(self):
+    """ Assert organization_cache_stats reports and resets statistics """
+    cache.reset_stats()
+    self.get()
+    self.get()
+
+    out = StringIO()
+    call_command("organization_cache_stats", reset=True, stdout=out)
+    self.assertTrue(out.getvalue().strip() == "Hits: 1, misses: 1, invalidations: 0, hit ratio: 50.00%")
+    self.assertTrue(cache.get_stats()["misses"] == 0)
+
+
+class OrganizationProjectsCursorTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="testemail@email.com", password="test_returned")
+    self.organization = Organization(name="test organization", owner=self.user, published=True)
+    self.organization.save()
+
+    now = timezone.now()
+    for i in range(6):
+      project = Project(name="project{}".format(i), details="details", published=True, organization=self.organization, owner=self.user, hidden_address=bool(i % 2))
+      project.save()
+      project.causes.add(Cause.objects.get(pk=1))
+      if i % 2:
+        job = Job.objects.create(project=project)
+        JobDate.objects.create(job=job, start_date=now, end_date=now)
+      else:
+        Work.objects.create(project=project, weekly_hours=i, description="work")
+    Project(name="unpublished", details="details", organization=self.organization, owner=self.user).save()
+
+    self.client = APIClient()
+
+  def get(self, params):
+    return self.client.get(reverse("organization-projects", ["test-organization"]), params, format="json")
+
+  def test_cursor_pagination(self):
+    """ Assert an empty cursor starts cursor pagination and pages walk projects newest first """
+    response = self.get({"cursor": "", "page_size": 4})
+    self.assertTrue("count" not in response.data)
+    names = [project["name"] for project in response.data["results"]]
+
+    response = self.client.get(response.data["next"], format="json")
+    names += [project["name"] for project in response.data["results"]]
+    self.assertTrue(response.data["next"] is None)
+    self.assertTrue(names == ["project{}".format(i) for i in range(5, -1, -1)])
+
+  def test_cursor_pages_cost_constant_queries(self):
+    """ Assert deeper and larger pages cost the same number of queries """
+    self.client.force_authenticate(self.user)
+    with CaptureQueriesContext(connection) as first:
+      response = self.get({"cursor": "", "page_size": 1})
+    next_page = self.get({"cursor": "", "page_size": 4}).data["next"]
+    with CaptureQueriesContext(connection) as deep:
+      response = self.client.get(next_page, format="json")
+    self.assertTrue(len(response.data["results"]) == 2)
+
+    with CaptureQueriesContext(connection) as large:
+      response = self.get({"cursor": "", "page_size": 6})
+    self.assertTrue(len(response.data["results"]) == 6)
+    self.assertTrue(len(first) == len(deep) == len(large))
+    self.assertTrue(response.data["results"][0]["disponibility"]["type"] == "job")
+
+  def test_page_number_pagination_is_kept(self):
+    """ Assert projects keep page number pagination without a cursor """
+    response = self.get({})
+    self.assertTrue(response.data["count"] == 6)
+    self.assertTrue([project["name"] for project in response.data["results"]] == ["project{}".format(i) for i in range(5, -1, -1)])
+
+
+class OrganizationBulkInviteTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="testemail@email.com", password="test_returned")
+    self.users = [User.objects.create_user(email="user{}@email.com".format(i), password="test_returned") for i in range(10)]
+
+    self.organization = Organization(name="test organization", owner=self.user, published=True)
+    self.organization.save()
+    OrganizationInvite.objects.create(organization=self.organization, invitator=self.user, invited=self.users[0])
+
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+
+  def invite(self, emails):
+    return self.client.post(reverse("organization-invite-users", ["test-organization"]), {"emails": emails}, format="json")
+
+  def test_can_invite_users(self):
+    """ Assert invite_users reports the status of each email """
+    mail.outbox = []
+    response = self.invite(["user0@email.com", "user1@email.com", "user2@email.com", "user1@email.com", "invalid", "unknown@email.com"])
+    self.assertTrue(response.status_code == 200)
+    self.assertTrue(response.data["results"] == [
+      {"email": "user0@email.com", "status": "already_invited"},
+      {"email": "user1@email.com", "status": "invited"},
+      {"email": "user2@email.com", "status": "invited"},
+      {"email": "invalid", "status": "invalid"},
+      {"email": "unknown@email.com", "status": "not_found"},
+    ])
+
+    self.assertTrue(OrganizationInvite.objects.filter(organization=self.organization).count() == 3)
+    self.assertTrue(Organization.objects.get(pk=self.organization.pk).invites_count == 3)
+    if is_email_enabled("userInvited-toUser"): # pragma: no cover
+      self.assertTrue(sorted(m.to[0] for m in mail.outbox if m.subject == get_email_subject("userInvited-toUser", "You are invited to an organization")) == ["user1@email.com", "user2@email.com"])
+
+  def test_invite_users_queries(self):
+    """ Assert inviting more users does not cost more queries, apart from their emails """
+    with self.settings(OVP_ORGANIZATIONS={"EMAIL_OUTBOX": True}):
+      with CaptureQueriesContext(connection) as few:
+        self.invite(["user1@email.com", "user2@email.com"])
+      with CaptureQueriesContext(connection) as many:
+        response = self.invite(["user{}@email.com".format(i) for i in range(3, 10)])
+    self.assertTrue(len(response.data["results"]) == 7)
+    self.assertTrue(len(few) == len(many))
+
+  def test_invite_users_validation(self):
+    """ Assert invite_users requires a non empty list and organization membership """
+    response = self.invite([])
+    self.assertTrue(response.status_code == 400)
+    self.assertTrue(response.data["emails"] == ["This list may not be empty."])
+
+    self.client.force_authenticate(self.users[1])
+    response = self.invite(["user2@email.com"])
+    self.assertTrue(response.status_code == 403)
+
+
+class OrganizationUpdateMembersTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="testemail@email.com", password="test_returned")
+    self.users = [User.objects.create_user(email="user{}@email.com".format(i), password="test_returned") for i in range(6)]
+
+    self.organization = Organization(name="test organization", owner=self.user, published=True)
+    self.organization.save()
+    self.organization.members.add(self.user, self.users[0], self.users[1])
+
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+
+  def update(self, data):
+    return self.client.post(reverse("organization-update-members", ["test-organization"]), data, format="json")
+
+  def test_can_update_members(self):
+    """ Assert members can be added and removed by email or id in one request """
+    mail.outbox = []
+    response = self.update({"add": ["user2@email.com", str(self.users[3].pk), "user0@email.com", "unknown@email.com"], "remove": ["user1@email.com", str(self.users[4].pk)]})
+    self.assertTrue(response.status_code == 200)
+    self.assertTrue(response.data["added"] == ["user2@email.com", "user3@email.com"])
+    self.assertTrue(response.data["removed"] == ["user1@email.com"])
+    self.assertTrue(response.data["unchanged"] == ["user0@email.com", "user4@email.com"])
+    self.assertTrue(response.data["not_found"] == ["unknown@email.com"])
+
+    organization = Organization.objects.get(pk=self.organization.pk)
+    self.assertTrue(sorted(organization.members.values_list("email", flat=True)) == ["testemail@email.com", "user0@email.com", "user2@email.com", "user3@email.com"])
+    self.assertTrue(organization.members_count == 4)
+
+    if is_email_enabled("membersAdded-toOwner"): # pragma: no cover
+      owner_emails = [m for m in mail.outbox if m.to == ["testemail@email.com"]]
+      self.assertTrue(len(owner_emails) == 2)
+      self.assertTrue("user2@email.com" in owner_emails[0].body and "user3@email.com" in owner_emails[0].body)
+
+  def test_update_members_fires_one_signal_per_direction(self):
+    """ Assert adding and removing many members fires m2m_changed once per direction """
+    actions = []
+    def receiver(sender, action, **kwargs):
+      actions.append(action)
+    m2m_changed.connect(receiver, sender=Organization.members.through)
+    try:
+      self.update({"add": ["user2@email.com", "user3@email.com", "user4@email.com"], "remove": ["user0@email.com", "user1@email.com"]})
+    finally:
+      m2m_changed.disconnect(receiver, sender=Organization.members.through)
+    self.assertTrue(actions == ["pre_add", "post_add", "pre_remove", "post_remove"])
+
+  def test_update_members_validation(self):
+    """ Assert update_members requires users and ownership """
+    response = self.update({})
+    self.assertTrue(response.status_code == 400)
+
+    response = self.update({"add": ["user2@email.com"], "remove": ["user2@email.com"]})
+    self.assertTrue(response.status_code == 400)
+
+    self.client.force_authenticate(self.users[0])
+    response = self.update({"add": ["user2@email.com"]})
+    self.assertTrue(response.status_code == 403)
+
+
+class OrganizationBulkRetrieveTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="testemail@email.com", password="test_returned")
+    self.member = User.objects.create_user(email="member@email.com", password="test_returned")
+
+    self.organizations = []
+    for i in range(6):
+      address = GoogleAddress(typed_address="address {}".format(i))
+      address.save_base(raw=True)
+      organization = Organization(name="organization {}".format(i), owner=self.user, published=True, hidden_address=bool(i % 2), address=address)
+      organization.save()
+      organization.causes.add(Cause.objects.get(pk=1))
+      self.organizations.append(organization)
+    self.organizations[1].members.add(self.member)
+    Organization.objects.filter(slug="organization-5").update(deleted=True)
+
+    self.client = APIClient()
+
+  def test_bulk_retrieve(self):
+    """ Assert organizations are returned in the requested order and missing ones are reported """
+    response = self.client.get(reverse("organization-bulk-retrieve"), {"slugs": "organization-2,organization-0,missing,organization-5", "ids": "{},{}".format(self.organizations[3].pk, self.organizations[0].pk)}, format="json")
+    self.assertTrue(response.status_code == 200)
+    self.assertTrue([organization["slug"] for organization in response.data["results"]] == ["organization-2", "organization-0", "organization-3"])
+    self.assertTrue(response.data["not_found"] == ["missing", "organization-5"])
+    self.assertTrue(response.data["results"][0] == self.client.get(reverse("organization-detail", ["organization-2"]), format="json").data)
+
+    response = self.client.post(reverse("organization-bulk-retrieve"), {"ids": [self.organizations[4].pk]}, format="json")
+    self.assertTrue([organization["slug"] for organization in response.data["results"]] == ["organization-4"])
+
+  def test_bulk_retrieve_hides_addresses(self):
+    """ Assert hidden addresses are only shown to members, in a constant number of queries """
+    slugs = ",".join("organization-{}".format(i) for i in range(5))
+
+    self.client.force_authenticate(self.member)
+    with self.assertNumQueries(3):
+      response = self.client.get(reverse("organization-bulk-retrieve"), {"slugs": slugs}, format="json")
+
+    addresses = [organization["address"] for organization in response.data["results"]]
+    self.assertTrue(addresses[1]["typed_address"] == "address 1")
+    self.assertTrue(addresses[3] is None)
+    self.assertTrue(addresses[2]["typed_address"] == "address 2")
+    self.assertTrue(len(set(tuple(organization) for organization in response.data["results"])) == 1)
+
+  def test_bulk_retrieve_validation(self):
+    """ Assert bulk retrieve requires slugs or ids and limits their number """
+    response = self.client.get(reverse("organization-bulk-retrieve"), format="json")
+    self.assertTrue(response.status_code == 400)
+
+    response = self.client.post(reverse("organization-bulk-retrieve"), {"ids": list(range(201))}, format="json")
+    self.assertTrue(response.status_code == 400)
+
+
+class OrganizationSparseFieldsTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="testemail@email.com", password="test_returned")
+
+    address = GoogleAddress(typed_address="r. tecainda, 81, sao paulo")
+    address.save_base(raw=True)
+
+    self.organization = Organization(name="test organization", owner=self.user, published=True, hidden_address=True, address=address, image=UploadedImage.objects.create())
+    self.organization.save()
+    self.organization.causes.add(Cause.objects.get(pk=1))
+
+    self.client = APIClient()
+
+  def test_retrieve_fields(self):
+    """ Assert ?fields= only serializes and queries the requested fields """
+    with CaptureQueriesContext(connection) as queries:
+      response = self.client.get(reverse("organization-detail", ["test-organization"]), {"fields": "name,slug"}, format="json")
+    self.assertTrue(response.status_code == 200)
+    self.assertTrue(list(response.data) == ["slug", "name"])
+
+    # The conditional request pre-query and the organization, without joins or prefetches
+    self.assertTrue(len(queries) == 2)
+    self.assertTrue("JOIN" not in queries.captured_queries[1]["sql"])
+    self.assertTrue('"details"' not in queries.captured_queries[1]["sql"])
+
+  def test_retrieve_omit(self):
+    """ Assert ?omit= drops fields and keeps hidden addresses working """
+    response = self.client.get(reverse("organization-detail", ["test-organization"]), {"omit": "causes,owner"}, format="json")
+    self.assertTrue("causes" not in response.data and "owner" not in response.data)
+    self.assertTrue(response.data["address"] is None)
+
+    self.client.force_authenticate(self.user)
+    response = self.client.get(reverse("organization-detail", ["test-organization"]), {"omit": "causes,owner"}, format="json")
+    self.assertTrue(response.data["address"]["typed_address"] == "r. tecainda, 81, sao paulo")
+
+    response = self.client.get(reverse("organization-detail", ["test-organization"]), {"omit": "address"}, format="json")
+    self.assertTrue("address" not in response.data)
+
+  def test_sparse_etags(self):
+    """ Assert sparse responses do not share ETags with full ones """
+    full = self.client.get(reverse("organization-detail", ["test-organization"]), format="json")
+    response = self.client.get(reverse("organization-detail", ["test-organization"]), {"fields": "name"}, format="json", HTTP_IF_NONE_MATCH=full["ETag"])
+    self.assertTrue(response.status_code == 200)
+
+  def test_list_and_bulk_retrieve_fields(self):
+    """ Assert the list and bulk retrieve also accept ?fields= """
+    response = self.client.get(reverse("organization-list"), {"fields": "slug"}, format="json")
+    self.assertTrue(response.data["results"] == [{"slug": "test-organization"}])
+
+    response = self.client.get(reverse("organization-bulk-retrieve"), {"slugs": "test-organization", "fields": "slug,name"}, format="json")
+    self.assertTrue(response.data["results"] == [{"slug": "test-organization", "name": "test organization"}])
+
+
+class OrganizationCausesTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="testemail@email.com", password="test_returned")
+    self.organization = Organization(name="test organization", owner=self.user)
+    self.organization.save()
+    self.organization.causes.add(*Cause.objects.filter(pk__in=[1, 2, 3]))
+
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+
+  def patch(self, data):
+    return self.client.patch(reverse("organization-detail", ["test-organization"]), data, format="json")
+
+  def test_unknown_causes_are_validation_errors(self):
+    """ Assert unknown cause ids are reported per item """
+    response = self.patch({"causes": [{"id": 1}, {"id": 9999}]})
+    self.assertTrue(response.status_code == 400)
+    self.assertTrue(response.data["causes"] == [{}, {"id": ["Cause with 'id' 9999 does not exist."]}])
+
+    data = copy.copy(base_organization)
+    data["causes"] = [{"id": 9999}]
+    response = self.client.post(reverse("organization-list"), data, format="json")
+    self.assertTrue(response.status_code == 400)
+    self.assertTrue(response.data["causes"] == [{"id": ["Cause with 'id' 9999 does not exist."]}])
+
+  def test_causes_are_diffed(self):
+    """ Assert updating causes only writes additions and removals """
+    with CaptureQueriesContext(connection) as queries:
+      response = self.patch({"causes": [{"id": 2}, {"id": 3}, {"id": 4}]})
+    self.assertTrue(response.status_code == 200)
+    self.assertTrue(sorted(cause["id"] for cause in response.data["causes"]) == [2, 3, 4])
+
+    statements = [query["sql"].split(" ")[0] for query in queries.captured_queries if "organization_causes" in query["sql"].split(" WHERE ")[0]]
+    self.assertTrue(statements.count("DELETE") == 1)
+    self.assertTrue(statements.count("INSERT") == 1)
+
+    with CaptureQueriesContext(connection) as queries:
+      self.patch({"causes": [{"id": 4}, {"id": 3}, {"id": 2}]})
+    self.assertTrue(not [query for query in queries.captured_queries if query["sql"].startswith(("DELETE", "INSERT")) and "organization_causes" in query["sql"]])
+
+
+class OrganizationAddressUpdateTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="testemail@email.com", password="test_returned")
+    address = GoogleAddress(typed_address="r. tecainda, 81, sao paulo")
+    address.save_base(raw=True)
+    self.organization = Organization(name="test organization", owner=self.user, address=address)
+    self.organization.save()
+
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+
+  def patch(self, address):
+    with mock.patch("ovp_core.models.address.google_address.requests.get") as geocode:
+      geocode.return_value.json.return_value = {"results": []}
+      response = self.client.patch(reverse("organization-detail", ["test-organization"]), {"address": address}, format="json")
+    self.assertTrue(response.status_code == 200)
+    return geocode
+
+  def test_address_is_updated_in_place(self):
+    """ Assert patching the address keeps its row and skips unchanged data """
+    address_id = self.organization.address_id
+
+    geocode = self.patch({"typed_address": "r. tecainda, 81, sao paulo", "typed_address2": "apto 1"})
+    self.assertTrue(not geocode.called)
+    self.assertTrue(GoogleAddress.objects.count() == 1)
+    self.assertTrue(Organization.objects.get(pk=self.organization.pk).address_id == address_id)
+    self.assertTrue(GoogleAddress.objects.get(pk=address_id).typed_address2 == "apto 1")
+
+    with CaptureQueriesContext(connection) as queries:
+      self.patch({"typed_address": "r. tecainda, 81, sao paulo", "typed_address2": "apto 1"})
+    self.assertTrue(not [query for query in queries.captured_queries if "google" in query["sql"] and not query["sql"].startswith("SELECT")])
+
+    geocode = self.patch({"typed_address": "campinas, sp"})
+    self.assertTrue(geocode.call_count == 1)
+    self.assertTrue(GoogleAddress.objects.count() == 1)
+    self.assertTrue(GoogleAddress.objects.get(pk=address_id).typed_address == "campinas, sp")
+
+  def test_geocoding_is_reused(self):
+    """ Assert addresses already geocoded for a typed address are not geocoded again """
+    geocoded = GoogleAddress(typed_address="campinas, sp", address_line="Campinas, SP, Brazil", city_state="Campinas, SP", lat=-22.9, lng=-47.06)
+    geocoded.save_base(raw=True)
+
+    geocode = self.patch({"typed_address": "campinas, sp"})
+    self.assertTrue(not geocode.called)
+
+    address = Organization.objects.get(pk=self.organization.pk).address
+    self.assertTrue(address.pk == self.organization.address_id)
+    self.assertTrue(address.city_state == "Campinas, SP")
+    self.assertTrue(address.lat == -22.9 and address.lng == -47.06)
+
+  def test_delete_orphaned_addresses(self):
+    """ Assert delete_orphaned_addresses only deletes unreferenced addresses """
+    for i in range(5):
+      GoogleAddress(typed_address="orphan {}".format(i)).save_base(raw=True)
+
+    out = StringIO()
+    call_command("delete_orphaned_addresses", "--dry-run", "--grace", "0", stdout=out)
+    self.assertTrue(out.getvalue().strip() == "Found 5 orphaned addresses")
+    self.assertTrue(GoogleAddress.objects.count() == 6)
+
+    out = StringIO()
+    call_command("delete_orphaned_addresses", "--batch-size", "2", "--grace", "0", stdout=out)
+    self.assertTrue(out.getvalue().strip() == "Deleted 5 orphaned addresses")
+    self.assertTrue(list(GoogleAddress.objects.values_list("pk", flat=True)) == [self.organization.address_id])
+
+  def test_delete_orphaned_addresses_grace(self):
+    """ Assert addresses created while delete_orphaned_addresses waits are kept """
+    GoogleAddress(typed_address="orphan").save_base(raw=True)
+    in_flight = []
+
+    def sleep(seconds):
+      # An address inserted before the organization referencing it commits
+      address = GoogleAddress(typed_address="in flight")
+      address.save_base(raw=True)
+      in_flight.append(address)
+
+    out = StringIO()
+    with mock.patch("ovp_organizations.management.commands.delete_orphaned_addresses.time.sleep", side_effect=sleep):
+      call_command("delete_orphaned_addresses", stdout=out)
+    self.assertTrue(out.getvalue().strip() == "Deleted 1 orphaned addresses")
+    self.assertTrue(GoogleAddress.objects.filter(pk=in_flight[0].pk).exists())
+
+  def test_conditional_get_after_address_update(self):
+    """ Assert patching the address changes the organization retrieve ETag """
+    url = reverse("organization-detail", ["test-organization"])
+    etag = self.client.get(url)["ETag"]
+    self.assertTrue(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == 304)
+
+    self.patch({"typed_address": "r. tecainda, 81, sao paulo", "typed_address2": "apto 9"})
+    response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+    self.assertTrue(response.status_code == 200)
+    self.assertTrue(response.data["address"]["typed_address2"] == "apto 9")
@@ -4,7 +4,15 @@ from ovp_core.serializers import EmptySerializer
 
 from ovp_organizations import serializers
 from ovp_organizations import models
+from ovp_organizations import cache
+from ovp_organizations import conditional
+from ovp_organizations import outbox
 from ovp_organizations import permissions as organization_permissions
+from ovp_organizations.filters import filter_organizations
+from ovp_organizations.flat import FlatOrganizationSearchSerializer
+from ovp_organizations.membership import get_membership
+from ovp_organizations.membership import prefetch_memberships
+from ovp_organizations.pagination import KeysetPagination
 
 from ovp_projects.serializers.project import ProjectOnOrganizationRetrieveSerializer
 from ovp_projects.models import Project
@@ -19,19 +27,134 @@ from rest_framework import pagination
 from rest_framework import permissions
 from rest_framework import status
 
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import Case
+from django.db.models import Count
+from django.db.models import IntegerField
+from django.db.models import Max
+from django.db.models import Prefetch
+from django.db.models import Q
+from django.db.models import Sum
+from django.db.models import Value
+from django.db.models import When
 from django.shortcuts import get_object_or_404
 
+from collections import OrderedDict
+
 import json
 
-class OrganizationResourceViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+class OrganizationResourceViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin, mixins.ListModelMixin, viewsets.GenericViewSet):
   """
   OrganizationResourceViewSet resource endpoint
   """
-  queryset = models.Organization.objects.all()
+  queryset = models.Organization.objects.alive()
   model = models.Organization
   lookup_field = 'slug'
   lookup_value_regex = '[^/]+' # default is [^/.]+ - here we're allowing dots in the url slug field
 
+  def get_queryset(self):
+    if self.action == 'list':
+      queryset = models.Organization.objects.public().select_related('address', 'image')
+      return self.sparse_queryset(filter_organizations(queryset, self.request.query_params))
+    if self.action in ['retrieve', 'bulk_retrieve']:
+      # Matches the nested fields of OrganizationRetrieveSerializer
+      return self.sparse_queryset(models.Organization.objects.alive().select_related('owner', 'address', 'image', 'cover').prefetch_related('causes'))
+    return super(OrganizationResourceViewSet, self).get_queryset()
+
+  def sparse_queryset(self, queryset):
+    """ Drops the joins and columns of fields left out by ?fields= or ?omit= """
+    names = self.get_serializer_class().sparse_field_names(self.request)
+    if names is None:
+      return queryset
+
+    relations = [name for name in queryset.query.select_related or {} if name in names]
+    queryset = queryset.select_related(None)
+    if relations:
+      queryset = queryset.select_related(*relations)
+    if 'causes' not in names:
+      queryset = queryset.prefetch_related(None)
+
+    # Always needed by hidden addresses, bulk_retrieve and conditional requests
+    columns = set(['slug', 'owner', 'hidden_address', 'modified_date'])
+    columns.update(name for name in names if name in self.concrete_field_names)
+    return queryset.only(*columns)
+
+  @property
+  def concrete_field_names(self):
+    return [field.name for field in models.Organization._meta.concrete_fields]
+
+  @property
+  def paginator(self):
+    """ The list is paginated by keyset. Projects are too when a 'cursor'
+        param is given, even empty for the first page, other actions keep
+        the default pagination """
+    if not hasattr(self, '_paginator'):
+      if self.action == 'list' or (self.action == 'projects' and 'cursor' in self.request.query_params):
+        self._paginator = KeysetPagination()
+    return super(OrganizationResourceViewSet, self).paginator
+
+  def get_projects_queryset(self, organization):
+    """ Published projects of an organization, newest first, with every
+        relation ProjectOnOrganizationRetrieveSerializer renders """
+    user = self.request.user
+    return Project.objects.filter(organization=organization, published=True).order_by('-created_date', '-id').select_related(
+      'image', 'address', 'owner', 'owner__avatar', 'organization', 'organization__address', 'job', 'work'
+    ).prefetch_related(
+      'causes', 'skills', 'job__dates',
+      # Hidden addresses only check whether the viewer is a member
+      Prefetch('organization__members', queryset=User.objects.filter(pk=user.pk if user.is_authenticated else None))
+    )
+
+  def list(self, request, *args, **kwargs):
+    """ Renders the page from values() rows, with the same output as
+        OrganizationSearchSerializer """
+    if not FlatOrganizationSearchSerializer.is_supported():
+      return super(OrganizationResourceViewSet, self).list(request, *args, **kwargs)
+
+    flat = FlatOrganizationSearchSerializer(request, serializers.OrganizationSearchSerializer.sparse_field_names(request))
+    page = self.paginate_queryset(flat.get_queryset(self.filter_queryset(self.get_queryset())))
+    return self.get_paginated_response(flat.serialize(page))
+
+  def retrieve(self, request, *args, **kwargs):
+    etag, last_modified, private = self.get_retrieve_validators()
+    if etag is None:
+      return super(OrganizationResourceViewSet, self).retrieve(request, *args, **kwargs)
+
+    not_modified = conditional.not_modified(request, etag, last_modified)
+    if not_modified is not None:
+      return not_modified
+
+    if cache.is_enabled():
+      data = cache.get_or_render(self.kwargs[self.lookup_field], etag, lambda: self.get_serializer(self.get_object()).data)
+      ret = response.Response(data)
+    else:
+      ret = super(OrganizationResourceViewSet, self).retrieve(request, *args, **kwargs)
+    return conditional.set_validators(ret, etag, last_modified, private=private)
+
+  def get_retrieve_validators(self):
+    """ Computes (etag, last_modified, private) for retrieve from a single row,
+        without loading or serializing the organization.
+
+        Organizations with hidden addresses render differently for owners and
+        members than for everyone else, so the viewer is part of their ETag
+        and they have no Last-Modified, which can't tell viewers apart. """
+    values = models.Organization.objects.alive().filter(slug=self.kwargs[self.lookup_field]).values('pk', 'owner_id', 'address_id', 'hidden_address', 'members_count', 'projects_count', 'modified_date', 'owner__modified_date', 'image__modified_date', 'cover__modified_date').first()
+    if values is None:
+      return None, None, False
+
+    viewer = 'public'
+    if values['hidden_address'] and get_membership(self.request, values['pk'], values['owner_id']).is_owner_or_member:
+      viewer = 'member'
+
+    dates = [values['modified_date'], values['owner__modified_date'], values['image__modified_date'], values['cover__modified_date']]
+    fields, omit = self.request.query_params.get('fields', ''), self.request.query_params.get('omit', '')
+    etag = conditional.make_etag('organization', values['pk'], values['address_id'], values['members_count'], values['projects_count'], viewer, fields, omit, *dates)
+    last_modified = None if values['hidden_address'] else conditional.to_timestamp(*dates)
+    return etag, last_modified, values['hidden_address']
+
   def partial_update(self, request, *args, **kwargs):
     """ We do not include the mixin as we want only PATCH and no PUT """
     instance = self.get_object()
@@ -54,25 +177,59 @@ class OrganizationResourceViewSet(mixins.CreateModelMixin, mixins.RetrieveModelM
 
     invited = User.objects.get(email=request.data["email"])
 
+    # The unique (organization, invited) index rejects duplicate invites,
+    # so there is no need to look the invite up before inserting it
     try:
-      models.OrganizationInvite.objects.get(organization=organization, invited=invited)
+      with transaction.atomic():
+        invite = models.OrganizationInvite.objects.create(invitator=request.user, invited=invited, organization=organization)
+        organization.mailing().sendUserInvited(context={"invite": invite})
+    except IntegrityError:
+      if not models.OrganizationInvite.objects.filter(organization=organization, invited=invited).exists():
+        raise
       return response.Response({"email": ["This user is already invited to this organization."]}, status=400)
-    except models.OrganizationInvite.DoesNotExist:
-      pass
 
-    invite = models.OrganizationInvite(invitator=request.user, invited=invited, organization=organization)
-    invite.save()
+    return response.Response({"detail": "User invited."})
 
-    organization.mailing().sendUserInvited(context={"invite": invite})
+  @decorators.detail_route(methods=["POST"])
+  def invite_users(self, request, *args, **kwargs):
+    """ Invites a list of users, reporting the status of each email:
+        'invited', 'already_invited', 'invalid' or 'not_found' """
+    organization = self.get_object()
 
-    return response.Response({"detail": "User invited."})
+    serializer = self.get_serializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+
+    statuses = OrderedDict()
+    for email in serializer.validated_data["emails"]:
+      email = email.strip()
+      try:
+        validate_email(email)
+        statuses.setdefault(email, "not_found")
+      except ValidationError:
+        statuses.setdefault(email, "invalid")
+
+    users = User.objects.filter(email__in=[email for email, status in statuses.items() if status == "not_found"])
+    users = {user.email: user for user in users}
+    for email in users:
+      statuses[email] = "already_invited"
+
+    with transaction.atomic():
+      invites = organization.invite_users(request.user, users.values())
+
+      with outbox.batch():
+        for invite in invites:
+          statuses[invite.invited.email] = "invited"
+          organization.mailing().sendUserInvited(context={"invite": invite})
+
+    return response.Response({"results": [{"email": email, "status": status} for email, status in statuses.items()]})
 
   @decorators.detail_route(methods=["POST"])
   def join(self, request, *args, **kwargs):
     organization = self.get_object()
-    organization.members.add(request.user)
 
-    organization.mailing().sendUserJoined(context={"user": request.user, "organization": organization})
+    with transaction.atomic():
+      organization.members.add(request.user)
+      organization.mailing().sendUserJoined(context={"user": request.user, "organization": organization})
 
     return response.Response({"detail": "Joined organization."})
 
@@ -89,17 +246,19 @@ class OrganizationResourceViewSet(mixins.CreateModelMixin, mixins.RetrieveModelM
     except models.OrganizationInvite.DoesNotExist:
       return response.Response({"detail": "This user is not invited to this organization."}, status=400)
 
-    organization.mailing().sendUserInvitationRevoked(context={"invite": invite})
-    invite.delete()
+    with transaction.atomic():
+      organization.mailing().sendUserInvitationRevoked(context={"invite": invite})
+      invite.delete()
 
     return response.Response({"detail": "Invite has been revoked."})
 
   @decorators.detail_route(methods=["POST"])
   def leave(self, request, *args, **kwargs):
     organization = self.get_object()
-    organization.members.remove(request.user)
 
-    organization.mailing().sendUserLeft(context={"user": request.user, "organization": organization})
+    with transaction.atomic():
+      organization.members.remove(request.user)
+      organization.mailing().sendUserLeft(context={"user": request.user, "organization": organization})
 
     return response.Response({"detail": "You've left the organization."})
 
@@ -113,36 +272,151 @@ class OrganizationResourceViewSet(mixins.CreateModelMixin, mixins.RetrieveModelM
     except User.DoesNotExist:
       return response.Response({"email": ["This user is not valid."]}, status=400)
 
-    organization.members.remove(user)
-
-    organization.mailing().sendUserRemoved(context={"user": user, "organization": organization})
+    with transaction.atomic():
+      organization.members.remove(user)
+      organization.mailing().sendUserRemoved(context={"user": user, "organization": organization})
 
     return response.Response({"detail": "Member was removed."})
 
+  @decorators.detail_route(methods=["POST"])
+  def update_members(self, request, *args, **kwargs):
+    """ Adds and removes members, given by email or id, in one transaction.
+        Users who are unknown or whose membership would not change are
+        reported in 'not_found' and 'unchanged' """
+    organization = self.get_object()
+
+    serializer = self.get_serializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+
+    identifiers = serializer.validated_data["add"] + serializer.validated_data["remove"]
+    ids = [int(identifier) for identifier in identifiers if identifier.isdigit()]
+    emails = [identifier for identifier in identifiers if not identifier.isdigit()]
+
+    by_identifier = {}
+    for user in User.objects.filter(Q(pk__in=ids) | Q(email__in=emails)):
+      by_identifier[str(user.pk)] = user
+      by_identifier[user.email] = user
+
+    add = [by_identifier[identifier] for identifier in serializer.validated_data["add"] if identifier in by_identifier]
+    remove = [by_identifier[identifier] for identifier in serializer.validated_data["remove"] if identifier in by_identifier]
+
+    with transaction.atomic():
+      added, removed = organization.update_members(add=add, remove=remove)
+
+      with outbox.batch():
+        if added:
+          organization.mailing().sendMembersAdded(context={"users": added, "organization": organization})
+        if removed:
+          organization.mailing().sendMembersRemoved(context={"users": removed, "organization": organization})
+
+    changed = set(user.pk for user in added + removed)
+    return response.Response({
+      "added": [user.email for user in added],
+      "removed": [user.email for user in removed],
+      "unchanged": list(OrderedDict((user.email, None) for user in add + remove if user.pk not in changed)),
+      "not_found": [identifier for identifier in identifiers if identifier not in by_identifier],
+    })
+
+  @decorators.list_route(methods=["GET", "POST"])
+  def bulk_retrieve(self, request, *args, **kwargs):
+    """ Retrieves many organizations by slug or id, either with comma
+        separated 'slugs' and 'ids' query params or as lists in the body.
+        Organizations are returned in the order they were requested """
+    if request.method == "GET":
+      data = {key: [value for value in request.query_params.get(key, "").split(",") if value] for key in ["slugs", "ids"]}
+    else:
+      data = request.data
+
+    serializer = serializers.OrganizationBulkRetrieveSerializer(data=data)
+    serializer.is_valid(raise_exception=True)
+    slugs, ids = serializer.validated_data["slugs"], serializer.validated_data["ids"]
+
+    organizations = self.get_queryset().filter(Q(slug__in=slugs) | Q(pk__in=ids))
+    by_slug = {organization.slug: organization for organization in organizations}
+    by_id = {organization.pk: organization for organization in by_slug.values()}
+
+    # Hidden addresses need to know which organizations the viewer belongs to
+    prefetch_memberships(request, [organization for organization in by_id.values() if organization.hidden_address])
+
+    results, seen = [], set()
+    for organization in [by_slug.get(slug) for slug in slugs] + [by_id.get(pk) for pk in ids]:
+      if organization is not None and organization.pk not in seen:
+        seen.add(organization.pk)
+        results.append(organization)
+
+    return response.Response({
+      "results": self.get_serializer(results, many=True).data,
+      "not_found": [slug for slug in slugs if slug not in by_slug] + [pk for pk in ids if pk not in by_id],
+    })
+
+  @decorators.list_route(methods=["POST"])
+  def bulk_publish(self, request, *args, **kwargs):
+    serializer = self.get_serializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+
+    organizations = self.get_queryset().filter(slug__in=serializer.validated_data["slugs"])
+    if serializer.validated_data["published"]:
+      changed = organizations.publish()
+    else:
+      changed = organizations.unpublish()
+
+    return response.Response({"changed": [organization.slug for organization in changed]})
+
   @decorators.detail_route(methods=['GET'])
   def projects(self, request, slug, pk=None):
     organization = self.get_object()
-    projects = Project.objects.filter(organization=organization, published=True)
+    projects = self.get_projects_queryset(organization)
+
+    # Projects are validated by their latest modification and count, the
+    # count catches projects being removed from the list
+    hidden = Sum(Case(When(hidden_address=True, then=Value(1)), default=Value(0), output_field=IntegerField()))
+    latest = projects.order_by().aggregate(modified_date=Max('modified_date'), count=Count('pk'), hidden=hidden)
+
+    # Hidden project addresses are shown to organization members and to the
+    # project owner, so those lists depend on the viewer
+    viewer = 'public'
+    if latest['hidden']:
+      if get_membership(request, organization.pk, organization.owner_id).is_member:
+        viewer = 'member'
+      elif request.user.is_authenticated:
+        viewer = 'user:{}'.format(request.user.pk)
+
+    etag = conditional.make_etag('projects', organization.pk, latest['count'], latest['modified_date'], viewer, request.query_params.urlencode())
+    private = bool(latest['hidden'])
+    last_modified = None if private else conditional.to_timestamp(latest['modified_date'])
+
+    not_modified = conditional.not_modified(request, etag, last_modified)
+    if not_modified is not None:
+      return not_modified
+
     page = self.paginate_queryset(projects)
     if page is not None:
       serializer = self.get_serializer(page, many=True)
-      return self.get_paginated_response(serializer.data)
+      return conditional.set_validators(self.get_paginated_response(serializer.data), etag, last_modified, private=private)
     serializer = self.get_serializer(projects, many=True)
 
-    return response.Response(serializer.data)
+    return conditional.set_validators(response.Response(serializer.data), etag, last_modified, private=private)
 
   def get_serializer_class(self):
     request = self.get_serializer_context()['request']
     if self.action in ['create', 'partial_update']:
       return serializers.OrganizationCreateSerializer
-    if self.action == 'retrieve':
+    if self.action in ['retrieve', 'bulk_retrieve']:
       return serializers.OrganizationRetrieveSerializer
+    if self.action == 'list':
+      return serializers.OrganizationSearchSerializer
     if self.action in ['invite_user', 'revoke_invite']:
       return serializers.OrganizationInviteSerializer
+    if self.action == 'invite_users':
+      return serializers.OrganizationBulkInviteSerializer
     if self.action == 'remove_member':
       return serializers.MemberRemoveSerializer
+    if self.action == 'update_members':
+      return serializers.OrganizationMembersSerializer
     if self.action == 'projects':
       return ProjectOnOrganizationRetrieveSerializer
+    if self.action == 'bulk_publish':
+      return serializers.OrganizationBulkPublishSerializer
     if self.action in ['leave', 'join']: # pragma: no cover
       return EmptySerializer
 
@@ -153,16 +427,18 @@ class OrganizationResourceViewSet(mixins.CreateModelMixin, mixins.RetrieveModelM
       self.permission_classes = (permissions.IsAuthenticated,)
     if self.action == 'partial_update':
       self.permission_classes = (permissions.IsAuthenticated, organization_permissions.OwnsOrIsOrganizationMember)
-    if self.action == 'retrieve':
+    if self.action in ['retrieve', 'list', 'bulk_retrieve']:
       self.permission_classes = ()
-    if self.action in ['invite_user', 'revoke_invite']:
+    if self.action in ['invite_user', 'invite_users', 'revoke_invite']:
       self.permission_classes = (permissions.IsAuthenticated, organization_permissions.OwnsOrIsOrganizationMember)
     if self.action == 'join':
       self.permission_classes = (permissions.IsAuthenticated, organization_permissions.IsInvitedToOrganization)
     if self.action == 'leave':
       self.permission_classes = (permissions.IsAuthenticated, organization_permissions.IsOrganizationMember)
-    if self.action == 'remove_member':
+    if self.action in ['remove_member', 'update_members']:
       self.permission_classes = (permissions.IsAuthenticated, organization_permissions.OwnsOrganization)
+    if self.action == 'bulk_publish':
+      self.permission_classes = (permissions.IsAuthenticated, permissions.IsAdminUser)
 
     return super(OrganizationResourceViewSet, self).get_permissions()
 
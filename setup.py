@@ -7,7 +7,7 @@ setup(
     version='1.0.13',
     author=u'Atados',
     author_email='arroyo@atados.com.br',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     include_package_data=True,
     url='https://github.com/OpenVolunteeringPlatform/django-ovp-organizations',
     download_url = 'https://github.com/OpenVolunteeringPlatform/django-ovp-organizations/tarball/1.0.13',